@@ -0,0 +1,30 @@
+"""村田安雄『動的経済システムの最適制御』の検算＆シミュレーションのモデル部分。
+
+ノートブック (economy_control_*.ipynb) は import すると実験や描画を全部
+実行してしまうので、モデルの数値計算だけをここに切り出した。
+
+    from economy_control import ch04
+    prm = ch04.get_params('k', case=ch04.case_II)
+    sol = ch04.solve_A_Tp1(prm)
+
+サブモジュールは最初に属性として参照されたときに import する。どのサブ
+モジュールも import 時には numpy しか読まず、scipy, sympy, matplotlib は
+それを使う関数の中で import する。実験と図は experiments と figures にあ
+り、明示的に呼んだときだけ実行される。シナリオのファイルをまとめて解くと
+きは batch を、図4-1a～図4-10b を描き直すときは render を使う。ノート
+ブックのベンチマークは bench を、最適化の呼び出しの計測は instrument を
+import して使う。
+"""
+
+import importlib
+
+__version__ = '0.0.1'
+
+__all__ = ['batch', 'bench', 'ch02', 'ch03_2b', 'ch04', 'experiments',
+           'figures', 'instrument', 'render']
+
+
+def __getattr__ (name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,456 @@
+"""シナリオのファイルをまとめて解くバッチ処理。
+
+    python -m economy_control.batch ch04 scenarios.jsonl out --workers 8
+    python -m economy_control.batch ch02 params.json out --method Newton-CG
+
+入力は JSON Lines (.jsonl) か JSON (.json) か Parquet (.parquet)。一行
+(一レコード)が一つのシナリオである。第4章のシナリオは get_params の引数
+と同じで、"alternative" に代替型にするパラメータの名前のリスト、"case" に
+"I" か "II"、あとは上書きしたい standard のパラメータ(T と p も可)を書く。
+第2章は s, nu, rho, phi, dt と初期値 y0、期間の数 n である。どちらも "id"
+を付けておけば出力にそのまま書かれる。.json のトップレベルが dict のとき
+は、値の直積をとってシナリオにする(ノートブックの make_scenarios と同
+じ)。
+
+シナリオは chunksize 個ずつ読んでワーカーに渡し、結果はチャンクごとに出
+力ディレクトリの part-00000.npz (または .parquet) に列ごとに書く。入力も
+出力も全体をメモリに載せることはない。解けなかったシナリオも success を
+False にして入力のパラメータは書き、結果の列だけを NaN にする。途中で止
+まっても --resume を付けて同じ設定で実行し直せば、書き終わったチャンク
+は飛ばして続きから解く。第4章の root では、同じチャンクの中ですでに解け
+たシナリオのうち(チャンク内の幅で正規化した距離で)一番近いものの
+A_{T+1} を初期値にする。近いシナリオが同じチャンクに入るよう、入力は並
+べておくとよい。manifest.json には入力の大きさと SHA-256 も書
+いておき、入力が変わっていれば続きを解かずにエラーにする。終了コードは
+今回解いた分だけでなく、出力ディレクトリのすべてのチャンクに失敗した行
+があれば 1 になる。
+Parquet の読み書きには pyarrow が要る。
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import ch02, ch04
+
+
+ch04_keys = ['gamma', 'r', 'theta', 'tau', 'k', 'A22', 'z', 'F65', 'T', 'p']
+ch04_methods = ['root', 'simple_sum', 'E22_UT', 'V', 'time_consistent', 'dp']
+ch04_scores = {
+    'simple_sum': (ch04.score_simple_sum, ch04.score_simple_sum_jac),
+    'E22_UT': (ch04.score_E22_UT, ch04.score_E22_UT_jac),
+    'V': (ch04.score_V, ch04.score_V_jac),
+}
+ch02_keys = ['s', 'nu', 'rho', 'phi', 'dt', 'y0', 'n']
+ch02_methods = ['LQR', 'Nelder-Mead', 'L-BFGS-B', 'Newton-CG']
+
+# 各章の出力の列。paths は長さがシナリオごとに違う系列。
+columns = {
+    'ch04': {
+        'scalars': ['index', 'id', 'case'] + ch04_keys
+        + ['method', 'success', 'message', 'nfev', 'nit', 'time',
+           'A_Tp1', 'd65', 'E22_UT', 'Ats_cons'],
+        'paths': ['Cts', 'Ats'],
+    },
+    'ch02': {
+        'scalars': ['index', 'id'] + ch02_keys
+        + ['method', 'success', 'message', 'nfev', 'nit', 'time', 'score'],
+        'paths': ['gs', 'ys'],
+    },
+}
+
+
+def read_records (path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches():
+            for r in batch.to_pylist():
+                yield {k: v for k, v in r.items() if v is not None}
+    elif ext in ('.jsonl', '.ndjson'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            names = list(data.keys())
+            data = (dict(zip(names, v))
+                    for v in itertools.product(*data.values()))
+        yield from data
+
+
+def iter_chunks (records, chunksize):
+    it = iter(records)
+    for i in itertools.count():
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield i, chunk
+
+
+def parse_ch04 (rec, method):
+    rec = dict(rec)
+    method = rec.pop('method', method)
+    alt = rec.pop('alternative', [])
+    if isinstance(alt, str):
+        alt = [alt]
+    case = rec.pop('case', 'I')
+    case = {'I': ch04.case_I, 'II': ch04.case_II}[case] \
+        if isinstance(case, str) else case
+    return method, ch04.get_param_values(*alt, case=case, **rec)
+
+
+def warm_start (chapter, method, records):
+    # チャンクのパラメータの幅を距離の尺度にする
+    if chapter != 'ch04':
+        return None
+    xs = []
+    for rec in records:
+        rec = dict(rec)
+        rec.pop('id', None)
+        try:
+            values = parse_ch04(rec, method)[1]
+            xs.append([float(values[n]) for n in ch04_keys])
+        except Exception:
+            pass
+    if not xs:
+        return None
+    scale = np.ptp(np.array(xs), axis=0)
+    scale[scale == 0] = 1
+    return {'scale': scale, 'x': [], 'A_Tp1': []}
+
+
+def solve_ch04 (rec, method, warm=None):
+    method, values = parse_ch04(rec, method)
+    prm = ch04.LifeCycleParams(**values)
+    out = {n: getattr(prm, n) for n in ch04_keys}
+    out.update({'method': method, 'A_Tp1': np.nan, 'd65': np.nan, 'nit': 0})
+    if method == 'root':
+        guess = None
+        if warm is not None:
+            x = np.array([out[n] for n in ch04_keys], dtype=float) \
+                / warm['scale']
+            if warm['x']:
+                i = np.argmin(np.sum((np.array(warm['x']) - x) ** 2, axis=1))
+                guess = warm['A_Tp1'][i]
+        sol = ch04.solve_A_Tp1(prm, guess)
+        if warm is not None and sol.success:
+            warm['x'].append(x)
+            warm['A_Tp1'].append(sol.x[0])
+        Cts, Ats, d65 = ch04.get_Cts_Ats_vec(sol.x[0], prm)
+        out.update({'success': bool(sol.success), 'message': sol.message,
+                    'nfev': sol.nfev, 'nit': sol.nit, 'A_Tp1': sol.x[0],
+                    'd65': float(d65)})
+    elif method in ch04_scores:
+        score, jac = ch04_scores[method]
+        res = ch04.minimize_Cts(score, prm, jac=jac)
+        Cts = res.x
+        out.update({'success': bool(res.success), 'message': res.message,
+                    'nfev': res.nfev, 'nit': res.nit})
+    elif method == 'time_consistent':
+        Cts, stages = ch04.plan_time_consistent(prm)
+        failed = [s for s in stages if not s['success']]
+        out.update({'success': not failed,
+                    'message': '; '.join(['t=%d: %s' % (s['t'], s['message'])
+                                          for s in failed]),
+                    'nfev': sum([s['nfev'] for s in stages]),
+                    'nit': len(stages)})
+    elif method == 'dp':
+        Cts, Ats = ch04.dp_path(ch04.solve_dp(prm), prm.A22, prm)
+        out.update({'success': True, 'message': '', 'nfev': 0})
+    else:
+        raise ValueError("unknown method %r" % method)
+    out['Cts'] = Cts
+    out['Ats'] = ch04.get_Ats(Cts, prm)
+    out['E22_UT'] = - ch04.score_E22_UT(Cts, prm)
+    out['Ats_cons'] = ch04.Ats_cons(Cts, prm)
+    return out
+
+
+def parse_ch02 (rec, method):
+    rec = dict(rec)
+    method = rec.pop('method', method)
+    values = {f.name: f.default
+              for f in dataclasses.fields(ch02.StabilizationParams) if f.init}
+    values.update({'y0': -1, 'n': 100})
+    values.update(rec)
+    return method, values
+
+
+def solve_ch02 (rec, method, warm=None):
+    method, values = parse_ch02(rec, method)
+    values = dict(values)
+    y0 = values.pop('y0')
+    n = values.pop('n')
+    prm = ch02.get_params(**values)
+    res = ch02.solve_gs(y0, n, prm, method=method)
+    out = {n_: getattr(prm, n_) for n_ in ('s', 'nu', 'rho', 'phi', 'dt')}
+    out.update({'y0': y0, 'n': n, 'method': method,
+                'success': bool(res.success),
+                'message': str(res.get('message', '')), 'nfev': res.nfev,
+                'nit': res.get('nit', 0), 'score': res.fun, 'gs': res.x,
+                'ys': ch02.calc_ys(y0, res.x, prm)})
+    return out
+
+
+def parse_inputs (chapter, rec, method):
+    # 失敗した行にも、既定値を補った入力を書いておく。数値にできない値は
+    # NaN のままにする。
+    parse = {'ch04': parse_ch04, 'ch02': parse_ch02}[chapter]
+    try:
+        values = parse(rec, method)[1]
+    except Exception:
+        values = rec
+    out = {}
+    for n in {'ch04': ch04_keys, 'ch02': ch02_keys}[chapter]:
+        try:
+            out[n] = float(values[n])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return out
+
+
+def solve_chunk (chapter, method, records, start):
+    solve = {'ch04': solve_ch04, 'ch02': solve_ch02}[chapter]
+    warm = warm_start(chapter, method, records)
+    rows = []
+    for i, rec in enumerate(records):
+        rec = dict(rec)
+        row = {'index': start + i, 'id': str(rec.pop('id', start + i)),
+               'method': rec.get('method', method)}
+        if chapter == 'ch04':
+            row['case'] = str(rec.get('case', 'I'))
+        t0 = time.perf_counter()
+        try:
+            with np.errstate(all='ignore'):
+                row.update(solve(rec, method, warm))
+        except Exception as e:
+            # 一つのシナリオの失敗でバッチ全体を止めないよう、記録だけする。
+            # 結果の列は NaN のままにする。
+            row.update(parse_inputs(chapter, rec, method))
+            row.update({'success': False, 'message': repr(e)})
+        row['time'] = time.perf_counter() - t0
+        rows.append(row)
+    return rows
+
+
+def rows_to_columns (rows, chapter):
+    cols = {}
+    for n in columns[chapter]['scalars']:
+        cols[n] = [r.get(n, np.nan) for r in rows]
+    for n in columns[chapter]['paths']:
+        cols[n] = [np.asarray(r.get(n, []), dtype=float) for r in rows]
+    return cols
+
+
+def part_path (outdir, i, fmt):
+    return os.path.join(outdir, "part-%05d.%s" % (i, fmt))
+
+
+def save_part (path, cols, chapter, fmt):
+    # 書きかけのファイルを完了したチャンクと取り違えないよう、一時ファイル
+    # に書いてから置き換える
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table({n: ([x.tolist() for x in v]
+                              if n in columns[chapter]['paths'] else v)
+                          for n, v in cols.items()})
+        pq.write_table(table, tmp)
+    else:
+        arrays = {}
+        for n, v in cols.items():
+            if n in columns[chapter]['paths']:
+                lens = np.array([len(x) for x in v])
+                a = np.full((len(v), max(lens, default=0)), np.nan)
+                for j, x in enumerate(v):
+                    a[j, :len(x)] = x
+                arrays[n] = a
+                arrays[n + '_len'] = lens
+            elif n in ('id', 'case', 'method', 'message'):
+                arrays[n] = np.array([str(x) for x in v])
+            else:
+                arrays[n] = np.array(v)
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def load_part (path):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        rows = pq.read_table(path).to_pylist()
+        return [{n: (np.array(v, dtype=float) if isinstance(v, list) else v)
+                 for n, v in r.items()} for r in rows]
+    with np.load(path) as z:
+        arrays = {n: z[n] for n in z.files}
+    paths = [n[:-len('_len')] for n in arrays if n.endswith('_len')]
+    rows = []
+    for j in range(len(arrays['index'])):
+        r = {n: a[j].item() for n, a in arrays.items()
+             if n not in paths and not n.endswith('_len')}
+        for n in paths:
+            r[n] = arrays[n][j, :arrays[n + '_len'][j]]
+        rows.append(r)
+    return rows
+
+
+def list_parts (outdir):
+    parts = {}
+    for fname in os.listdir(outdir):
+        if fname.startswith('part-') and fname.endswith(('.npz', '.parquet')):
+            parts[int(fname[5:10])] = os.path.join(outdir, fname)
+    return parts
+
+
+def part_failures (path):
+    # success の列だけを読んで、失敗した行の数を返す
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        success = pq.read_table(path, columns=['success']).column(0)
+        success = success.to_pylist()
+    else:
+        with np.load(path) as z:
+            success = z['success'].tolist()
+    return sum([not s for s in success])
+
+
+def file_digest (path, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def iter_results (outdir):
+    # 書き終わったチャンクの結果を入力の順に一レコードずつ返す
+    parts = list_parts(outdir)
+    for i in sorted(parts):
+        yield from load_part(parts[i])
+
+
+def run_batch (path, outdir, chapter, method=None, workers=None,
+               chunksize=32, fmt='npz', resume=False, verbose=True):
+    if method is None:
+        method = {'ch04': 'root', 'ch02': 'LQR'}[chapter]
+    log = print if verbose else (lambda *args: None)
+    manifest = {'input': os.path.abspath(path),
+                'input_size': os.path.getsize(path),
+                'input_sha256': file_digest(path), 'chapter': chapter,
+                'method': method, 'chunksize': chunksize, 'format': fmt}
+    os.makedirs(outdir, exist_ok=True)
+    mpath = os.path.join(outdir, 'manifest.json')
+    if os.path.exists(mpath):
+        with open(mpath, encoding='utf-8') as f:
+            old = json.load(f)
+        if not resume:
+            raise FileExistsError("%s already has results; use --resume"
+                                  " to continue" % outdir)
+        # 同じ名前でも中身が変わった入力では、書き終わったチャンクと続きが
+        # 別の入力になってしまう
+        for n in ('input_size', 'input_sha256'):
+            if old.get(n) != manifest[n]:
+                raise ValueError("%s was written for a different input: %s"
+                                 " %r != %r" % (outdir, n, old.get(n),
+                                                manifest[n]))
+        if old != manifest:
+            raise ValueError("%s was written with different settings: %r"
+                             % (outdir, old))
+    else:
+        with open(mpath, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+    done = set(list_parts(outdir))
+    stats = {'records': 0, 'failed': 0, 'chunks': 0, 'skipped': len(done)}
+    t_start = time.perf_counter()
+
+    def save (i, rows):
+        save_part(part_path(outdir, i, fmt), rows_to_columns(rows, chapter),
+                  chapter, fmt)
+        failed = sum([not r['success'] for r in rows])
+        stats['records'] += len(rows)
+        stats['failed'] += failed
+        stats['chunks'] += 1
+        log("part-%05d %d records (%d failed) %.2fs"
+            % (i, len(rows), failed, time.perf_counter() - t_start))
+
+    pending = ((i, c) for i, c in iter_chunks(read_records(path), chunksize)
+               if i not in done)
+    if workers is None:
+        workers = os.cpu_count()
+    if workers == 1:
+        for i, chunk in pending:
+            save(i, solve_chunk(chapter, method, chunk, i * chunksize))
+    else:
+        with ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork')) as ex:
+            # 読み込んだチャンクがたまりすぎないよう、投入はワーカー数の
+            # 二倍までにしておく
+            limit = 2 * workers
+            futures = {}
+            for i, chunk in pending:
+                if len(futures) >= limit:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        save(futures.pop(fut), fut.result())
+                futures[ex.submit(solve_chunk, chapter, method, chunk,
+                                  i * chunksize)] = i
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    save(futures.pop(fut), fut.result())
+    stats['time'] = time.perf_counter() - t_start
+    # 飛ばしたチャンクの失敗も数える。failed は今回解いた分だけ
+    stats['failed_total'] = sum([part_failures(p)
+                                 for p in list_parts(outdir).values()])
+    log("%d records in %d chunks (%d failed, %d chunks skipped) %.2fs"
+        % (stats['records'], stats['chunks'], stats['failed'],
+           stats['skipped'], stats['time']))
+    if stats['failed_total'] != stats['failed']:
+        log("%d failed in all chunks" % stats['failed_total'])
+    return stats
+
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(prog='python -m economy_control.batch')
+    parser.add_argument('chapter', choices=['ch02', 'ch04'])
+    parser.add_argument('input',
+                        help="シナリオのファイル (.jsonl, .json, .parquet)")
+    parser.add_argument('outdir', help="結果を書くディレクトリ")
+    parser.add_argument('--method', choices=ch04_methods + ch02_methods,
+                        help="ch04 の既定は root、ch02 の既定は LQR")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="プロセス数。1 なら並列化しない")
+    parser.add_argument('--chunksize', type=int, default=32)
+    parser.add_argument('--format', choices=['npz', 'parquet'],
+                        default='npz')
+    parser.add_argument('--resume', action='store_true',
+                        help="書き終わったチャンクを飛ばして続きから解く")
+    args = parser.parse_args(argv)
+    methods = {'ch04': ch04_methods, 'ch02': ch02_methods}[args.chapter]
+    if args.method is not None and args.method not in methods:
+        parser.error("method %s is not for %s" % (args.method, args.chapter))
+    try:
+        stats = run_batch(args.input, args.outdir, args.chapter,
+                          method=args.method, workers=args.workers,
+                          chunksize=args.chunksize, fmt=args.format,
+                          resume=args.resume)
+    except (FileExistsError, ValueError) as e:
+        parser.exit(2, "error: %s\n" % e)
+    return 0 if stats['failed_total'] == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
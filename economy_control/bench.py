@@ -0,0 +1,101 @@
+"""ノートブックのベンチマークで使う計測と記録。
+
+各ソルバーの速さの基準がないので、問題の大きさを変えながら時間・評価回
+数・ピークメモリを測り、JSON に書き出しておく。三つのノートのベンチマー
+クのセクションはここを import して使う。
+
+bench_case(name, size, fn) は fn() を repeat 回呼んだうちの最短の時間と、
+fn() が返す評価回数(わからないときは None)を記録する。tracemalloc を有効
+にすると遅くなるので、ピークメモリは時間を測る前に別にもう一度
+tracemalloc の下で呼んで測る。そのときキャッシュ(表やコンパイルした式な
+ど)が前のセルで温まっていると、それを作るためのメモリが数えられないので、
+reset を渡せばそれを呼んでキャッシュを空にしてから測る。結果は
+bench_save で benchmarks/ノート名.json に保存する。
+
+bench_compare は benchmarks/ノート名.baseline.json と比べて、時間・評価回
+数・メモリのどれかが tol 倍を超えたものを退行として返す。基準のファイル
+がなければ今回の結果を基準として保存する。時間はマシンに依存するので、
+基準は同じマシンで取ったものと比べること。
+"""
+
+import json
+import os
+import platform
+import time
+import tracemalloc
+from time import gmtime, strftime
+
+import numpy as np
+
+
+bench_dir = 'benchmarks'
+
+
+def bench_case (name, size, fn, repeat=3, memory=True, reset=None,
+                verbose=True):
+    peak = None
+    if memory:
+        if reset is not None:
+            reset()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        nfev = fn()
+        times.append(time.perf_counter() - t0)
+    r = {'name': name, 'size': size, 'time': min(times),
+         'nfev': None if nfev is None else int(nfev), 'peak': peak}
+    if verbose:
+        print("%-22s %-36s %9.4fs  nfev=%-7s peak=%s"
+              % (name, json.dumps(size), r['time'], r['nfev'],
+                 "-" if peak is None else "%.1fMB" % (peak / 2 ** 20)))
+    return r
+
+
+def bench_save (results, name, path=None):
+    if path is None:
+        path = os.path.join(bench_dir, name + '.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    meta = {'notebook': name,
+            'time': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    return path
+
+
+def bench_key (r):
+    return r['name'], json.dumps(r['size'], sort_keys=True)
+
+
+def bench_compare (results, name, tol=1.5, path=None, verbose=True):
+    log = print if verbose else (lambda *args: None)
+    if path is None:
+        path = os.path.join(bench_dir, name + '.baseline.json')
+    if not os.path.exists(path):
+        bench_save(results, name, path)
+        log("saved baseline", path)
+        return []
+    with open(path) as f:
+        base = {bench_key(r): r for r in json.load(f)['results']}
+    bad = []
+    for r in results:
+        b = base.get(bench_key(r))
+        if b is None:
+            continue
+        for c in ('time', 'nfev', 'peak'):
+            # ごく短い時間の揺れは無視する
+            slack = 1e-3 if c == 'time' else 0
+            if r[c] is not None and b[c] is not None \
+               and r[c] > tol * b[c] + slack:
+                bad.append((r['name'], r['size'], c, b[c], r[c]))
+                log("REGRESSION %s %s %s: %g -> %g" % bad[-1])
+    return bad
@@ -0,0 +1,167 @@
+"""第2章の投資の加速度原理の経済での安定化政策の数値計算。
+
+economy_control_02.ipynb のモデル部分をライブラリとして使えるようにした
+もの。ノートブックもここから import して使う。パラメータ s, nu, rho,
+phi, dt は StabilizationParams にまとめて明示的に渡す。scipy はそれを使う関数の中で
+はじめて import する。
+"""
+
+import dataclasses
+
+import numpy as np
+
+
+@dataclasses.dataclass(frozen=True)
+class StabilizationParams:
+    s: float = 0.3
+    nu: float = 4
+    rho: float = 0.1
+    phi: float = 2
+    dt: float = 0.1
+    w: float = dataclasses.field(init=False)
+    theta: float = dataclasses.field(init=False)
+
+    def __post_init__ (self):
+        setf = lambda n, v: object.__setattr__(self, n, v)
+        setf('w', self.rho / (1 - self.nu * self.rho))
+        setf('theta', np.sqrt(self.w ** 2 + self.phi ** -1))
+
+
+def get_params (**kwargs):
+    return StabilizationParams(**kwargs)
+
+
+def get_A (s, nu, rho, phi):
+    # 式 (22)。パラメータは配列でもよく、その場合は (..., 2, 2) を返す。
+    s, nu, rho, phi = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (s, nu, rho, phi)])
+    w = rho / (1 - nu * rho)
+    A = np.empty(s.shape + (2, 2))
+    A[..., 0, 0] = - s * w
+    A[..., 0, 1] = w
+    A[..., 1, 0] = w / phi
+    A[..., 1, 1] = s * w
+    return A
+
+
+def get_grid (width=2.0, num=100):
+    return np.mgrid[-width:width:num * 1j, -width:width:num * 1j]
+
+
+def get_separatrices (A, width=2.0):
+    ev, evec = np.linalg.eig(A)
+    t = np.arange(-width, width, width/200)
+    lines = []
+    if ev.imag[0] == 0 and ev.imag[1] == 0:
+        for i in range(2):
+            if evec[1, i] == 0:
+                lines.append((np.zeros_like(t), t))
+            else:
+                lines.append((t, (evec[0, i].real / evec[1, i].real) * t))
+    return ev, lines
+
+
+field_cache = {}
+
+
+def get_field_key (p, width=2.0, num=100):
+    return (tuple(float(x) for x in p), float(width), int(num))
+
+
+def get_fields (params, width=2.0, num=100):
+    keys = [get_field_key(p, width, num) for p in params]
+    new = [k for k in dict.fromkeys(keys) if k not in field_cache]
+    if new:
+        Y, G = get_grid(width, num)
+        As = get_A(*np.array([k[0] for k in new]).T)
+        F = np.einsum('kij,jhw->kihw', As, np.stack([Y, G]))
+        for k, A_, f in zip(new, As, F):
+            ev, lines = get_separatrices(A_, width)
+            field_cache[k] = {'field': f, 'A': A_, 'ev': ev, 'lines': lines}
+    return np.stack([field_cache[k]['field'] for k in keys])
+
+
+def get_ys_filter (prm):
+    # 漸化式 y_{k+1} = a y_k + b g_k の伝達関数 b z^{-1} / (1 - a z^{-1})
+    a = 1 - prm.s * prm.w * prm.dt
+    b = prm.w * prm.dt
+    return [0.0, b], [1.0, - a]
+
+
+def calc_ys (y0, gs, prm):
+    # 式 (12) を線形フィルタとして O(T) で計算。y0 はフィルタの初期状態。
+    import scipy.signal
+    gs = np.asarray(gs, dtype=float)
+    fb, fa = get_ys_filter(prm)
+    zi = np.broadcast_to(np.asarray(y0, dtype=float)[..., None],
+                         gs.shape[:-1] + (1,))
+    ys, zf = scipy.signal.lfilter(fb, fa, gs, axis=-1, zi=zi)
+    return ys
+
+
+def calc_score (gs, y0, prm):
+    gs = np.asarray(gs, dtype=float)
+    ys = calc_ys(y0, gs, prm)
+    return np.sum(ys ** 2 + prm.phi * gs ** 2, axis=-1)
+
+
+def calc_adjoint (us, prm):
+    # K^T us を随伴方程式 lambda_k = u_k + a lambda_{k+1} として後ろから解く
+    import scipy.signal
+    fb, fa = get_ys_filter(prm)
+    us = np.asarray(us, dtype=float)[..., ::-1]
+    return scipy.signal.lfilter(fb, fa, us, axis=-1)[..., ::-1]
+
+
+def calc_score_jac (gs, y0, prm):
+    gs = np.asarray(gs, dtype=float)
+    ys = calc_ys(y0, gs, prm)
+    return 2 * calc_adjoint(ys, prm) + 2 * prm.phi * gs
+
+
+def calc_score_hessp (gs, v, y0, prm):
+    v = np.asarray(v, dtype=float)
+    return 2 * calc_adjoint(calc_ys(0, v, prm), prm) + 2 * prm.phi * v
+
+
+def solve_lqr (A, B, Q, R, T, y0):
+    A = np.atleast_2d(np.asarray(A, dtype=float))
+    B = np.atleast_2d(np.asarray(B, dtype=float))
+    Q = np.atleast_2d(np.asarray(Q, dtype=float))
+    R = np.atleast_2d(np.asarray(R, dtype=float))
+    n, m = B.shape
+    Ks = np.zeros((T, m, n))
+    P = Q
+    for k in range(T - 2, -1, -1):
+        BP = B.T @ P
+        Ks[k] = np.linalg.solve(R + BP @ B, BP @ A)
+        P = Q + A.T @ P @ (A - B @ Ks[k])
+    ys = np.zeros((T, n))
+    gs = np.zeros((T, m))
+    ys[0] = np.broadcast_to(np.asarray(y0, dtype=float), (n,))
+    for k in range(T - 1):
+        gs[k] = - Ks[k] @ ys[k]
+        ys[k + 1] = A @ ys[k] + B @ gs[k]
+    return gs, ys
+
+
+def solve_gs (y0, n, prm, method='LQR'):
+    import scipy.optimize
+    x0 = np.zeros(n)
+    if method == 'LQR':
+        gs, ys = solve_lqr(1 - prm.s * prm.w * prm.dt, prm.w * prm.dt,
+                           1, prm.phi, n, y0)
+        gs = gs[:, 0]
+        fun = np.sum(ys[:, 0] ** 2 + prm.phi * gs ** 2)
+        return scipy.optimize.OptimizeResult(x=gs, fun=fun,
+                                             success=True, nfev=0, nit=0)
+    if method == 'Nelder-Mead':
+        return scipy.optimize.minimize(calc_score, x0, args=(y0, prm),
+                                       method=method)
+    if method == 'Newton-CG':
+        return scipy.optimize.minimize(calc_score, x0, args=(y0, prm),
+                                       jac=calc_score_jac,
+                                       hessp=calc_score_hessp,
+                                       method=method)
+    return scipy.optimize.minimize(calc_score, x0, args=(y0, prm),
+                                   jac=calc_score_jac, method=method)
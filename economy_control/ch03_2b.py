@@ -0,0 +1,168 @@
+"""第3章2節b の EQ19D～EQ25D の数値計算。
+
+economy_control_03_2b.ipynb の「数値計算」と「式のコンパイル」の部分をラ
+イブラリとして使えるようにしたもの。ノートブックもここから import して
+使う。式の導出と検算はノートブックのほうで行う。sympy は compile_exprs で式をコンパイルするときにだけ import する。
+load_compiled でキャッシュから読むだけなら sympy は要らない。
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+
+def riccati_backward (A, B, P_T, Q_T, beta, zs):
+    n, m = B.shape
+    T = len(zs)
+    zs = np.asarray(zs, dtype=float).reshape(T, n)
+    P_T = np.asarray(P_T, dtype=float).reshape(n)
+    Ls = np.zeros((T + 1, m, n))
+    ls = np.zeros((T + 1, m))
+    Q_t = np.array(Q_T, dtype=float)
+    P_t = P_T
+    g_t = 0.0
+    for t in range(T, 0, -1):
+        QB = Q_t @ B
+        M = B.T @ QB
+        # EQ19D の (B.T*Q(t)*B)**-1 * B.T*Q(t) と (B.T*Q(t)*B)**-1 * B.T*P(t)
+        Ls[t] = np.linalg.solve(M, QB.T)
+        ls[t] = np.linalg.solve(M, B.T @ P_t)
+        # EQ22D
+        h_t = (B.T @ P_t) @ ls[t]
+        if t == 1:
+            break
+        z_t = zs[t - 1]
+        # EQ21D より Q(t)*S(t) = Q(t) - Q(t)*B*L(t)
+        QS = Q_t - QB @ Ls[t]
+        SP = P_t - Ls[t].T @ (B.T @ P_t)
+        # EQ25D
+        g_t = beta * (SP @ z_t + 0.5 * z_t @ QS @ z_t - 0.5 * h_t + g_t)
+        # EQ23D
+        P_t = P_T + beta * A.T @ (SP + QS @ z_t)
+        # EQ24D
+        Q_t = Q_T + beta * A.T @ QS @ A
+        Q_t = 0.5 * (Q_t + Q_t.T)
+    return {'A': A, 'B': B, 'zs': zs, 'L': Ls, 'l': ls,
+            'Q1': Q_t, 'P1': P_t, 'h1': h_t, 'g1': g_t}
+
+
+def riccati_forward (rc, y0s):
+    A = rc['A']
+    B = rc['B']
+    zs = rc['zs']
+    T = len(zs)
+    Y = np.atleast_2d(np.asarray(y0s, dtype=float))
+    ys = np.zeros((T + 1,) + Y.shape)
+    xs = np.zeros((T, Y.shape[0], B.shape[1]))
+    ys[0] = Y
+    for t in range(1, T + 1):
+        u = Y @ A.T + zs[t - 1]
+        # EQ19D
+        X = - u @ rc['L'][t].T - rc['l'][t]
+        # EQ11
+        Y = u + X @ B.T
+        xs[t - 1] = X
+        ys[t] = Y
+    return xs, ys
+
+
+def riccati_value (rc, y0s):
+    # EQ20D の v(1, y(0))
+    A = rc['A']
+    B = rc['B']
+    u = np.atleast_2d(np.asarray(y0s, dtype=float)) @ A.T + rc['zs'][0]
+    QB = rc['Q1'] @ B
+    QS = rc['Q1'] - QB @ rc['L'][1]
+    SP = rc['P1'] - rc['L'][1].T @ (B.T @ rc['P1'])
+    return u @ SP + 0.5 * np.sum((u @ QS) * u, axis=1) \
+        - 0.5 * rc['h1'] + rc['g1']
+
+
+def calc_J (ys, xs, P_T, Q_T, beta):
+    J = 0
+    for t in range(1, len(ys)):
+        J = J + (beta ** (t - 1)) * (ys[t] @ P_T
+                                     + 0.5 * np.sum((ys[t] @ Q_T) * ys[t],
+                                                    axis=-1))
+    return J
+
+
+def calc_J_x (xs, y0, A, B, zs, P_T, Q_T, beta):
+    ys = [y0]
+    for t in range(1, len(zs) + 1):
+        ys.append(A @ ys[-1] + B @ xs[t - 1] + zs[t - 1])
+    return calc_J(np.array(ys), xs, P_T, Q_T, beta)
+
+
+compile_cache_dir = os.path.join('.economy_control_cache', 'compiled')
+# lambdify(modules='numpy') が生成するコードが前提にしている名前空間
+compile_header = \
+    "import numpy; from numpy import *; from numpy.linalg import *\n\n"
+
+
+def expr_hash (args, exprs):
+    import sympy
+    s = repr((sympy.__version__, [sympy.srepr(a) for a in args],
+              [sympy.srepr(e) for e in exprs]))
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()[:16]
+
+
+def load_compiled_file (path):
+    ns = {}
+    with open(path, encoding='utf-8') as f:
+        exec(compile(f.read(), path, 'exec'), ns)
+    return ns['_lambdifygenerated']
+
+
+def load_compiled (name, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = compile_cache_dir
+    with open(os.path.join(cache_dir, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    return load_compiled_file(os.path.join(cache_dir, manifest[name]))
+
+
+def write_atomic (path, s):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(s)
+    os.replace(tmp, path)
+
+
+def compile_exprs (name, args, exprs, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = compile_cache_dir
+    fname = "%s_%s.py" % (name, expr_hash(args, exprs))
+    path = os.path.join(cache_dir, fname)
+    if not os.path.exists(path):
+        import sympy
+        f = sympy.lambdify(args, list(exprs), modules='numpy', cse=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomic(path, compile_header + inspect.getsource(f))
+    mpath = os.path.join(cache_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(mpath):
+        with open(mpath, encoding='utf-8') as f:
+            manifest = json.load(f)
+    if manifest.get(name) != fname:
+        manifest[name] = fname
+        write_atomic(mpath, json.dumps(manifest, indent=1, sort_keys=True))
+    return load_compiled_file(path)
+
+
+def riccati_backward_compiled (A, B, P_T, Q_T, beta, zs, step=None):
+    if step is None:
+        step = load_compiled('riccati_step')
+    n, m = B.shape
+    T = len(zs)
+    zs = np.asarray(zs, dtype=float).reshape(T, n, 1)
+    P_T = np.asarray(P_T, dtype=float).reshape(n, 1)
+    Q_t, P_t, g_t = Q_T, P_T, np.zeros((1, 1))
+    for t in range(T - 1, 0, -1):
+        # z(t + 1) は zs[t]
+        Q_t, P_t, g_t = step(A, B, P_T, Q_T, beta, Q_t, P_t, g_t, zs[t])
+        Q_t = 0.5 * (Q_t + Q_t.T)
+    return Q_t, P_t, g_t
@@ -0,0 +1,747 @@
+"""第4章のライフサイクル・モデルの数値計算。
+
+economy_control_04.ipynb のモデル部分をライブラリとして使えるようにした
+もの。ノートブックもここから import して使う。import しても計算や描画は
+何もしない。scipy は最適化を行う関数の中で
+はじめて import する。
+"""
+
+import dataclasses
+import functools
+import time
+import warnings
+
+import numpy as np
+
+# p.74, p.76 より。
+
+R = 65
+sigma_sq = 0.1625567
+
+case_I = {
+    'T': 85,
+    'p': 0.00652
+}
+
+case_II = {
+    'T': 90,
+    'p': 0.00838
+}
+
+standard = {
+    'gamma': 3,
+    'r': 0.04,
+    'theta': 0.01,
+    'tau': 0.3,
+    'k': 0.5,
+    'A22': 200,
+    'z': 100,
+    'F65': 0
+}
+
+alternative = {
+    'gamma': 4,
+    'r': 0.05,
+    'theta': 0.02,
+    'tau': 0.2,
+    'k': 50,
+    'A22': 400,
+    'z': 70,
+    'F65': 1000
+}
+
+# p.75 より、年齢別平均所得。
+y = [0] * 22 + [
+    154.7, # 22
+    162.0, # 23
+    168.4, # 24
+    175.0, # 25
+    182.4, # 26
+    191.9, # 27
+    201.0, # 28
+    209.0, # 29
+    217.3, # 30
+    226.2, # 31
+    235.4, # 32
+
+    243.1, # 33
+    251.0, # 34
+    258.2, # 35
+    267.1, # 36
+    275.7, # 37
+    284.0, # 38
+    291.2, # 39
+    298.9, # 40
+    304.4, # 41
+    310.5, # 42
+    316.0, # 43
+
+    319.7, # 44
+    322.4, # 45
+    325.4, # 46
+    328.1, # 47
+    326.6, # 48
+    325.1, # 49
+    323.8, # 50
+    322.2, # 51
+    321.7, # 52
+    315.8, # 53
+    308.4, # 54
+    
+    301.1, # 55
+    292.1, # 56
+    281.0, # 57
+    267.0, # 58
+    254.0, # 59
+    243.5, # 60
+    234.8, # 61
+    228.5, # 62
+    221.0, # 63
+    214.9, # 64
+    210.0, # 65
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class LifeCycleParams:
+    gamma: float
+    r: float
+    theta: float
+    tau: float
+    k: float
+    A22: float
+    z: float
+    F65: float
+    T: int
+    p: float
+    R: int = R
+    sigma_sq: float = sigma_sq
+    rho: float = dataclasses.field(init=False)
+    alpha: float = dataclasses.field(init=False)
+    y: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    inc: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    D: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    den: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    ca: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    cb: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    cc: np.ndarray = dataclasses.field(init=False, repr=False, compare=False)
+    A_base: np.ndarray = dataclasses.field(init=False, repr=False,
+                                           compare=False)
+    dAts_dCts: np.ndarray = dataclasses.field(init=False, repr=False,
+                                              compare=False)
+
+    def __post_init__ (self):
+        setf = lambda n, v: object.__setattr__(self, n, v)
+        setf('rho', 1 + self.r)
+        setf('alpha', (1 + self.theta) ** -1)
+        ys = np.array(y, dtype=float)
+        ys[self.R] += self.F65
+        ys.flags.writeable = False
+        setf('y', ys)
+        inc = get_income(self)
+        inc.flags.writeable = False
+        setf('inc', inc)
+        for n, v in zip(('den', 'D', 'ca', 'cb', 'cc', 'A_base', 'dAts_dCts'),
+                        get_working_coefs(self) + get_Ats_coefs(self)):
+            v.flags.writeable = False
+            setf(n, v)
+
+
+def get_param_values (*args, case=case_I, **kwargs):
+    # get_params に渡す前の、LifeCycleParams の引数の dict
+    d = dict(standard)
+    d.update(case)
+    for n in args:
+        d[n] = alternative[n]
+    d.update(kwargs)
+    return d
+
+
+def get_params (*args, case=case_I, **kwargs):
+    return LifeCycleParams(**get_param_values(*args, case=case, **kwargs))
+
+
+def get_income_suffix_sums (prm):
+    R, rho, y = prm.R, prm.rho, prm.y
+    D = np.zeros(R + 2)
+    for t in range(R, 21, -1):
+        D[t] = y[t] + (rho ** -1) * D[t + 1]
+    return D[22:R]
+
+
+def get_working_coefs (prm):
+    R, rho, alpha, gamma = prm.R, prm.rho, prm.alpha, prm.gamma
+    tau, y, sigma_sq = prm.tau, prm.y, prm.sigma_sq
+    ts = np.arange(22, R)
+    # 式(34)
+    g = ((rho ** (1 - gamma)) * alpha) ** (1/gamma)
+    # 式(33)
+    G_tp1 = (1 - g ** (R - (ts + 1) + 1)) / (1 - g)
+    # 式(40) の分母
+    den = 1 + ((rho ** (1 - gamma)) * alpha * (G_tp1 ** gamma)
+               * (1 + (1/2) * gamma * (gamma + 1) * sigma_sq)) ** (1/gamma)
+    D = get_income_suffix_sums(prm)
+    ca = np.zeros(R - 22 + 1)
+    cb = np.zeros(R - 22 + 1)
+    cc = np.zeros(R - 22 + 1)
+    a_t, b_t, c_t = 1.0, 0.0, 0.0
+    for t in ts:
+        ca[t - 22], cb[t - 22], cc[t - 22] = a_t, b_t, c_t
+        q = 1 - 1 / den[t - 22]
+        a_t = rho * q * a_t
+        b_t = rho * (q * b_t + (1 - tau) * (y[t] - D[t - 22] / den[t - 22]))
+        c_t = rho * (q * c_t + (rho ** (t - R - 1)) / den[t - 22])
+    ca[R - 22], cb[R - 22], cc[R - 22] = a_t, b_t, c_t
+    return den, D, ca, cb, cc
+
+
+def get_income (prm):
+    R, T, tau, y, z = prm.R, prm.T, prm.tau, prm.y, prm.z
+    ts = np.arange(22, T + 1)
+    return np.where(ts <= R, (1 - tau) * y[np.minimum(ts, R)], z)
+
+
+def get_Ats_coefs (prm):
+    T, rho, A22 = prm.T, prm.rho, prm.A22
+    i = np.arange(T - 22 + 2)
+    d = i[:, None] - i[None, :-1]
+    M = np.where(d > 0, rho ** np.maximum(d, 0), 0.0)
+    return (rho ** i) * A22 + M @ prm.inc, - M
+
+
+def get_Cts_Ats (A_Tp1, prm):
+    gamma, rho, alpha, k, p = prm.gamma, prm.rho, prm.alpha, prm.k, prm.p
+    T, R, z, tau, y, A22 = prm.T, prm.R, prm.z, prm.tau, prm.y, prm.A22
+    sigma_sq = prm.sigma_sq
+    try:
+        A_Tp1 = A_Tp1[0]
+    except:
+        pass
+    Ats = [A_Tp1]
+    Cts = []
+    A_tp1 = A_Tp1
+    # 式(25)
+    C_T = ((rho * alpha * k * (((1 + p) ** (T - R)) -1)) ** (-1/gamma)) * A_Tp1
+    # 式(2')
+    A_T = (rho ** -1) * A_Tp1 + C_T - z
+    Ats.append(A_T)
+    Cts.append(C_T)
+    C_tp1 = C_T
+    A_tp1 = A_T
+    t = T - 1
+    while t >= R + 1:
+        # 式(25) と 式(26) の間の式
+        C_t = ((
+            ((1 + p) ** (R - t - 1)) * (C_tp1 ** - gamma)
+            + (((1 + p) ** (t - R)) - 1) * k * (A_tp1 ** - gamma)
+        ) * rho * alpha) ** (- 1/gamma)
+        # 式(2')
+        A_t = (rho ** -1) * A_tp1 + C_t - z
+        Ats.append(A_t)
+        Cts.append(C_t)
+        C_tp1 = C_t
+        A_tp1 = A_t
+        t = t - 1
+    assert t == R
+    A_Rp1 = A_tp1
+    # 式(27') の下の式
+    C_R = (rho * alpha * ((1 + p) ** -1) * (C_tp1 ** - gamma)) ** (-1/gamma)
+    # 式(1')
+    A_R = (rho ** -1) * A_tp1 + C_R - (1 - tau) * y[R]
+    Ats.append(A_R)
+    Cts.append(C_R)
+    rAts = list(reversed(Ats))
+    rCts = list(reversed(Cts))
+    Ats = []
+    Cts = []
+    t = 22
+    A_t = A22
+    while t <= R - 1:
+        # 式(36)
+        L_t = A_t \
+            + (1 - tau) * sum([y[t + i] * (rho ** - i)
+                               for i in range(R - t + 1)]) \
+            - A_Rp1 * (rho ** (t - R - 1))
+        # 式(34)
+        g = ((rho ** (1 - gamma)) * alpha) ** (1/gamma)
+        # 式(33)
+        G_tp1 = (1 - g ** (R - (t + 1) + 1)) / (1 - g)
+        # 式(40)
+        C_t = L_t / (1 + ((rho ** (1 - gamma)) * alpha * (G_tp1 ** gamma)
+                          * (1 + (1/2) * gamma * (gamma + 1) * sigma_sq))
+                     ** (1/gamma))
+        Ats.append(A_t)
+        Cts.append(C_t)
+        # 式(1)
+        A_t = (A_t + (1 - tau) * y[t] - C_t) * rho
+        t = t + 1
+    d65 = A_R - A_t
+    return Cts + rCts, Ats + rAts, d65
+
+
+def get_Cts_Ats_vec (A_Tp1s, prm, deriv=False):
+    gamma, rho, alpha, k, p = prm.gamma, prm.rho, prm.alpha, prm.k, prm.p
+    T, R, z, tau, y, A22 = prm.T, prm.R, prm.z, prm.tau, prm.y, prm.A22
+    A_Tp1 = np.asarray(A_Tp1s, dtype=float)
+    shape = A_Tp1.shape
+    A_Tp1 = A_Tp1.reshape(-1)
+    Ats = np.zeros((len(A_Tp1), T - 22 + 2))
+    Cts = np.zeros((len(A_Tp1), T - 22 + 1))
+    Ats[:, T + 1 - 22] = A_Tp1
+    # 式(25)
+    c_T = (rho * alpha * k * (((1 + p) ** (T - R)) -1)) ** (-1/gamma)
+    C_tp1 = c_T * A_Tp1
+    # 式(2')
+    A_tp1 = (rho ** -1) * A_Tp1 + C_tp1 - z
+    Ats[:, T - 22] = A_tp1
+    Cts[:, T - 22] = C_tp1
+    # dC, dA は A_{T+1} による微分
+    dC = np.full(len(A_Tp1), c_T)
+    dA = (rho ** -1) + dC
+    for t in range(T - 1, R, -1):
+        # 式(25) と 式(26) の間の式
+        a1 = (1 + p) ** (R - t - 1)
+        a2 = (((1 + p) ** (t - R)) - 1) * k
+        X = (a1 * (C_tp1 ** - gamma) + a2 * (A_tp1 ** - gamma)) * rho * alpha
+        C_t = X ** (- 1/gamma)
+        if deriv:
+            dX = - gamma * rho * alpha * (a1 * (C_tp1 ** (- gamma - 1)) * dC
+                                          + a2 * (A_tp1 ** (- gamma - 1)) * dA)
+            dC = (- 1/gamma) * (C_t / X) * dX
+            dA = (rho ** -1) * dA + dC
+        C_tp1 = C_t
+        # 式(2')
+        A_tp1 = (rho ** -1) * A_tp1 + C_tp1 - z
+        Ats[:, t - 22] = A_tp1
+        Cts[:, t - 22] = C_tp1
+    A_Rp1 = A_tp1
+    # 式(27') の下の式
+    C_R = (rho * alpha * ((1 + p) ** -1) * (C_tp1 ** - gamma)) ** (-1/gamma)
+    # 式(1')
+    A_R = (rho ** -1) * A_Rp1 + C_R - (1 - tau) * y[R]
+    Cts[:, R - 22] = C_R
+    ts = np.arange(22, R)
+    den, D, ca, cb, cc = prm.den, prm.D, prm.ca, prm.cb, prm.cc
+    A_w = ca * A22 + cb + cc * A_Rp1[:, None]
+    # 式(36)
+    L_w = A_w[:, :-1] + (1 - tau) * D - A_Rp1[:, None] * (rho ** (ts - R - 1))
+    # 式(40)
+    Cts[:, :R - 22] = L_w / den
+    Ats[:, :R - 22] = A_w[:, :-1]
+    Ats[:, R - 22] = A_R
+    d65 = A_R - A_w[:, -1]
+    if deriv:
+        dC_R = (C_R / C_tp1) * dC
+        dd65 = (rho ** -1) * dA + dC_R - cc[-1] * dA
+        return (Cts.reshape(shape + Cts.shape[1:]),
+                Ats.reshape(shape + Ats.shape[1:]), d65.reshape(shape),
+                dd65.reshape(shape))
+    return (Cts.reshape(shape + Cts.shape[1:]),
+            Ats.reshape(shape + Ats.shape[1:]), d65.reshape(shape))
+
+
+def score_A_Tp1 (A_Tp1, prm):
+    Cts, Ats, d65 = get_Cts_Ats_vec(A_Tp1, prm)
+    return d65
+
+
+def find_A_Tp1 (prm, grid=None):
+    if grid is None:
+        grid = np.geomspace(1e-2, 1e5, 200)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d = score_A_Tp1(grid, prm)
+    ok = np.isfinite(d)
+    i = np.nonzero(ok[:-1] & ok[1:] & (np.sign(d[:-1]) != np.sign(d[1:])))[0]
+    if len(i) == 0:
+        return None
+    i = i[0]
+    import scipy.optimize
+    return scipy.optimize.brentq(score_A_Tp1, grid[i], grid[i + 1],
+                                 args=(prm,))
+
+
+def score_A_Tp1_deriv (A_Tp1, prm):
+    Cts, Ats, d65, dd65 = get_Cts_Ats_vec(A_Tp1, prm, deriv=True)
+    return d65, dd65
+
+
+def solve_A_Tp1 (prm, guess=None, xtol=1e-10, ftol=1e-8, maxiter=50):
+    x = prm.A22 if guess is None else float(np.ravel(guess)[0])
+    lo = hi = None
+    history = []
+    nfev = 0
+    message = "maximum number of iterations reached"
+    success = False
+    for it in range(maxiter):
+        with np.errstate(invalid='ignore', divide='ignore',
+                         over='ignore'):
+            f, df = score_A_Tp1_deriv(x, prm)
+        f, df = float(f), float(df)
+        nfev += 1
+        history.append((x, f, df))
+        if not np.isfinite(f):
+            if lo is not None and hi is not None:
+                x = 0.5 * (lo[0] + hi[0])
+                continue
+            A = find_A_Tp1(prm)
+            nfev += 1
+            if A is None:
+                message = "d65 is not finite at A_Tp1 = %g" \
+                    " and no sign change was found on the grid" % x
+                break
+            x = A
+            continue
+        if abs(f) <= ftol:
+            success = True
+            message = "|d65| <= ftol"
+            break
+        if f < 0:
+            lo = (x, f)
+        else:
+            hi = (x, f)
+        if lo is not None and hi is not None \
+           and abs(hi[0] - lo[0]) <= xtol * (1 + abs(x)):
+            success = True
+            message = "bracket width <= xtol"
+            break
+        xn = x - f / df if np.isfinite(df) and df != 0 else np.nan
+        if lo is not None and hi is not None:
+            a, b = sorted((lo[0], hi[0]))
+            if not (a < xn < b):
+                xn = 0.5 * (a + b)
+        elif not np.isfinite(xn) or xn <= 0:
+            xn = 0.5 * x if f > 0 else 2 * x
+        if abs(xn - x) <= xtol * (1 + abs(x)):
+            x = xn
+            success = True
+            message = "step size <= xtol"
+            break
+        x = xn
+    import scipy.optimize
+    return scipy.optimize.OptimizeResult(
+        x=np.array([x]), fun=f, success=success, message=message,
+        nfev=nfev, nit=len(history), bracket=(lo, hi),
+        history=np.array(history))
+
+
+def ssd (a, b): # Sum of Squared Difference
+    a = np.array(a)
+    b = np.array(b)
+    return np.sum((a - b) ** 2)
+
+
+def U (C, prm):
+    gamma = prm.gamma
+    return ((1 - gamma) ** -1) * (C ** (1 - gamma))
+
+
+def W (A, prm):
+    gamma, k = prm.gamma, prm.k
+    return k * ((1 - gamma) ** -1) * (A ** (1 - gamma))
+
+
+@functools.lru_cache(maxsize=128)
+def get_survival_table (p, R, T):
+    ts = np.arange(T + 2)
+    # 式(23)
+    Pt = np.where(ts < R, 0.0, 1 - ((1 + p) ** (R - np.maximum(ts, R))))
+    logS = np.concatenate([[0.0], np.cumsum(np.log1p(- Pt))])
+    bw = Pt / (1 - Pt)
+    for a in (Pt, logS, bw):
+        a.flags.writeable = False
+    return Pt, logS, bw
+
+
+@functools.lru_cache(maxsize=128)
+def get_discount_table (alpha, T):
+    d = alpha ** np.arange(T + 2)
+    d.flags.writeable = False
+    return d
+
+
+def P (t, prm):
+    return get_survival_table(prm.p, prm.R, prm.T)[0][t]
+
+
+def Phi (t1, t2, prm):
+    assert np.all(np.asarray(t2) >= t1)
+    logS = get_survival_table(prm.p, prm.R, prm.T)[1]
+    return np.exp(logS[np.asarray(t2) + 1] - logS[t1])
+
+
+def score_Et_UT (t, Cts, Ats, prm):
+    T, alpha = prm.T, prm.alpha
+    Pt, logS, bw = get_survival_table(prm.p, prm.R, T)
+    ti = np.arange(t, T + 1)
+    w = Phi(t, ti, prm) * get_discount_table(alpha, T)[:T - t + 1]
+    C = np.asarray(Cts, dtype=float)[..., t - 22:]
+    A = np.asarray(Ats, dtype=float)[..., t + 1 - 22:]
+    return (U(C, prm) + bw[ti] * W(A, prm) * alpha) @ w
+
+
+def get_Ats (Cts, prm):
+    return prm.A_base + np.asarray(Cts, dtype=float) @ prm.dAts_dCts.T
+
+
+def Ats_cons (Cts, prm):
+    Ats = get_Ats(Cts, prm)
+    return np.sum(np.minimum(Ats, 0), axis=-1)
+
+
+def get_UW_grad (Cts, a, b, prm):
+    Cts = np.asarray(Cts, dtype=float)
+    Ats = get_Ats(Cts, prm)
+    dU = Cts ** - prm.gamma
+    dW = prm.k * (Ats[1:] ** - prm.gamma)
+    return a * dU + (b * dW) @ prm.dAts_dCts[1:]
+
+
+def Ats_cons_jac (Cts, prm):
+    Ats = get_Ats(Cts, prm)
+    return np.sum(prm.dAts_dCts[Ats < 0], axis=0)
+
+
+def score_simple_sum (Cts, prm):
+    T, alpha = prm.T, prm.alpha
+    Ats = get_Ats(Cts, prm)
+    s = 0
+    for t in range(22, T+1):
+        Pt = P(t, prm)
+        # 式(2) の後の式
+        s += (1 - Pt) * U(Cts[t - 22], prm) \
+            + Pt * W(Ats[t + 1 - 22], prm) * alpha
+    return -s
+
+
+def score_simple_sum_jac (Cts, prm):
+    Pt = P(np.arange(22, prm.T + 1), prm)
+    return - get_UW_grad(Cts, 1 - Pt, Pt * prm.alpha, prm)
+
+
+def score_E22_UT (Cts, prm):
+    return -score_Et_UT(22, Cts, get_Ats(Cts, prm), prm)
+
+
+def score_E22_UT_jac (Cts, prm):
+    ts = np.arange(22, prm.T + 1)
+    Pt, logS, bw = get_survival_table(prm.p, prm.R, prm.T)
+    w = Phi(22, ts, prm) * get_discount_table(prm.alpha, prm.T)[:len(ts)]
+    return - get_UW_grad(Cts, w, w * bw[ts] * prm.alpha, prm)
+
+
+def score_V (Cts, prm):
+    T, alpha = prm.T, prm.alpha
+    Ats = get_Ats(Cts, prm)
+    V = 0
+    t = T
+    while t >= 22:
+        Pt = P(t, prm)
+        V = (1 - Pt) * U(Cts[t - 22], prm) \
+            + Pt * W(Ats[t + 1 - 22], prm) * alpha \
+            + (1 - Pt) * alpha * V
+        t = t - 1
+    return -V
+
+
+def score_V_jac (Cts, prm):
+    Pt = P(np.arange(22, prm.T + 1), prm)
+    # V の漸化式を展開したときの V の係数 prod_{s < t} (1 - P(s)) * alpha
+    pi = np.concatenate([[1], np.cumprod((1 - Pt) * prm.alpha)[:-1]])
+    return - get_UW_grad(Cts, pi * (1 - Pt), pi * Pt * prm.alpha, prm)
+
+
+def score_Et_UT_2 (Cts2, Cts1, prm):
+    Cts = list(Cts1) + list(Cts2)
+    Ats = get_Ats(Cts, prm)
+    return - score_Et_UT(22 + len(Cts1), Cts, Ats, prm)
+
+
+def Ats_cons_2 (Cts2, Cts1, prm):
+    Ats = get_Ats(list(Cts1) + list(Cts2), prm)
+    return np.sum(np.minimum(Ats, 0), axis=-1)
+
+
+def minimize_Cts (score, prm, jac=None, x0=10, options=None):
+    # 本文の Cts1, Cts2, Cts4 と同じ SLSQP の呼び方
+    import scipy.optimize
+    n = prm.T - 22 + 1
+    cons = {'type': 'ineq', 'fun': Ats_cons, 'args': (prm,)}
+    if jac is not None:
+        cons['jac'] = Ats_cons_jac
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return scipy.optimize.minimize(score, [x0] * n, args=(prm,),
+                                       jac=jac,
+                                       bounds=([(0, np.inf)] * n),
+                                       constraints=(cons,),
+                                       method="SLSQP", options=options)
+
+
+def plan_sequential (prm, x0=10):
+    # 本文の Cts5。年齢ごとに score_Et_UT_2 を最初から解き直すので遅い。
+    import scipy.optimize
+    Cts = []
+    nfev = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for t in range(22, prm.T + 1):
+            n = prm.T - 22 + 1 - len(Cts)
+            res = scipy.optimize.minimize(score_Et_UT_2, [x0] * n,
+                                          args=(Cts, prm),
+                                          bounds=([(0, np.inf)] * n),
+                                          constraints=(
+                                              {'type': 'ineq',
+                                               'fun': Ats_cons_2,
+                                               'args': (Cts, prm)},
+                                          ), method="SLSQP")
+            Cts.append(res.x[0])
+            nfev += res.nfev
+    return np.array(Cts), nfev
+
+
+def plan_time_consistent (prm, x0=10, ftol=1e-10, maxiter=1000, passes=3,
+                          c_min=1e-3, verbose=False):
+    T, alpha = prm.T, prm.alpha
+    D = prm.dAts_dCts
+    import scipy.optimize
+    Pt, logS, bw = get_survival_table(prm.p, prm.R, T)
+    disc = get_discount_table(alpha, T)
+    n = T - 22 + 1
+    Cts = np.zeros(n)
+    # 決まった C の分を足し込んだ Ats
+    base = np.array(prm.A_base)
+    x = np.full(n, float(x0))
+    stages = []
+    t_start = time.perf_counter()
+    for t in range(22, T + 1):
+        L = t - 22
+        ti = np.arange(t, T + 1)
+        w = Phi(t, ti, prm) * disc[:len(ti)]
+        # 引退前は bw が 0 なので W(A) を足さない。掛ける前に A < 0 で
+        # W(A) が nan になると 0 を掛けても nan になってしまう。
+        m = bw[ti] > 0
+        wb = (w * bw[ti] * alpha)[m]
+        D_t = D[L + 1:, L:]
+        D_m = D_t[m]
+        base_t = base[L + 1:]
+        base_m = base_t[m]
+
+        def score (x):
+            return - (U(x, prm) @ w + W(base_m + D_m @ x, prm) @ wb)
+
+        def score_jac (x):
+            A = base_m + D_m @ x
+            return - (w * (x ** - prm.gamma)
+                      + (wb * prm.k * (A ** - prm.gamma)) @ D_m)
+
+        t0 = time.perf_counter()
+        nfev = njev = 0
+        for k in range(passes):
+            # C は 10 から 200 程度まで大きさがばらばらなので、今の x で
+            # 割った u = C / sx を変数にする。SLSQP の ftol は目的関数の
+            # 値の絶対誤差なので、目的関数も今の点での大きさで割っておく。
+            sx = np.maximum(x, c_min)
+            scale = 1 / abs(score(x))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                res = scipy.optimize.minimize(
+                    lambda u: score(u * sx) * scale, np.ones(len(x)),
+                    jac=lambda u: score_jac(u * sx) * sx * scale,
+                    bounds=[(c_min / s, None) for s in sx],
+                    constraints=({'type': 'ineq',
+                                  'fun': lambda u: base_t + D_t @ (u * sx),
+                                  'jac': lambda u: D_t * sx},),
+                    method="SLSQP",
+                    options={'ftol': ftol, 'maxiter': maxiter})
+            nfev += res.nfev
+            njev += res.njev
+            x = res.x * sx
+            # 解が初期値から大きく動いたときはスケールを取り直してもう一度
+            if res.success and np.max(np.abs(res.x - 1)) < 0.1:
+                break
+        Cts[L] = x[0]
+        base = base + D[:, L] * Cts[L]
+        x = x[1:]
+        stages.append({'t': t, 'success': bool(res.success),
+                       'message': res.message, 'nfev': nfev, 'njev': njev,
+                       'passes': k + 1, 'time': time.perf_counter() - t0})
+        if verbose:
+            print("%d %s nfev=%d passes=%d %.3fs" % (
+                t, res.success, nfev, k + 1, stages[-1]['time']))
+    failed = [s['t'] for s in stages if not s['success']]
+    if failed:
+        warnings.warn("plan_time_consistent: %d of %d stages failed (t = %s)"
+                      % (len(failed), len(stages),
+                         ", ".join(map(str, failed))), RuntimeWarning)
+    if verbose:
+        print("total %.2fs" % (time.perf_counter() - t_start))
+    return Cts, stages
+
+
+def dp_policy_at (A_endo, C_endo, A):
+    A = np.asarray(A, dtype=float)
+    # 内生格子より下では A_{t+1} が a_grid[0] に張り付くので C は A と平行に動く
+    return np.where(A < A_endo[0], C_endo[0] + A - A_endo[0],
+                    np.interp(A, A_endo, C_endo))
+
+
+def dp_value_at (A_endo, C_endo, V_endo, P_t, A, prm):
+    A = np.asarray(A, dtype=float)
+    C = dp_policy_at(A_endo, C_endo, A)
+    return np.where(A < A_endo[0],
+                    V_endo[0] + (1 - P_t) * (U(C, prm) - U(C_endo[0], prm)),
+                    np.interp(A, A_endo, V_endo))
+
+
+def solve_dp (prm, a_grid=None):
+    T, R, gamma, rho, alpha, k = \
+        prm.T, prm.R, prm.gamma, prm.rho, prm.alpha, prm.k
+    if a_grid is None:
+        a_grid = np.geomspace(1e-2, 1e5, 2000)
+    Pt = get_survival_table(prm.p, R, T)[0]
+    ts = np.arange(22, T + 1)
+    Y = prm.inc
+    As = np.zeros((len(ts), len(a_grid)))
+    Cs = np.zeros((len(ts), len(a_grid)))
+    Vs = np.zeros((len(ts), len(a_grid)))
+    dV = V1 = 0.0
+    for t in range(T, 21, -1):
+        i = t - 22
+        if t < T:
+            C1 = dp_policy_at(As[i + 1], Cs[i + 1], a_grid)
+            dV = (1 - Pt[t + 1]) * (C1 ** - gamma)
+            V1 = dp_value_at(As[i + 1], Cs[i + 1], Vs[i + 1], Pt[t + 1],
+                             a_grid, prm)
+        # 一階条件の右辺
+        Q = Pt[t] * alpha * k * (a_grid ** - gamma) + (1 - Pt[t]) * alpha * dV
+        Cs[i] = (rho * Q / (1 - Pt[t])) ** (- 1/gamma)
+        As[i] = a_grid / rho + Cs[i] - Y[i]
+        Vs[i] = (1 - Pt[t]) * U(Cs[i], prm) \
+            + Pt[t] * alpha * W(a_grid, prm) + (1 - Pt[t]) * alpha * V1
+    return {'ts': ts, 'P': Pt[ts], 'a_grid': a_grid,
+            'A': As, 'C': Cs, 'V': Vs}
+
+
+def dp_policy (dp, t, A):
+    i = t - 22
+    return dp_policy_at(dp['A'][i], dp['C'][i], A)
+
+
+def dp_value (dp, t, A, prm):
+    i = t - 22
+    return dp_value_at(dp['A'][i], dp['C'][i], dp['V'][i], dp['P'][i], A, prm)
+
+
+def dp_path (dp, A22s, prm):
+    A = np.asarray(A22s, dtype=float)
+    Cts = np.zeros(A.shape + (len(dp['ts']),))
+    Ats = np.zeros(A.shape + (len(dp['ts']) + 1,))
+    Ats[..., 0] = A
+    for i, t in enumerate(dp['ts']):
+        Cts[..., i] = dp_policy(dp, t, A)
+        # 式(1)(2)
+        A = (A + prm.inc[i] - Cts[..., i]) * prm.rho
+        Ats[..., i + 1] = A
+    return Cts, Ats
+
+
+def get_Yts (prm):
+    # 図4-1a などの所得 Y_t。R までは税引き前の y、それ以降は年金 z。
+    return np.array(list(prm.y[22:prm.R + 1]) + [prm.z] * (prm.T - prm.R))
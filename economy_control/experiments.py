@@ -0,0 +1,133 @@
+"""ノートブックで行った実験を関数として呼べるようにしたもの。
+
+import しただけでは何も実行しない。コマンドラインからは
+
+    python -m economy_control.experiments ch02 --figures out
+    python -m economy_control.experiments ch04 --case II --alternative k
+
+のように使う。遅い Cts5 の逐次計画は --slow を付けたときだけ行う。
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from . import ch02, ch04
+
+
+def run_ch02 (prm=None, y0=-1, n=100,
+              methods=('Nelder-Mead', 'L-BFGS-B', 'Newton-CG', 'LQR'),
+              verbose=True):
+    if prm is None:
+        prm = ch02.get_params()
+    results = {}
+    for method in methods:
+        t0 = time.perf_counter()
+        res = ch02.solve_gs(y0, n, prm, method=method)
+        results[method] = res
+        if verbose:
+            print("%-11s score=%.6f nfev=%d %.3fs"
+                  % (method, res.fun, res.nfev, time.perf_counter() - t0))
+    return results
+
+
+def run_ch04 (prm=None, slow=False, verbose=True):
+    if prm is None:
+        prm = ch04.get_params()
+    log = print if verbose else (lambda *args: None)
+    results = {}
+    t0 = time.perf_counter()
+    sol = ch04.solve_A_Tp1(prm)
+    Cts, Ats, d65 = ch04.get_Cts_Ats_vec(sol.x[0], prm)
+    results['Cts0'] = Cts
+    log("Cts0 A_Tp1=%.4f d65=%.2e %.3fs"
+        % (sol.x[0], d65, time.perf_counter() - t0))
+    for name, score, jac in [
+            ('Cts1', ch04.score_simple_sum, ch04.score_simple_sum_jac),
+            ('Cts2', ch04.score_E22_UT, ch04.score_E22_UT_jac),
+            ('Cts4', ch04.score_V, ch04.score_V_jac)]:
+        t0 = time.perf_counter()
+        res = ch04.minimize_Cts(score, prm, jac=jac)
+        results[name] = res.x
+        log("%s %s nfev=%d %.3fs" % (name, res.success, res.nfev,
+                                      time.perf_counter() - t0))
+    if slow:
+        t0 = time.perf_counter()
+        results['Cts5'], nfev = ch04.plan_sequential(prm)
+        log("Cts5 nfev=%d %.3fs" % (nfev, time.perf_counter() - t0))
+    t0 = time.perf_counter()
+    results['Cts5b'], stages = ch04.plan_time_consistent(prm)
+    log("Cts5b %s nfev=%d %.3fs"
+        % (all([s['success'] for s in stages]),
+           sum([s['nfev'] for s in stages]), time.perf_counter() - t0))
+    t0 = time.perf_counter()
+    dp = ch04.solve_dp(prm)
+    results['Cts6'], Ats6 = ch04.dp_path(dp, prm.A22, prm)
+    log("Cts6 %.3fs" % (time.perf_counter() - t0))
+    for name, x in results.items():
+        log(name, ch04.score_E22_UT(x, prm), ch04.Ats_cons(x, prm),
+            ch04.ssd(x, results['Cts6']))
+    return results
+
+
+def save_ch02_figures (prm, path):
+    from . import figures
+    fig, axs = figures.subplots(2, 2, figsize=(8, 8))
+    for ax, phi in zip(axs.flat, (0.5, 1, 2, 4)):
+        figures.plot_phase(ax, (prm.s, prm.nu, prm.rho, phi))
+        ax.set_title('$\\phi = %g$' % phi)
+    fig.tight_layout()
+    fig.savefig(os.path.join(path, 'ch02_phase.png'))
+    return [os.path.join(path, 'ch02_phase.png')]
+
+
+def save_ch04_figures (results, prm, path):
+    from . import figures
+    Ats = {name: ch04.get_Ats(x, prm) for name, x in results.items()}
+    files = []
+    for fname, paths, ylabel in [('ch04_Cts.png', results, '$C_t$'),
+                                 ('ch04_Ats.png', Ats, '$A_t$')]:
+        fig, ax = figures.subplots()
+        figures.plot_paths(ax, 22, paths, ylabel)
+        fig.savefig(os.path.join(path, fname))
+        files.append(os.path.join(path, fname))
+    return files
+
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m economy_control.experiments')
+    parser.add_argument('chapter', choices=['ch02', 'ch04'])
+    parser.add_argument('--case', choices=['I', 'II'], default='I')
+    parser.add_argument('--alternative', nargs='*', default=[],
+                        choices=sorted(ch04.alternative.keys()),
+                        help="代替型にする第4章のパラメータ")
+    parser.add_argument('--slow', action='store_true',
+                        help="Cts5 の逐次計画も行う")
+    parser.add_argument('--figures', metavar='DIR',
+                        help="図を DIR に PNG で保存する")
+    args = parser.parse_args(argv)
+    if args.figures:
+        # コマンドラインからは画面に出さずに PNG に書くだけなので Agg にする
+        import matplotlib
+        matplotlib.use('Agg')
+    if args.chapter == 'ch02':
+        prm = ch02.get_params()
+        run_ch02(prm)
+        if args.figures:
+            os.makedirs(args.figures, exist_ok=True)
+            print(save_ch02_figures(prm, args.figures))
+    else:
+        case = {'I': ch04.case_I, 'II': ch04.case_II}[args.case]
+        prm = ch04.get_params(*args.alternative, case=case)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = run_ch04(prm, slow=args.slow)
+        if args.figures:
+            os.makedirs(args.figures, exist_ok=True)
+            print(save_ch04_figures(results, prm, args.figures))
+
+
+if __name__ == '__main__':
+    main()
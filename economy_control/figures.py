@@ -0,0 +1,38 @@
+"""図の描画。
+
+どの関数も描画先の ax を受け取るだけなので、このモジュールを import して
+も matplotlib は import されない。matplotlib が要るのは subplots を呼んだ
+ときだけである。バックエンドは選ばないので、ノートブックではそのときの
+ものが使われる。画面のない環境で描くときは、呼ぶ側(experiments や render
+のコマンドライン)が決める。
+"""
+
+from . import ch02
+
+
+def subplots (*args, **kwargs):
+    import matplotlib.pyplot as plt
+    return plt.subplots(*args, **kwargs)
+
+
+def plot_phase (ax, p, width=2.0, num=100, density=0.7):
+    # p は第2章の (s, nu, rho, phi)
+    dY, dG = ch02.get_fields([p], width, num)[0]
+    c = ch02.field_cache[ch02.get_field_key(p, width, num)]
+    Y, G = ch02.get_grid(width, num)
+    ax.streamplot(G, Y, dG, dY, density=density, color='k')
+    for g_, y_ in c['lines']:
+        ax.plot(g_, y_, ls='-')
+    ax.set_xlim([-width, width])
+    ax.set_ylim([-width, width])
+    ax.set_xlabel('$g$')
+    ax.set_ylabel('$y$')
+
+
+def plot_paths (ax, t0, paths, ylabel, xlabel='$t$'):
+    # paths は {ラベル: 系列}。系列は t0 から始まる。
+    for label, xs in paths.items():
+        ax.plot(range(t0, t0 + len(xs)), xs, label=label)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.legend()
@@ -0,0 +1,148 @@
+"""最適化の目的関数・勾配・制約の呼び出しの計測。
+
+scipy.optimize.minimize が目的関数を何回呼び、一回あたりどれぐらいかか
+り、その中のどこ(第4章なら get_Ats, Phi, U, W など)に時間がかかってい
+るのかは外からは見えない。そこで目的関数・勾配・制約を包んで計測する。
+第2章と第4章のノートはここを import して使う。
+
+instrument(f, name, report) は f を包み、report['calls'][name] に呼び出
+し回数と一回ごとの時間を記録する。profile_every が正なら、その回数に一
+回の呼び出しを cProfile で記録する。minimize_instrumented は
+scipy.optimize.minimize と同じ引数をとり、fun, jac, hess, hessp と各制約
+の fun, jac をすべて instrument で包んでから解く。反復ごとの callback で、
+目的関数の値と制約違反(ineq は負の部分の和、eq は絶対値の和)を
+report['trace'] に記録する。callback の中での評価は数えない。
+
+結果は (res, report) として返すので、print しなくてもプログラムから使え
+る。report['calls'][name] には n, time, times のほか、instr_bins の対数
+ビンによる時間のヒストグラム hist が入る。report['profile'] は累積時間の
+大きい順の関数の表である。minimize を使わない root finding などは
+new_report で report を作り、instrument で直接包んでから finish_report
+で締める。
+"""
+
+import cProfile
+import pstats
+import time
+
+import numpy as np
+
+
+instr_bins = np.logspace(-7, 1, 33)
+
+
+def new_report (profile_every=0):
+    return {'calls': {}, 'trace': [], 'profile_every': profile_every,
+            'profiler': cProfile.Profile() if profile_every else None,
+            'profiling': False}
+
+
+def instrument (f, name, report):
+    rec = report['calls'].setdefault(name, {'n': 0, 'time': 0.0,
+                                            'times': []})
+    every = report['profile_every']
+
+    def wrapped (*args, **kwargs):
+        prof = every and not report['profiling'] and rec['n'] % every == 0
+        t0 = time.perf_counter()
+        if prof:
+            report['profiling'] = True
+            report['profiler'].enable()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if prof:
+                report['profiler'].disable()
+                report['profiling'] = False
+            dt = time.perf_counter() - t0
+            rec['n'] += 1
+            rec['time'] += dt
+            rec['times'].append(dt)
+    return wrapped
+
+
+def cons_violation (constraints, x):
+    viol = 0.0
+    for c in constraints:
+        v = np.atleast_1d(c['fun'](x, *c.get('args', ())))
+        if c['type'] == 'ineq':
+            viol += np.sum(np.maximum(- v, 0))
+        else:
+            viol += np.sum(np.abs(v))
+    return float(viol)
+
+
+def profile_table (prof, n=15):
+    st = pstats.Stats(prof)
+    rows = [{'func': fn, 'file': "%s:%d" % (file, line), 'ncalls': nc,
+             'tottime': tt, 'cumtime': ct}
+            for (file, line, fn), (cc, nc, tt, ct, callers)
+            in st.stats.items()]
+    rows.sort(key=lambda r: - r['cumtime'])
+    return rows[:n]
+
+
+def finish_report (report, elapsed):
+    report['time'] = elapsed
+    for rec in report['calls'].values():
+        rec['times'] = np.array(rec['times'])
+        rec['hist'] = np.histogram(rec['times'], instr_bins)[0]
+    prof = report.pop('profiler')
+    report['profile'] = [] if prof is None else profile_table(prof)
+    return report
+
+
+def minimize_instrumented (fun, x0, args=(), constraints=(),
+                           profile_every=0, **kwargs):
+    import scipy.optimize
+    report = new_report(profile_every)
+    name = getattr(fun, '__name__', 'fun')
+    for k in ('jac', 'hess', 'hessp'):
+        if callable(kwargs.get(k)):
+            kwargs[k] = instrument(kwargs[k],
+                                   getattr(kwargs[k], '__name__', k), report)
+    if isinstance(constraints, dict):
+        constraints = (constraints,)
+    cons = []
+    for i, c in enumerate(constraints):
+        c = dict(c)
+        for k in ('fun', 'jac'):
+            if callable(c.get(k)):
+                c[k] = instrument(c[k], getattr(c[k], '__name__',
+                                                "cons%d_%s" % (i, k)),
+                                  report)
+        cons.append(c)
+    callback = kwargs.pop('callback', None)
+    t0 = time.perf_counter()
+
+    def trace (xk, *a):
+        report['trace'].append({
+            'nit': len(report['trace']) + 1,
+            'fun': float(fun(xk, *args)),
+            'viol': cons_violation(constraints, xk),
+            'nfev': report['calls'][name]['n'],
+            'time': time.perf_counter() - t0})
+        if callback is not None:
+            callback(xk, *a)
+
+    res = scipy.optimize.minimize(instrument(fun, name, report), x0,
+                                  args=args, constraints=cons,
+                                  callback=trace, **kwargs)
+    return res, finish_report(report, time.perf_counter() - t0)
+
+
+def print_report (report, n=10):
+    print("total %.3fs, %d iterations" % (report['time'],
+                                          len(report['trace'])))
+    for name, rec in report['calls'].items():
+        if rec['n'] == 0:
+            continue
+        print("%-22s n=%-7d total=%.4fs mean=%.1fus p99=%.1fus"
+              % (name, rec['n'], rec['time'], rec['time'] / rec['n'] * 1e6,
+                 np.percentile(rec['times'], 99) * 1e6))
+    if report['trace']:
+        tr = report['trace'][-1]
+        print("last: fun=%.6g viol=%.3g" % (tr['fun'], tr['viol']))
+    for r in report['profile'][:n]:
+        print("%-28s %8d %9.4fs %9.4fs" % (r['func'], r['ncalls'],
+                                           r['tottime'], r['cumtime']))
@@ -0,0 +1,240 @@
+"""図4-1a から図4-10b までをまとめて描く。
+
+    python -m economy_control.render --write-scenarios figs.jsonl
+    python -m economy_control.batch ch04 figs.jsonl solved
+    python -m economy_control.render out --results solved
+
+--results を省くと、図に使うシナリオ(十個)をその場で解く。図は Agg で
+PNG に描き、プロセスプールで手分けする。各ワーカーは Figure を一つだけ作っ
+て使い回す。図ごとに入力データのハッシュを out/figures.json に残してお
+き、ハッシュが変わらない図は描き直さない。
+
+ノートブックでは $Y$ をその時点のグローバルな prm から一度だけ計算していた
+が、ここでは図に描くシナリオ自身のパラメータから ch04.get_Yts で求める。
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import batch, ch04, figures
+
+
+# 描き方を変えたら上げる。ハッシュに含めるので全部描き直しになる。
+render_version = 1
+
+# 図に使うシナリオ。batch の入力のレコードと同じ形。
+figure_scenarios = {
+    'standard': {},
+    'r': {'alternative': ['r']},
+    'tau': {'alternative': ['tau']},
+    'theta': {'alternative': ['theta']},
+    'F65': {'alternative': ['F65']},
+    'z': {'alternative': ['z']},
+    'II': {'case': 'II'},
+    'II_gamma': {'alternative': ['gamma'], 'case': 'II'},
+    'II_k': {'alternative': ['k'], 'case': 'II'},
+    'II_A22': {'alternative': ['A22'], 'case': 'II'},
+}
+
+
+def compare (sc1, sc2, kind, sym, name):
+    # 二つのシナリオの kind の系列を、パラメータ name の値をラベルにして並べる
+    return [(sc, kind, (sym, name)) for sc in (sc1, sc2)]
+
+
+# (図の番号, 縦軸, [(シナリオ, 系列, ラベル)])。系列は 'C', 'A', 'Y' のど
+# れか。ラベルが (記号, パラメータ名) のときは、そのシナリオの値を入れる。
+figure_specs = [
+    ('4-1a', '$C$, $Y$', [('standard', 'Y', '$Y$'),
+                          ('standard', 'C', '$C$')]),
+    ('4-1b', '$A$, $C$', [('standard', 'A', '$A$'),
+                          ('standard', 'C', '$C$')]),
+    ('4-2', '$C$, $Y$', [('r', 'Y', '$Y$'), ('r', 'C', '$C$')]),
+    ('4-3', '$C$, $Y$', [('tau', 'Y', '$Y$'), ('tau', 'C', '$C$')]),
+    ('4-4', '$C$', compare('standard', 'theta', 'C', 'θ', 'theta')),
+    ('4-5a', '$C$', compare('standard', 'F65', 'C', 'F_{65}', 'F65')),
+    ('4-5b', '$A$', compare('standard', 'F65', 'A', 'F_{65}', 'F65')),
+    ('4-6a', '$C$', compare('standard', 'z', 'C', 'z', 'z')),
+    ('4-6b', '$A$', compare('standard', 'z', 'A', 'z', 'z')),
+    ('4-7a', '$C$', compare('standard', 'II', 'C', 'T', 'T')),
+    ('4-7b', '$A$', compare('standard', 'II', 'A', 'T', 'T')),
+    ('4-8a', '$C$', compare('II', 'II_gamma', 'C', 'γ', 'gamma')),
+    ('4-8b', '$A$', compare('II', 'II_gamma', 'A', 'γ', 'gamma')),
+    ('4-9', '$A$', compare('II', 'II_k', 'A', 'k', 'k')),
+    ('4-10a', '$C$', compare('II', 'II_A22', 'C', 'A_{22}', 'A22')),
+    ('4-10b', '$A$', compare('II', 'II_A22', 'A', 'A_{22}', 'A22')),
+]
+
+
+def scenario_params (sc):
+    rec = dict(figure_scenarios[sc])
+    case = {'I': ch04.case_I, 'II': ch04.case_II}[rec.pop('case', 'I')]
+    return ch04.get_params(*rec.pop('alternative', []), case=case, **rec)
+
+
+def params_key (values):
+    return tuple(float(values[n]) for n in batch.ch04_keys)
+
+
+def write_scenarios (path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for sc, rec in figure_scenarios.items():
+            f.write(json.dumps(dict(rec, id=sc)) + '\n')
+
+
+def solve_scenarios ():
+    # batch と同じ root で解いた結果を batch.iter_results と同じ形で返す
+    records = [dict(rec, id=sc) for sc, rec in figure_scenarios.items()]
+    return batch.solve_chunk('ch04', 'root', records, 0)
+
+
+def make_job (name, ylabel, series, rows, outdir):
+    lines = []
+    for sc, kind, label in series:
+        prm = scenario_params(sc)
+        row = rows.get(params_key(vars(prm)))
+        if row is None:
+            return sc
+        ys = {'C': row['Cts'], 'A': row['Ats'], 'Y': ch04.get_Yts(prm)}[kind]
+        if not isinstance(label, str):
+            label = '$%s = %g$' % (label[0], getattr(prm, label[1]))
+        lines.append((label, np.asarray(ys, dtype=float)))
+    return {'name': name, 'title': 'Fig. ' + name, 'ylabel': ylabel,
+            'lines': lines, 'path': os.path.join(outdir, 'fig_%s.png' % name)}
+
+
+def make_jobs (results, outdir, verbose=True):
+    log = print if verbose else (lambda *args: None)
+    rows = {}
+    for r in results:
+        if r.get('method', 'root') == 'root' and r['success']:
+            rows[params_key(r)] = r
+    jobs = []
+    for name, ylabel, series in figure_specs:
+        job = make_job(name, ylabel, series, rows, outdir)
+        if isinstance(job, str):
+            log("skip %s: no solved result for scenario %s" % (name, job))
+        else:
+            jobs.append(job)
+    return jobs
+
+
+def job_hash (job, figsize, dpi):
+    h = hashlib.sha256(repr((render_version, figsize, dpi, job['title'],
+                             job['ylabel'], [l for l, ys in job['lines']]))
+                       .encode('utf-8'))
+    for l, ys in job['lines']:
+        h.update(ys.tobytes())
+    return h.hexdigest()
+
+
+_canvas = {}
+
+
+def get_canvas (figsize, dpi):
+    # ワーカーごとに Figure を一つ作って使い回す。pyplot を通さないので
+    # バックエンドの設定も要らない(Agg で描かれる)。
+    key = (tuple(figsize), dpi)
+    if key not in _canvas:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize, dpi=dpi)
+        _canvas[key] = (fig, fig.add_subplot())
+    return _canvas[key]
+
+
+def render_jobs (jobs, figsize=(6.4, 4.8), dpi=100):
+    fig, ax = get_canvas(figsize, dpi)
+    done = []
+    for job in jobs:
+        t0 = time.perf_counter()
+        ax.clear()
+        figures.plot_paths(ax, 22, dict(job['lines']), job['ylabel'])
+        ax.set_title(job['title'])
+        tmp = "%s.%d.tmp" % (job['path'], os.getpid())
+        fig.savefig(tmp, format='png')
+        os.replace(tmp, job['path'])
+        done.append((job['name'], time.perf_counter() - t0))
+    return done
+
+
+def render (results, outdir, workers=None, force=False, figsize=(6.4, 4.8),
+            dpi=100, verbose=True):
+    log = print if verbose else (lambda *args: None)
+    t_start = time.perf_counter()
+    os.makedirs(outdir, exist_ok=True)
+    mpath = os.path.join(outdir, 'figures.json')
+    manifest = {}
+    if os.path.exists(mpath):
+        with open(mpath, encoding='utf-8') as f:
+            manifest = json.load(f)
+    jobs = make_jobs(results, outdir, verbose)
+    hashes = {job['name']: job_hash(job, figsize, dpi) for job in jobs}
+    todo = [job for job in jobs
+            if force or manifest.get(job['name']) != hashes[job['name']]
+            or not os.path.exists(job['path'])]
+    if workers is None:
+        workers = os.cpu_count()
+    workers = min(workers, len(todo))
+    if workers == 0:
+        done = []
+    elif workers == 1:
+        done = render_jobs(todo, figsize, dpi)
+    else:
+        # 各ワーカーが Figure を使い回せるよう、ジョブを workers 個に分けて渡す
+        chunks = [todo[i::workers] for i in range(workers)]
+        with ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork')) as ex:
+            done = [d for ds in ex.map(render_jobs, chunks,
+                                       [figsize] * workers, [dpi] * workers)
+                    for d in ds]
+    for name, t in done:
+        manifest[name] = hashes[name]
+        log("Fig. %s %.3fs" % (name, t))
+    tmp = "%s.%d.tmp" % (mpath, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, mpath)
+    stats = {'rendered': len(done), 'unchanged': len(jobs) - len(todo),
+             'missing': len(figure_specs) - len(jobs),
+             'time': time.perf_counter() - t_start}
+    log("%d rendered, %d unchanged, %d missing %.2fs"
+        % (stats['rendered'], stats['unchanged'], stats['missing'],
+           stats['time']))
+    return stats
+
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(prog='python -m economy_control.render')
+    parser.add_argument('outdir', nargs='?', help="図を書くディレクトリ")
+    parser.add_argument('--results', metavar='DIR',
+                        help="batch ch04 の出力。省くとその場で解く")
+    parser.add_argument('--write-scenarios', metavar='FILE',
+                        help="図に使うシナリオを batch の入力として書いて終わる")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help="ハッシュが変わっていなくても描き直す")
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args(argv)
+    if args.write_scenarios:
+        write_scenarios(args.write_scenarios)
+        return 0
+    if args.outdir is None:
+        parser.error("outdir is required")
+    if args.results:
+        results = batch.iter_results(args.results)
+    else:
+        results = solve_scenarios()
+    stats = render(results, args.outdir, workers=args.workers,
+                   force=args.force, dpi=args.dpi)
+    return 0 if stats['missing'] == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -14,7 +14,7 @@
 # + [markdown] id="-s-r8b183fe8"
 # # 村田安雄『動的経済システムの最適制御』第2章のシミュレーション
 #
-# (Version: 0.0.1)
+# (Version: 0.0.2)
 #
 # 「第2章 投資の加速度原理の経済での安定化政策」について本にシミュレーション結果があるが、それを「追試」してみる。
 #
@@ -32,6 +32,21 @@ import matplotlib.pyplot as plt
 import scipy.optimize
 import numpy as np
 
+# + [markdown] id="jnL6z9_mcKlx"
+# モデルの関数は economy_control パッケージの ch02 (economy_control/ch02.py)に置いてあり、このノートではそれを import して説明と実験をする。パラメータ s, nu, rho, phi, dt は StabilizationParams (prm)にまとめて明示的に渡す。Colab ではリポジトリを clone してパスに加えてから import する。
+
+# + id="QFc90hK3Xo4C"
+import os
+import subprocess
+import sys
+
+if not os.path.isdir('economy_control'):
+    if not os.path.isdir('economy_control_repo'):
+        subprocess.run(['git', 'clone', '-q',
+                        'https://github.com/JRF-2018/economy_control',
+                        'economy_control_repo'], check=True)
+    sys.path.append('economy_control_repo')
+
 # + [markdown] id="50Ih5r_a4lwh"
 # どれぐらいの範囲の図にすればいいのか本からはわからない。とりあえず、-2.0 から 2.0 を 100 マスで区切ったものにする。
 
@@ -67,35 +82,55 @@ ev, evec = np.linalg.eig(A)
 
 print(ev)
 
-# + id="2I6ZuDAX5cIK"
-dY = A[0, 0] * Y + A[0, 1] * G
-dG = A[1, 0] * Y + A[1, 1] * G
+# + [markdown] id="JApt-3YHB8O3"
+# パラメータ (s, nu, rho, phi) を変えながら図を見比べたいので、ベクトル場はまとめて計算してキャッシュしておく。get_fields は K 組のパラメータに対する (dY, dG) を (K, 2, H, W) の配列として一度に計算する。結果はパラメータと格子 (width, num) をキーにして field_cache に入れておき、同じものを描き直すときはそこから読むだけにする。固有値と固有ベクトルによる分離線もそのときに求めておく。
+#
+# なお、状態は (y, g) の順なので固有ベクトルも (y, g) の順だが、図の横軸は g、縦軸は y である。なので分離線の傾き dy/dg は evec[0]/evec[1] になる。以前は evec[1]/evec[0] で描いていたが、それだと直線上でベクトル場が直線と平行にならない。
 
-# + id="FEJ5fgxx5jwa"
-t = np.arange(-width, width, width/200)
+# + id="B9CWfiDJEP8j"
+from economy_control.ch02 import (
+    get_A, get_grid, get_separatrices, field_cache, get_field_key, get_fields)
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 285} id="_hRUp0v25nii" outputId="0d78c996-9be3-4d55-da9e-724c0ed52425"
-fig, ax = plt.subplots()
+def plot_phase (ax, p, width=2.0, num=100, density=0.7):
+    dY, dG = get_fields([p], width, num)[0]
+    c = field_cache[get_field_key(p, width, num)]
+    Y, G = get_grid(width, num)
+    ax.streamplot(G, Y, dG, dY, density=density, color='k')
+    for g_, y_ in c['lines']:
+        ax.plot(g_, y_, ls='-')
+    ax.set_xlim([-width, width])
+    ax.set_ylim([-width, width])
+    ax.set_xlabel('$g$')
+    ax.set_ylabel('$y$')
 
-ax.streamplot(G, Y, dG, dY, density=0.7, color='k')
 
-if ev.imag[0] == 0 and ev.imag[1] == 0:
-    ax.plot(t, (evec[1,0]/evec[0,0]) * t, ls='-')
-    ax.plot(t, (evec[1,1]/evec[0,1]) * t, ls='-')
+# + id="2I6ZuDAX5cIK"
+dY, dG = get_fields([(s, nu, rho, phi)], width)[0]
 
-ax.set_xlim([-width, width])
-ax.set_ylim([-width, width])
-ax.set_xlabel('$g$')
-ax.set_ylabel('$y$')
+# + colab={"base_uri": "https://localhost:8080/", "height": 285} id="_hRUp0v25nii"
+fig, ax = plt.subplots()
+plot_phase(ax, (s, nu, rho, phi), width)
 None
 
+# + [markdown] id="9v6IdbWVuySB"
+# phi をいくつか変えたものを並べてみる。四つのベクトル場は一度の einsum で計算され、もう一度描くときはキャッシュから読まれる。
+
+# + id="VcKqJJ47OC6P"
+params_tmp = [(s, nu, rho, phi_) for phi_ in (0.5, 1, 2, 4)]
+print(get_fields(params_tmp, width).shape, len(field_cache))
+fig, axs = plt.subplots(1, 4, figsize=(16, 4))
+for ax, p_ in zip(axs, params_tmp):
+    plot_phase(ax, p_, width)
+    ax.set_title('$\\phi = %g$' % p_[3])
+plt.show()
+
 # + [markdown] id="CopkMxWj5wN6"
 # さてここからが今回私がやりたかったことである。「最適化」を解析的に導出するのではなく、力技で scipy.optimize.minimize を使って求めたらどうなるか？…というのを試してみたかった。それをやってみる。
 
 # + id="FEECDVY_5reS"
 dt = 0.1
 
-def calc_ys (y0, gs) :
+def calc_ys_naive (y0, gs) :
     ys = [y0]
     g0 = gs[0]
     gs = gs[1:]
@@ -109,11 +144,25 @@ def calc_ys (y0, gs) :
     # assert len(ys) == len(gs) + 1
     return ys
 
-def calc_score (gs, y0):
-    ys = np.array(calc_ys(y0, gs))
-    gs = np.array(gs)
-    return np.sum(ys ** 2 + phi * gs ** 2)
 
+# + [markdown] id="x44tcPpKqofs"
+# 上の calc_ys_naive は最初に書いたものだが、calc_score が呼ばれるたびに Python のループを回すことになり遅い。式 (12) は線形なので、$a = 1 - s w\,dt$, $b = w\,dt$ と置けば $y_k = a^k y_0 + \sum_{j < k} a^{k - 1 - j} b g_j$ と閉じた形に書ける。これは係数 $b a^{k-1-j}$ の畳み込みで、漸化式 $y_{k+1} = a y_k + b g_k$ を線形フィルタとみなせばよいから、scipy.signal.lfilter で O(T) で求めることにする。$y_0$ はフィルタの初期状態 zi として与える。T × T の係数行列を作ると T が一万を超えたあたりでメモリも時間も O(T²) で効いてくるので、それは避ける。
+#
+# gs は (N, T) の形の配列でもよく、その場合は N 個の制御列をまとめて計算する。calc_score も同様で、(N,) の形でスコアを返す。ch02 の calc_ys, calc_score はこれを実装したもので、パラメータは prm として受け取る。
+
+# + id="FPfz2CT2w5Ux"
+from economy_control.ch02 import get_params, get_ys_filter, calc_ys, calc_score
+
+prm = get_params(s=s, nu=nu, rho=rho, phi=phi, dt=dt)
+
+# + [markdown] id="LLx-qykHhGlN"
+# いちおう calc_ys_naive と同じ値になるか検算しておく。ついでに、ランダムな制御列 1000 個をまとめてスコア付けしてみる。
+
+# + id="ktKAQRse_2zm"
+gs_pop = np.random.default_rng(0).normal(size=(1000, 100))
+ys_pop = calc_ys(-1, gs_pop, prm)
+print(np.max(np.abs(ys_pop[0] - np.array(calc_ys_naive(-1, gs_pop[0])))))
+calc_score(gs_pop, -1, prm)[:5]
 
 # + [markdown] id="nikdV3Nz6gvi"
 # フィリップスの最適安定化モデルでは、式 (13) の $J = \frac{1}{2}\int^T_0 (y^2 + \phi g ^2) dt$ を目的関数にしているが、ここでは np.sum(ys ** 2 + phi * gs ** 2) を使っている。
@@ -123,27 +172,191 @@ def calc_score (gs, y0):
 # + id="CG-TUcT-7Zxp"
 y0 = -1
 
+# + [markdown] id="QVObVLmviLVZ"
+# 力技を試す前に、比べる相手を用意しておく。calc_score を最小にする問題は離散時間の LQ 問題そのものなので、本来は最適化ルーチンを使うまでもない。状態方程式を $y_{k+1} = A y_k + B g_k$、目的関数を $\sum_{k=0}^{T-1} (y_k^T Q y_k + g_k^T R g_k)$ とすると、後ろからのリカッチ方程式
+#
+# $$K_k = (R + B^T P_{k+1} B)^{-1} B^T P_{k+1} A,\quad P_k = Q + A^T P_{k+1} (A - B K_k)$$
+#
+# を $P_{T-1} = Q$ から解き、$g_k = - K_k y_k$ とすればよい。これは第3章2節b の EQ21D～EQ24D と同じ形で、$R = 0$ のときはそれそのものになる。計算量は O(T) である。ch02 の solve_lqr はこれをそのまま実装したもの。
+#
+# なお calc_ys と同じく、最後の $g_{T-1}$ は y に影響しないので 0 になる。
+
+# + id="ok7mmszSCh25"
+from economy_control.ch02 import solve_lqr
+
+# + [markdown] id="2jjrQP6ITTPH"
+# solve_gs は y0 と期間の数 n とパラメータ prm から最適な gs を求める。既定の method='LQR' は上の solve_lqr で解く。比較のために 'Nelder-Mead', 'L-BFGS-B', 'Newton-CG' を指定すると scipy.optimize.minimize で解く(後ろの二つが使う勾配とヘッセ行列とベクトルの積は下で import する)。
+
+# + id="w-4HAXdh4CU4"
+from economy_control.ch02 import solve_gs
+
 # + id="H5ISiV8y7htS"
-res = scipy.optimize.minimize(calc_score, [0] * 100, args=(y0,), method='Nelder-Mead')
+res = solve_gs(y0, 100, prm)
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 285} id="WwNhgZMI8QF_" outputId="562c6356-85c9-4006-e145-a79585b0d4a1"
+# + colab={"base_uri": "https://localhost:8080/", "height": 285} id="WwNhgZMI8QF_"
 fig, ax = plt.subplots()
+plot_phase(ax, (s, nu, rho, phi), width)
+ax.plot(res.x, calc_ys(y0, res.x, prm))
+plt.show()
 
-ax.streamplot(G, Y, dG, dY, density=0.7, color='k')
+# + [markdown] id="cOYsjzx_mPK2"
+# これが最適な経路である。では、最初にやりたかった力技、つまり Nelder-Mead で gs の 100 個の値を直接探すとどうなるか。比較として解いてみる。
 
-if ev.imag[0] == 0 and ev.imag[1] == 0:
-    ax.plot(t, (evec[1,0]/evec[0,0]) * t, ls='-')
-    ax.plot(t, (evec[1,1]/evec[0,1]) * t, ls='-')
+# + id="tDmBs43A9pwM"
+res_nm = solve_gs(y0, 100, prm, method='Nelder-Mead')
 
-ax.set_xlim([-width, width])
-ax.set_ylim([-width, width])
-ax.set_xlabel('$g$')
-ax.set_ylabel('$y$')
-# ここまでは上と同じ。
-ax.plot(res.x, calc_ys(y0, res.x))
+# + id="nslX4RKdoCX7"
+fig, ax = plt.subplots()
+plot_phase(ax, (s, nu, rho, phi), width)
+ax.plot(res_nm.x, calc_ys(y0, res_nm.x, prm))
 plt.show()
 
 # + [markdown] id="m-BlSCSI8n2M"
 # …ということで、上の緑のギザギザが「力技」なわけだが、あまりうまくいっていない。dt を小さくすればギザギザはとても小さくなりより streamplot の線に沿った形にはなるようだが、いかんせん小さすぎてちゃんとした値になっているかよくわからない。
 #
 # ただ、この実験で、gs が百のパラメータからなるとても長いベクトルにしたわけだが、それがわりと短い時間で結果が出ている。それは今後にむけて心強い結果だといえる。
+
+# + [markdown] id="HoIvokmW4Czi"
+# ギザギザの原因は、Nelder-Mead が calc_score をブラックボックスとして 100 次元を探索しているからだと思われる。しかし calc_score は gs の二次式なので、勾配もヘッセ行列も正確に求まる。
+#
+# ys = a^k y0 + K gs なので、$J = \|ys\|^2 + \phi \|gs\|^2$ の勾配は $2 K^T ys + 2 \phi\, gs$ になる。$K^T$ を掛けるのは随伴方程式 $\lambda_k = 2 y_k + a \lambda_{k + 1}$ を後ろから解くことに相当する。これは系列を逆順にして calc_ys と同じフィルタをかけ、結果をまた逆順にすれば O(T) で求まる。ヘッセ行列とベクトル v の積は $2 K^T K v + 2 \phi v$ で、$K v$ は y0 = 0 の calc_ys である。gs, v が (N, T) の形なら N 個まとめて計算する。
+
+# + id="04iWxPoDhO5s"
+from economy_control.ch02 import calc_adjoint, calc_score_jac, calc_score_hessp
+
+# + [markdown] id="0_cTxN49rS49"
+# 勾配が正しいか差分で検算しておく。随伴方程式で求めたものが、係数行列 K を作って行列積で求めたものと一致するかも (N, T) の形でまとめて見ておく。
+
+# + id="pzAovTdfq8gF"
+gs_tmp = np.random.default_rng(1).normal(size=100)
+print(scipy.optimize.check_grad(calc_score, calc_score_jac, gs_tmp, y0, prm))
+v_tmp = np.random.default_rng(2).normal(size=100)
+eps = 1e-6
+hv = (calc_score_jac(gs_tmp + eps * v_tmp, y0, prm)
+      - calc_score_jac(gs_tmp - eps * v_tmp, y0, prm)) / (2 * eps)
+print(np.max(np.abs(hv - calc_score_hessp(gs_tmp, v_tmp, y0, prm))))
+k_tmp = np.arange(100)
+d_tmp = k_tmp[:, None] - k_tmp[None, :] - 1
+a_tmp = 1 - prm.s * prm.w * prm.dt
+K_tmp = np.where(d_tmp >= 0, prm.w * prm.dt * (a_tmp ** np.maximum(d_tmp, 0)), 0.0)
+gs_tmp = np.random.default_rng(3).normal(size=(5, 100))
+v_tmp = np.random.default_rng(4).normal(size=(5, 100))
+ys_tmp = y0 * (a_tmp ** k_tmp) + gs_tmp @ K_tmp.T
+print(np.max(np.abs(calc_score_jac(gs_tmp, y0, prm)
+                    - (2 * ys_tmp @ K_tmp + 2 * phi * gs_tmp))))
+np.max(np.abs(calc_score_hessp(gs_tmp, v_tmp, y0, prm)
+              - (2 * (v_tmp @ K_tmp.T) @ K_tmp + 2 * phi * v_tmp)))
+
+# + [markdown] id="eYiuoLvX80js"
+# L-BFGS-B と Newton-CG で解いてみる。評価回数 nfev が Nelder-Mead と比べてどれぐらいか見る。リカッチ方程式で直接解いたものとも比べておく。
+
+# + id="JD8aWiydnmk5"
+res_lbfgs = solve_gs(y0, 100, prm, method='L-BFGS-B')
+res_ncg = solve_gs(y0, 100, prm, method='Newton-CG')
+print(res_nm.nfev, res_nm.fun)
+print(res_lbfgs.nfev, res_lbfgs.fun)
+print(res_ncg.nfev, res_ncg.fun)
+print(res.fun, np.max(np.abs(res.x - res_lbfgs.x)))
+
+# + id="hH37iNRvtuOh"
+fig, ax = plt.subplots()
+ax.plot(res_nm.x, calc_ys(y0, res_nm.x, prm), label='Nelder-Mead')
+ax.plot(res_lbfgs.x, calc_ys(y0, res_lbfgs.x, prm), label='L-BFGS-B')
+ax.plot(res.x, calc_ys(y0, res.x, prm), ls=':', label='LQR')
+ax.set_xlabel('$g$')
+ax.set_ylabel('$y$')
+ax.legend()
+plt.show()
+
+# + [markdown] id="hF2B2XBZYIgK"
+# これならギザギザはなくなる。dt = 0.01 にして gs を千のパラメータにしても現実的な時間で解ける。リカッチ方程式なら dt = 0.001 で一万ステップでもすぐである。
+
+# + id="HFB2MD-feufR"
+prm_fine = get_params(s=s, nu=nu, rho=rho, phi=phi, dt=0.01)
+res_fine = solve_gs(y0, 1000, prm_fine, method='L-BFGS-B')
+res_fine_lqr = solve_gs(y0, 1000, prm_fine)
+print(res_fine.nfev, res_fine.success)
+print(res_fine.fun, res_fine_lqr.fun)
+prm_long = get_params(s=s, nu=nu, rho=rho, phi=phi, dt=0.001)
+res_long = solve_gs(y0, 10000, prm_long)
+print(res_long.fun)
+
+# + [markdown] id="aBk9nm-B9C4P"
+# ## ベンチマーク
+#
+# 各ソルバーの速さの基準がないので、問題の大きさを変えながら時間・評価回数・ピークメモリを測り、JSON に書き出しておく。計測と記録の関数(bench_case, bench_save, bench_compare)は三つのノートで共通なので economy_control パッケージの bench に置いてあり、使い方の説明もそちらにある。結果は benchmarks/ノート名.json に保存し、benchmarks/ノート名.baseline.json と比べて退行を探す。
+
+# + id="kZmDixWyL2ck"
+from economy_control import ch02
+from economy_control.bench import bench_case, bench_save, bench_compare
+
+
+# + [markdown] id="naGAT35N-5rx"
+# 第2章では、calc_score の評価そのものと、Nelder-Mead, L-BFGS-B, Newton-CG, リカッチ方程式による solve_gs を dt と段数 T を変えながら測る。Nelder-Mead は遅いので小さいものだけにする。
+#
+# dt を変えるときは bench_params で StabilizationParams を作り直して渡す。
+
+# + id="Wdlh9E-HLKBx"
+def bench_score (gs, y0, prm, n=100):
+    for i in range(n):
+        ch02.calc_score(gs, y0, prm)
+    return n
+
+def bench_params (dt_):
+    return ch02.get_params(s=s, nu=nu, rho=rho, phi=phi, dt=dt_)
+
+bench_results = []
+for dt_, T_ in ((0.1, 100), (0.01, 1000), (0.001, 10000)):
+    prm_tmp = bench_params(dt_)
+    gs_tmp = np.random.default_rng(0).normal(size=T_)
+    bench_results.append(bench_case(
+        'calc_score', {'dt': dt_, 'T': T_},
+        lambda: bench_score(gs_tmp, y0, prm_tmp, 100000 // T_)))
+for dt_, T_ in ((0.2, 50), (0.1, 100)):
+    prm_tmp = bench_params(dt_)
+    bench_results.append(bench_case(
+        'Nelder-Mead', {'dt': dt_, 'T': T_},
+        lambda: ch02.solve_gs(y0, T_, prm_tmp, method='Nelder-Mead').nfev,
+        repeat=1))
+for dt_, T_ in ((0.1, 100), (0.01, 1000)):
+    prm_tmp = bench_params(dt_)
+    for method in ('L-BFGS-B', 'Newton-CG'):
+        bench_results.append(bench_case(
+            method, {'dt': dt_, 'T': T_},
+            lambda: ch02.solve_gs(y0, T_, prm_tmp, method=method).nfev))
+for dt_, T_ in ((0.1, 100), (0.01, 1000), (0.001, 10000)):
+    prm_tmp = bench_params(dt_)
+    bench_results.append(bench_case(
+        'LQR', {'dt': dt_, 'T': T_},
+        lambda: ch02.solve_gs(y0, T_, prm_tmp).nfev))
+
+bench_save(bench_results, 'economy_control_02')
+bench_compare(bench_results, 'economy_control_02')
+
+# + [markdown] id="ZwyuP2vqsgWP"
+# ## 目的関数の計測
+#
+# scipy.optimize.minimize が目的関数を何回呼び、一回あたりどれぐらいかかり、その中のどこに時間がかかっているのかは外からは見えない。そこで目的関数・勾配・制約を包んで計測する economy_control.instrument を使う。minimize_instrumented は scipy.optimize.minimize と同じ引数をとり、(res, report) を返す。report の中身の説明は economy_control/instrument.py にある。
+
+# + id="Dbm6jAENwZyS"
+from economy_control.instrument import (
+    instr_bins, new_report, instrument, finish_report, minimize_instrumented,
+    print_report)
+
+# + [markdown] id="TRIHEjc6Urku"
+# 第2章の calc_score で試す。Nelder-Mead は 100 回に一回、Newton-CG は毎回 cProfile をとる。
+
+# + id="Tf6mpP5HVx2a"
+res_tmp, report_tmp = minimize_instrumented(calc_score, np.zeros(100),
+                                            args=(y0, prm), method='Nelder-Mead',
+                                            profile_every=100)
+print_report(report_tmp, 5)
+
+# + id="ERwwbuHyphRA"
+res_tmp, report_tmp = minimize_instrumented(calc_score, np.zeros(100),
+                                            args=(y0, prm), jac=calc_score_jac,
+                                            hessp=calc_score_hessp,
+                                            method='Newton-CG',
+                                            profile_every=1)
+print_report(report_tmp, 5)
+[(tr['nit'], tr['nfev'], tr['fun']) for tr in report_tmp['trace']]
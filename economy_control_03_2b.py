@@ -14,7 +14,7 @@
 # + [markdown] id="-s-r8b183fe8"
 # # 村田安雄『動的経済システムの最適制御』第3章2節bの検算
 #
-# (Version: 0.0.2)
+# (Version: 0.0.3)
 #
 # 「第3章 離散時間ダイナミック・プログラミングの方法と消費計画への応用」の「2. 確実性下の D.P. の最適化原理」の「［b］m 制御変数と n 状態変数の D.P.」について、行列に関する計算の「検算」を行ってみる。
 #
@@ -42,6 +42,21 @@ from sympy import *
 init_printing()
 from sympy_matrix_tools import *
 
+# + [markdown] id="29dlY509qY5T"
+# 数値計算と式のコンパイルの関数は economy_control パッケージの ch03_2b (economy_control/ch03_2b.py)に置いてあり、後半ではそれを import して検算と実験をする。Colab ではリポジトリを clone してパスに加えてから import する。
+
+# + id="bqW_KTDleaqj"
+import os
+import subprocess
+import sys
+
+if not os.path.isdir('economy_control'):
+    if not os.path.isdir('economy_control_repo'):
+        subprocess.run(['git', 'clone', '-q',
+                        'https://github.com/JRF-2018/economy_control',
+                        'economy_control_repo'], check=True)
+    sys.path.append('economy_control_repo')
+
 # + id="Cc90E2exg3yv"
 t = Symbol("t", integer=True, positive=True)
 n = Symbol("n", integer=True, positive=True)
@@ -125,6 +140,146 @@ EQ20D = Eq(v(t, y(t - 1)),
            * S(t) * (A * y(t -1) + z(t))
            - Rational(1, 2) * h(t) + g(t))
 
+# + [markdown] id="4qywH2obbh5A"
+# ### 数値による検算
+#
+# 記号的な expand().doit() は遅く、X == Q_T のようなハックが要ることもある。そこで記号的な検算の前に、n, m を具体的な数にし、A, B, Q_T, P_T, y(t - 1), x(t), z(t) などの行列に乱数を入れて、両辺の値を比べてみる。乱数のサンプルは k 個まとめて (k, 行, 列) の配列として NumPy で一度に計算するので数ミリ秒で済む。間違った恒等式は記号計算の前にここではじかれるし、記号計算では閉じられない段についても数値的な証拠になる。
+#
+# num_check(lhs, rhs) は式の木をたどって、MatAdd, MatMul, Transpose, Inverse などを NumPy の演算に置き換える。それ以外の葉(MatrixSymbol や MatrixFunction の値、beta など)には乱数を入れる。同じ葉には同じ値が入る。symmetric に与えた行列の葉は対称・正定値にしておく(EQQTT や EQQtT の仮定であり、(B^T Q B)^{-1} が取れるようにするためでもある)。symmetric には MatrixSymbol か MatrixFunction を並べ、MatrixFunction ならその値 Q(t), Q(t + 1) などがすべて対象になる。既定は num_symmetric = (Q_T, Q) で、名前が似ていても(たとえば下で微分のために作る Q_Tm1 など)ここに並べていないものは対称にしない。dims の (n, m) の組それぞれについて、相対誤差の最大値が tol 未満なら成立とみなす。
+
+# + id="xWHzvNiAqVqH"
+import time
+
+import numpy as np
+
+num_dims = ((3, 2), (4, 4), (5, 1))
+num_symmetric = (Q_T, Q)
+
+def num_dim (s, dims):
+    return int(sympify(s).subs({n: dims[0], m: dims[1]}))
+
+def num_is_symmetric (e, symmetric):
+    # MatrixSymbol はそのもの、MatrixFunction はその値 Q(t) などが対象
+    head = str(e).split("(")[0] if "(" in str(e) else None
+    return any(e == s or getattr(e, 'func', None) == s
+               or (head is not None and head == str(s)) for s in symmetric)
+
+def num_leaf (e, env, dims, rng, k, symmetric):
+    if e not in env:
+        if getattr(e, 'is_Matrix', False):
+            r, c = [num_dim(s, dims) for s in e.shape]
+            M = rng.standard_normal((k, r, c)) / np.sqrt(r)
+            if r == c and num_is_symmetric(e, symmetric):
+                M = M @ M.swapaxes(-1, -2) + np.eye(r)
+            env[e] = M
+        else:
+            env[e] = rng.uniform(0.5, 1.0, (k, 1, 1))
+    return env[e]
+
+def num_eval (e, env, dims, rng, k, symmetric):
+    ev = lambda a: num_eval(a, env, dims, rng, k, symmetric)
+    if e.is_Number:
+        return float(e)
+    if isinstance(e, (MatAdd, Add)):
+        r = 0
+        for a in e.args:
+            r = r + ev(a)
+        return r
+    if isinstance(e, (MatMul, Mul)):
+        r, r_is_matrix = 1.0, False
+        for a in e.args:
+            a_is_matrix = getattr(a, 'is_Matrix', False)
+            if r_is_matrix and a_is_matrix:
+                r = r @ ev(a)
+            else:
+                r = r * ev(a)
+            r_is_matrix = r_is_matrix or a_is_matrix
+        return r
+    if isinstance(e, Transpose):
+        return ev(e.arg).swapaxes(-1, -2)
+    if isinstance(e, Inverse):
+        return np.linalg.inv(ev(e.arg))
+    if isinstance(e, MatPow):
+        if e.exp == -1:
+            return np.linalg.inv(ev(e.base))
+        return np.linalg.matrix_power(ev(e.base), int(e.exp))
+    if isinstance(e, Pow):
+        return ev(e.base) ** ev(e.exp)
+    if isinstance(e, Identity):
+        return np.eye(num_dim(e.shape[0], dims))
+    if isinstance(e, ZeroMatrix):
+        return 0.0
+    return num_leaf(e, env, dims, rng, k, symmetric)
+
+def num_check (lhs, rhs=None, dims=num_dims, k=64, seed=0, tol=1e-8,
+               symmetric=None, verbose=True):
+    if symmetric is None:
+        symmetric = num_symmetric
+    if isinstance(lhs, Equality):
+        lhs, rhs = lhs.lhs, lhs.rhs
+    if rhs is None:
+        rhs = ZeroMatrix(*lhs.shape) if lhs.is_Matrix else Integer(0)
+        terms = lhs.args if isinstance(lhs, (MatAdd, Add)) else (lhs,)
+    else:
+        terms = (lhs, rhs)
+    errs = {}
+    for d in dims:
+        rng = np.random.default_rng([seed, d[0], d[1]])
+        env = {}
+        diff = np.abs(num_eval(lhs, env, d, rng, k, symmetric)
+                      - num_eval(rhs, env, d, rng, k, symmetric))
+        scale = max(np.max(np.abs(num_eval(a, env, d, rng, k, symmetric)))
+                    for a in terms)
+        errs[d] = float(np.max(diff)) / (1 + scale)
+    ok = all(e_ < tol for e_ in errs.values())
+    if verbose:
+        print("ok" if ok else "NG",
+              ", ".join("%s: %.1e" % (d, e_) for d, e_ in errs.items()))
+    return ok
+
+
+# + [markdown] id="rzE4R5wlNk0h"
+# 証明の前に、示したいことを数値で確かめておく。y(t) = A y(t - 1) + B x(t) + z(t) のもとで P(t)^T y(t) + 1/2 y(t)^T Q(t) y(t) + g(t) を x(t) で微分したもの B^T (P(t) + Q(t) y(t)) は、x(t) が EQ19D のとき 0 になり、そのときの値は S(t), h(t) を代入した EQ20D の右辺に等しいはずである。また、EQ21D～EQ25D で t := t - 1 の Q, P, g を作り、v(t, y(t - 1)) に EQ20D を入れたとき、w(y(t - 1)) + beta v(t, y(t - 1)) が P(t - 1)^T y(t - 1) + 1/2 y(t - 1)^T Q(t - 1) y(t - 1) + g(t - 1) になるはずである(下の EQ18c)。これらを微分も expand もせずに確かめる。
+
+# + id="Hjpa2hxDkIZg"
+num_t0 = time.perf_counter()
+num_y = EQ11.rhs.subs(x(t), EQ19D.rhs)
+num_S = {EQ21D.lhs: EQ21D.rhs, EQ22D.lhs: EQ22D.rhs}
+num_check(B.T * (P(t) + Q(t) * num_y))
+num_check((P(t).T * num_y + Rational(1, 2) * num_y.T * Q(t) * num_y + g(t)),
+          EQ20D.rhs.subs(num_S))
+
+num_tmp = EQ13.subs(t, t - 1).rhs + beta * EQ20D.rhs
+num_tmp2 = (P(t - 1).T * y(t - 1)
+            + Rational(1, 2) * y(t - 1).T * Q(t - 1) * y(t - 1) + g(t - 1))\
+    .subs({EQ24D.lhs.subs(t, t - 1): EQ24D.rhs.subs(t, t - 1),
+           EQ23D.lhs.subs(t, t - 1): EQ23D.rhs.subs(t, t - 1),
+           EQ25D.lhs.subs(t, t - 1): EQ25D.rhs.subs(t, t - 1)})
+num_check((num_tmp - num_tmp2).subs(EQ21D.lhs, EQ21D.rhs))
+print("%.3fs" % (time.perf_counter() - num_t0))
+
+# + [markdown] id="r2GGrhaPuB9V"
+# 三つ目は m < n でも成り立つ。一方、下で使う X == Q_T のハックにあたる Q(t) B (B^T Q(t) B)^{-1} B^T Q(t) == Q(t) は、B が(確率 1 で)正則になる m == n のときしか成り立たない。つまりあのハックは記号計算を閉じるための便法であって、EQ18c そのものは一般に正しいことが数値的にわかる。
+
+# + id="bsjShx9J2tMc"
+num_check(Q(t) * B * (B.T * Q(t) * B) ** -1 * B.T * Q(t), Q(t))
+
+# + [markdown] id="qDrpnFA5s0l4"
+# 逆に、たとえば EQ23D の S(t + 1).T を S(t + 1) と書き間違えていれば NG になる。なお m == n のときは S(t) == 0 になってしまうので、この種の間違いは m < n の組でないと見つからない。
+
+# + id="_EWb5ZjOVzHc"
+num_tmp3 = num_tmp2.subs(S(t).T, S(t))
+num_check((num_tmp - num_tmp3).subs(EQ21D.lhs, EQ21D.rhs))
+
+# + [markdown] id="NeQoJWv0TJ1K"
+# ここまでのセルは MatrixFunction を使うので sympy_matrix_tools が要る。num_check そのものが間違った恒等式をはじけることは、MatrixSymbol だけで作れる t := T の S(T) = I - B (B^T Q_T B)^{-1} B^T Q_T でも確かめられる。S(T) B = 0 と S(T)^T Q_T S(T) = Q_T S(T) は成り立つが、わざと壊した S(T)^T Q_T S(T) = Q_T は NG になる。
+
+# + id="rJ3wq5NcheCk"
+S_T = Identity(n) - B * ((B.T * Q_T * B) ** -1) * B.T * Q_T
+num_check(S_T * B, ZeroMatrix(n, m))
+num_check(S_T.T * Q_T * S_T, Q_T * S_T)
+num_check(S_T.T * Q_T * S_T, Q_T)
+
 # + [markdown] id="AiNvQS3Fvh7u"
 # 示したいのは t := t において EQ21D～EQ25D のときに EQ19D EQ20D が成り立っていたとき、t := t-1 において、EQ21D～EQ25D と定義したとき EQ19D EQ20D が成り立つことである。また帰納法の初期条件として t := T-1 において EQ21D～EQ25D と定義したとき EQ19D EQ20D が成り立つこともまず示さねばならない。
 #
@@ -454,3 +609,448 @@ EQ20tmp3
 # これで t := t - 1 において、EQ19D EQ20D が成り立つことが示せたことになる。これで帰納法でこの節の導出が正しかったことが証明された。…と思う。
 #
 # なお、終わってから気づいたのだが、t := T の時点で帰納法を満たしており、t := T - 1 については言う必要がなかったのかもしれない。ただ、本では示しているため、言った意味が全くないとはならないとは思う。
+
+# + [markdown] id="nhTfWiH-mcVZ"
+# ### 検証の DAG
+#
+# 上の証明は一本のスクリプトになっているが、実際には次のようなほぼ独立な部分からなる。
+#
+# * base_T: t := T の場合(EQ18a, EQ19a, EQ20a)。
+# * case_Tm1_value: t := T - 1 の値関数(EQ18b)。base_T の EQ20a を使う。
+# * case_Tm1_diff, case_Tm1_policy: t := T - 1 の最適化(EQ19b とそのときの EQ20D)。後半は symmetry の EQQtT を使う。
+# * symmetry: Q(t).T == Q(t) の補題(EQQtT)。
+# * induction_value, induction_diff, induction_policy: 帰納法の本題(EQ18c と EQ19c, EQ20D)。EQQtT を使う。
+#
+# proof_steps はそれぞれの部分を、入力に使う部分と、上の証明のセルの id の並びと、そのうち 0 になるべき式を表示しているセルの id で表したものである。run_verification は証明のセルをノートブックのファイル(proof_notebook)から読み、依存関係が満たされたものから順にステップごとに実行し直して、ステップごとの時間と 0 になるべき式の成否を表にする。ステップは入力に使う部分が作った名前だけを見て実行されるので、依存関係を書き漏らしていればそのステップがエラーになる。失敗したステップを入力に使うステップは実行しない。only にステップの名前のリストを与えると、それとその入力になるものだけを実行する。
+#
+# 証明のどこかを書き換えたときに確かめ直すためのもので、上の証明をもう一度計算することになるので既定では実行しない(use_dag = False)。use_dag = True にするか、run_verification(proof_steps, only=['symmetry']) のように呼ぶ。セルはファイルから読むので、書き換えたものは保存してから確かめる。Colab ではノートブックのファイルが手元にないので、clone したリポジトリのものを読む。
+#
+# X == Q_T のハックを使う前の式(case_Tm1_value と induction_value の EQ18tmp3)は、ハックがなくても 0 になっているはずである。そこで proof_num_cells に挙げたセルが表示する式には、ステップを実行するときに num_check もかけ、その成否を「セルの id num」として表に加える。
+#
+# 証明の expand() や mat_divide, mat_collect は重いので、通ったステップの結果(ステップのセルが代入した名前の値と、0 になるべき式の成否)は proof_cache_dir に pickle で保存し、次からはそれを読む。キャッシュはこのステップの実行を包むだけで、上の証明のセルを上から実行するときや sympy の関数そのものには手を入れない。キーは、ステップのセルのソース、セルが読む上の定義(EQ21D など)の srepr、入力のステップのキー、sympy と sympy_matrix_tools のバージョンから作るので、セルや定義を書き換えればそのステップとそれを入力に使うステップだけが計算し直しになる。二回目の実行では全ステップがキャッシュから読まれ、表の時間の横に (cache) と出る。ヒットとミスの数、pickle の保存・読み込みに失敗した数は最後に表示する(失敗しても警告を出して計算し直すだけである)。キャッシュを使わないときは memo=False にする。
+
+# + id="rzjGuRAauy9-"
+import ast
+import hashlib
+import json
+import os
+import pickle
+import time
+import warnings
+
+use_dag = False
+proof_notebook = 'economy_control_03_2b.ipynb'
+proof_cache_dir = os.path.join('.economy_control_cache', 'proof')
+
+# ステップ名: (入力に使うステップ, 実行するセル, 0 になるべき式のセル)
+proof_steps = {
+    'base_T': ([], ['3x4SV3h-yNjX', 'Q52c1UWFy65-', 'ih51kChczLY-',
+                    'QgTR0jp60sCW', 'VZdvkpdS0wWX', 'McOUs36F1hbO',
+                    'ZAv51P462j9-', 'uxVZgILd9Rxm', '1BmZmVCu-Arm',
+                    'IB0fIS22VVCS', 'obekGmrjDSc3'],
+               ['ZAv51P462j9-', 'obekGmrjDSc3']),
+    'case_Tm1_value': (['base_T'],
+                       ['_Ak_u9UkENpN', 'jv39y4EOxe1Y', 'm15B1exuYz-L',
+                        'v7aAjf1fah0x', 'nZg9rufLaonL', 'woix3CP0mV1w'],
+                       ['woix3CP0mV1w']),
+    'case_Tm1_diff': (['case_Tm1_value'],
+                      ['JRzTUN_wj51x', 'JVcqx5h08Xeu'], []),
+    'symmetry': ([], ['YgRHd_tvnrEI', '8jeNN4t4qJJB', 'GpJOatscqLDC',
+                      'G5geS7r_qOaB'],
+                 ['GpJOatscqLDC']),
+    'case_Tm1_policy': (['case_Tm1_diff', 'symmetry'],
+                        ['E-PyiEoAsP0Y', 'dCw5vn_lsfSR', 'gJL7scS_tA44',
+                         'mVeZOTNntRP4', 'DcPYXagpzQmv', 'US7eVPyLzkaw',
+                         'UCfwnvsV0fZQ'],
+                        ['gJL7scS_tA44', 'UCfwnvsV0fZQ']),
+    'induction_value': (['symmetry'],
+                        ['xgxfu3Xd0ofA', 'x_LH6F8x18Lo', 'wMVZFKi_2SPo',
+                         '3T0s6Z_H3Jqg'],
+                        ['3T0s6Z_H3Jqg']),
+    'induction_diff': (['induction_value'],
+                       ['nfCo2wQ74Bqh', 'CBiCbMWf8Ljf'], []),
+    'induction_policy': (['induction_diff', 'symmetry'],
+                         ['BmKhRFBn4hv_', 'UeCIweRR5DW4', 'jkIhAfFA5Hq3',
+                          'HQzrLH9J5doH', 'PbNsdaqE5gxA', '5yezUb-D5ltZ',
+                          '4V7g2YO15vpo'],
+                         ['jkIhAfFA5Hq3', '4V7g2YO15vpo']),
+}
+# X == Q_T のハックを使う前の、0 になるはずの式(EQ18tmp3)を表示するセル
+proof_num_cells = ['v7aAjf1fah0x', 'wMVZFKi_2SPo']
+
+def load_cells (path=None):
+    if path is None:
+        path = proof_notebook
+        if not os.path.exists(path):
+            path = os.path.join('economy_control_repo', proof_notebook)
+    with open(path, encoding='utf-8') as f:
+        nb = json.load(f)
+    return {c['metadata'].get('id'): ''.join(c['source'])
+            for c in nb['cells'] if c['cell_type'] == 'code'}
+
+def cell_names (src, ctx=ast.Store):
+    return {e.id for e in ast.walk(ast.parse(src))
+            if isinstance(e, ast.Name) and isinstance(e.ctx, ctx)}
+
+def step_key (srcs, base, dep_keys, ns):
+    # セルのソースと、セルが読む上の定義(EQ21D など)の srepr と、入力の
+    # ステップのキーと、sympy, sympy_matrix_tools のバージョンから作る
+    used = set()
+    for src in srcs:
+        used |= cell_names(src, ast.Load)
+    defs = sorted((k, srepr(base[k])) for k in used
+                  if k in base and isinstance(base[k], Basic))
+    smt = getattr(ns.get('sympy_matrix_tools'), '__version__', None)
+    s = repr((sympy.__version__, smt, srcs, defs, dep_keys))
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def memo_load (path, stats):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        stats['load_error'] += 1
+        warnings.warn("proof cache: %s: %r" % (path, e))
+
+def memo_store (path, r, stats):
+    try:
+        data = pickle.dumps(r)
+        # 読み戻して同じ式にならないものは保存しない
+        if pickle.loads(data) != r:
+            raise ValueError("unpickled expression differs")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception as e:
+        stats['store_error'] += 1
+        warnings.warn("proof cache: %s: %r" % (path, e))
+
+def is_zero_expr (e):
+    return e == 0 or isinstance(e, ZeroMatrix) \
+        or getattr(e, 'is_ZeroMatrix', False) is True
+
+def exec_cell (src, env, name):
+    # 最後の式の値を返す(セルの出力として表示されていたもの)
+    tree = ast.parse(src)
+    last = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = ast.Expression(tree.body.pop().value)
+    exec(compile(tree, name, 'exec'), env)
+    if last is not None:
+        return eval(compile(last, name, 'eval'), env)
+
+def print_verification (name, r):
+    if r['skipped']:
+        print("%-18s skipped (%s failed)" % (name, ", ".join(r['skipped'])))
+        return
+    print("%-18s %7.2fs%s  %s" % (name, r['time'],
+                                  " (cache)" if r['cached'] else "",
+                                  ", ".join("%s %s" % (c, "ok" if ok
+                                                       else "FAILED")
+                                            for c, ok in r['checks'])))
+    if r['error']:
+        print("%-18s error in %s" % ("", r['error']))
+
+def run_verification (steps, only=None, cells=None, ns=None,
+                      memo=True, cache_dir=None, num_cells=None):
+    if cells is None:
+        cells = load_cells()
+    if num_cells is None:
+        num_cells = proof_num_cells
+    if ns is None:
+        ns = globals()
+    if cache_dir is None:
+        cache_dir = proof_cache_dir
+    for k, (deps, ids, checks) in steps.items():
+        unknown = [d for d in deps if d not in steps]
+        if unknown:
+            raise KeyError("%s depends on unknown steps %s" % (k, unknown))
+        missing = [c for c in ids + checks if c not in cells]
+        if missing:
+            raise KeyError("%s uses unknown cells %s" % (k, missing))
+    want = set(steps if only is None else only)
+    while True:
+        more = {d for k in want for d in steps[k][0]} - want
+        if not more:
+            break
+        want |= more
+    # ステップのセルが代入する名前は、証明を上から実行したあとの値ではなく
+    # 入力のステップが作ったものを使う
+    assigned = set()
+    for deps, ids, checks in steps.values():
+        for c in ids:
+            assigned |= cell_names(cells[c])
+    base = {k: v for k, v in ns.items() if k not in assigned}
+    order = list(steps)
+    pending = [k for k in order if k in want]
+    outputs = {}
+    keys = {}
+    report = {}
+    stats = {'hit': 0, 'miss': 0, 'load_error': 0, 'store_error': 0}
+    t0 = time.perf_counter()
+    while pending:
+        ready = [k for k in pending if all(d in report for d in steps[k][0])]
+        if not ready:
+            raise ValueError("cyclic dependencies among %s" % pending)
+        k = ready[0]
+        pending.remove(k)
+        deps, ids, zero = steps[k]
+        failed = [d for d in deps if not report[d]['passed']]
+        if failed:
+            report[k] = {'time': 0.0, 'checks': [], 'passed': False,
+                         'skipped': failed, 'error': None, 'cached': False}
+            continue
+        t1 = time.perf_counter()
+        keys[k] = step_key([cells[c] for c in ids], base,
+                           [keys[d] for d in deps], ns)
+        path = os.path.join(cache_dir, keys[k] + ".pkl")
+        r = memo_load(path, stats) if memo else None
+        if r is not None:
+            stats['hit'] += 1
+            outputs[k] = r['outputs']
+            report[k] = {'time': time.perf_counter() - t1,
+                         'checks': r['checks'], 'passed': True,
+                         'skipped': [], 'error': None, 'cached': True}
+            continue
+        stats['miss'] += 1
+        env = dict(base)
+        for d in sorted(deps, key=order.index):
+            env.update(outputs[d])
+        values = {}
+        error = None
+        try:
+            for c in ids:
+                values[c] = exec_cell(cells[c], env, c)
+        except Exception as e:
+            error = "%s: %r" % (c, e)
+        checks = [(c, c in values and bool(is_zero_expr(values[c])))
+                  for c in zero]
+        checks += [(c + " num", c in values
+                    and num_check(values[c], verbose=False))
+                   for c in ids if c in num_cells]
+        outputs[k] = {n: v for n, v in env.items()
+                      if n not in base or v is not base[n]}
+        report[k] = {'time': time.perf_counter() - t1, 'checks': checks,
+                     'passed': error is None and all(ok for c, ok in checks),
+                     'skipped': [], 'error': error, 'cached': False}
+        # 通ったステップだけを保存する
+        if memo and report[k]['passed']:
+            memo_store(path, {'outputs': {n: v for n, v in outputs[k].items()
+                                          if n != '__builtins__'},
+                              'checks': checks}, stats)
+    for k, r in report.items():
+        print_verification(k, r)
+    print("total %.2fs, %s" % (time.perf_counter() - t0, "all passed"
+                               if all(r['passed'] for r in report.values())
+                               else "SOME FAILED"))
+    if memo:
+        print("cache hit %(hit)d, miss %(miss)d, load_error %(load_error)d,"
+              " store_error %(store_error)d" % stats)
+    return report
+
+if use_dag:
+    verification_report = run_verification(proof_steps)
+
+# + [markdown] id="45ajI4LSwugl"
+# ## 数値計算
+#
+# 以上で EQ19D～EQ25D の導出が正しいことは示せたが、これを実際に数値で計算するものも作っておきたい。A, B, P_T, Q_T, beta と z(1), …, z(T) を具体的に与えて、t = T から t = 1 まで後ろ向きに EQ21D～EQ25D を一度だけ計算する。
+#
+# EQ19D は $L(t) = (B^T Q(t) B)^{-1} B^T Q(t)$, $l(t) = (B^T Q(t) B)^{-1} B^T P(t)$ と置けば $x(t) = - L(t) (A y(t - 1) + z(t)) - l(t)$ と書けるので、保存しておくのは L(t) と l(t) だけにする。こうすればメモリは T に比例するだけで、Q(t) や S(t) の n×n 行列を T 個持つ必要はない。なお、上で示した EQQtT より Q(t) は対称なので、数値誤差がたまらないよう毎回対称化しておく。
+#
+# 前向きの計算では y(0) を (N, n) の形で与え、N 個の初期状態をまとめて行列積で計算する。
+#
+# これらは ch03_2b の riccati_backward, riccati_forward, riccati_value として実装してある。
+
+# + id="rIt_eX904JHY"
+import numpy as np
+from economy_control.ch03_2b import (
+    riccati_backward, riccati_forward, riccati_value)
+
+# + [markdown] id="s4zlEenbs0_X"
+# 検算として、ランダムな A, B, P_T, 正定値な Q_T, z に対して、前向きに求めた y(t) から EQ12 の J を直接計算し、EQ20D の v(1, y(0)) と一致するか見る。また x(t) を少しずらすと J が大きくなることも見ておく。
+
+# + id="AzLPh2cTGXiS"
+from economy_control.ch03_2b import calc_J, calc_J_x
+
+rng = np.random.default_rng(0)
+n_, m_, T_ = 6, 2, 20
+A_ = rng.normal(size=(n_, n_)) / np.sqrt(n_)
+B_ = rng.normal(size=(n_, m_))
+P_T_ = rng.normal(size=n_)
+C_ = rng.normal(size=(n_, n_))
+Q_T_ = C_ @ C_.T + np.eye(n_)
+z_ = rng.normal(size=(T_, n_))
+beta_ = 0.95
+y0s_ = rng.normal(size=(5, n_))
+
+rc = riccati_backward(A_, B_, P_T_, Q_T_, beta_, z_)
+xs_, ys_ = riccati_forward(rc, y0s_)
+print(np.max(np.abs(calc_J(ys_, xs_, P_T_, Q_T_, beta_)
+                    - riccati_value(rc, y0s_))))
+
+J0 = calc_J_x(xs_[:, 0], y0s_[0], A_, B_, z_, P_T_, Q_T_, beta_)
+min([calc_J_x(xs_[:, 0] + 1e-3 * rng.normal(size=(T_, m_)), y0s_[0],
+              A_, B_, z_, P_T_, Q_T_, beta_) - J0 for i in range(100)])
+
+# + [markdown] id="jfHYN9hYf6qN"
+# n = 200, T = 1000 ぐらいでも後ろ向きの計算は一度で済み、あとは初期状態を百個与えても行列積だけで済む。
+
+# + id="XWTT6htDClYx"
+n_, m_, T_ = 200, 20, 1000
+A_ = rng.normal(size=(n_, n_)) / np.sqrt(n_)
+B_ = rng.normal(size=(n_, m_))
+P_T_ = rng.normal(size=n_)
+Q_T_ = np.eye(n_)
+z_ = rng.normal(size=(T_, n_))
+
+rc = riccati_backward(A_, B_, P_T_, Q_T_, beta_, z_)
+xs_, ys_ = riccati_forward(rc, rng.normal(size=(100, n_)))
+ys_.shape
+
+# + [markdown] id="Zj55Qo5tw2hk"
+# ## 式のコンパイル
+#
+# 上の riccati_backward などは EQ19D～EQ25D を手で NumPy に書き直したものだが、検算済みの式そのものを NumPy の関数にしてしまうこともできる。sympy の lambdify に cse=True を与えると、EQ19D, EQ21D, EQ22D などに何度も出てくる (B.T*Q(t)*B)**-1 のような共通部分式が一度だけ計算されるようになる。
+#
+# ただ、式を作って expand して lambdify するのはそれなりに時間がかかる。そこで生成されたコードをディスクにキャッシュしておく。ファイル名には式の srepr と引数と sympy のバージョンから作ったハッシュを付けるので、式が変われば別のファイルになる。また名前からファイルへの対応を manifest.json に書いておき、load_compiled を使えば sympy を使わずに(式を作らずに)読み込める。これらの関数も ch03_2b に置いてある。
+
+# + id="OM6O5vexfGhs"
+import inspect
+from economy_control.ch03_2b import compile_exprs, load_compiled
+
+# + [markdown] id="JKnHOPZQk-Sk"
+# 後ろ向きの一段 Q(t+1), P(t+1), g(t+1) → Q(t), P(t), g(t) を EQ24D, EQ23D, EQ25D に EQ21D, EQ22D を代入した式としてまとめてコンパイルする。MatrixFunction のままでは lambdify できないので、上の微分のときと同様に MatrixSymbol に置き換えておく。また Identity(n) は n が記号のままだと NumPy にできないので、expand して消しておく。Q は対称なので Q.T は Q にしておく(EQQtT)。
+#
+# 三つの式を一つの関数にしているのは、共通部分式の除去が式をまたいで効くようにするためである。
+
+# + id="WiXTE0u-_OhQ"
+Q_tp1 = MatrixSymbol("Q_tp1", n, n)
+P_tp1 = MatrixSymbol("P_tp1", n, 1)
+g_tp1 = MatrixSymbol("g_tp1", 1, 1)
+z_tp1 = MatrixSymbol("z_tp1", n, 1)
+
+EQ21tmp = EQ21D.subs(t, t + 1)
+EQ22tmp = EQ22D.subs(t, t + 1)
+step_exprs = [eq.rhs.subs({EQ21tmp.lhs: EQ21tmp.rhs, EQ22tmp.lhs: EQ22tmp.rhs})
+              .subs({Q(t + 1): Q_tp1, P(t + 1): P_tp1, g(t + 1): g_tp1,
+                     z(t + 1): z_tp1})
+              .subs(Q_tp1.T, Q_tp1).expand().doit().subs(Q_tp1.T, Q_tp1)
+              for eq in (EQ24D, EQ23D, EQ25D)]
+riccati_step = compile_exprs('riccati_step',
+                             [A, B, P_T, Q_T, beta, Q_tp1, P_tp1, g_tp1,
+                              z_tp1], step_exprs)
+print(inspect.getsource(riccati_step))
+
+# + [markdown] id="2V23Msn_sqtR"
+# 同様に EQ19D の x(t) と EQ20D の v(t, y(t-1)) を Q(t), P(t), g(t), z(t), y(t-1) の関数としてコンパイルする。
+
+# + id="VY8ZfxHp_9bc"
+Q_t = MatrixSymbol("Q_t", n, n)
+P_t = MatrixSymbol("P_t", n, 1)
+g_t = MatrixSymbol("g_t", 1, 1)
+z_t = MatrixSymbol("z_t", n, 1)
+y_tm1 = MatrixSymbol("y_tm1", n, 1)
+
+policy_exprs = [eq.rhs.subs({EQ21D.lhs: EQ21D.rhs, EQ22D.lhs: EQ22D.rhs})
+                .subs({Q(t): Q_t, P(t): P_t, g(t): g_t, z(t): z_t,
+                       y(t - 1): y_tm1})
+                .subs(Q_t.T, Q_t).expand().doit().subs(Q_t.T, Q_t)
+                for eq in (EQ19D, EQ20D)]
+riccati_policy = compile_exprs('riccati_policy',
+                               [A, B, Q_t, P_t, g_t, z_t, y_tm1],
+                               policy_exprs)
+
+# + [markdown] id="UVKb9QQxTcKZ"
+# コンパイルしたものを使って後ろ向きに計算し、上の riccati_backward, riccati_forward, riccati_value と一致するか確かめる。コンパイルした関数の引数は sympy の形のままなので、ベクトルは (n, 1) の列ベクトルで与える。
+
+# + id="-8b1IsX7iskr"
+from economy_control.ch03_2b import riccati_backward_compiled
+
+rng = np.random.default_rng(1)
+n_, m_, T_ = 6, 2, 20
+A_ = rng.normal(size=(n_, n_)) / np.sqrt(n_)
+B_ = rng.normal(size=(n_, m_))
+P_T_ = rng.normal(size=n_)
+C_ = rng.normal(size=(n_, n_))
+Q_T_ = C_ @ C_.T + np.eye(n_)
+z_ = rng.normal(size=(T_, n_))
+y0_ = rng.normal(size=n_)
+
+rc = riccati_backward(A_, B_, P_T_, Q_T_, beta_, z_)
+Q1_, P1_, g1_ = riccati_backward_compiled(A_, B_, P_T_, Q_T_, beta_, z_)
+x1_, v1_ = riccati_policy(A_, B_, Q1_, P1_, g1_, z_[0].reshape(n_, 1),
+                          y0_.reshape(n_, 1))
+xs_, ys_ = riccati_forward(rc, y0_)
+print(np.max(np.abs(Q1_ - rc['Q1'])), np.max(np.abs(P1_[:, 0] - rc['P1'])),
+      abs(g1_[0, 0] - rc['g1']))
+print(np.max(np.abs(x1_[:, 0] - xs_[0, 0])),
+      abs(v1_[0, 0] - riccati_value(rc, y0_)[0]))
+
+# + [markdown] id="rlc3yfe4q1T1"
+# 二回目以降はハッシュが一致するので lambdify は呼ばれない。式を作らずに manifest から読むだけならさらに速い。
+
+# + id="UUx9wbQt1huV"
+import time
+
+t0 = time.perf_counter()
+compile_exprs('riccati_step', [A, B, P_T, Q_T, beta, Q_tp1, P_tp1, g_tp1,
+                               z_tp1], step_exprs)
+t1 = time.perf_counter()
+load_compiled('riccati_step')
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+
+# + [markdown] id="r8lpjwrzSyBz"
+# ## ベンチマーク
+#
+# 第2章のノートと同じく、問題の大きさを変えながら時間・評価回数・ピークメモリを測って benchmarks/economy_control_03_2b.json に書き出し、基準と比べる。計測には economy_control.bench を使う。
+
+# + id="vWAYNcpwbvk1"
+from economy_control.bench import bench_case, bench_save, bench_compare
+
+
+# + [markdown] id="LvSieKGprxtx"
+# 第3章2節b では、num_check と、数値のリカッチ方程式(riccati_backward + riccati_forward とコンパイルしたもの)を n, m, T を変えながら測る。記号的な証明は上で一度計算しているので、ここでもう一度計算して測ることはしない。
+
+# + id="e5uOT5M_LMWG"
+def bench_riccati_problem (n_, m_, T_, seed=0):
+    rng = np.random.default_rng(seed)
+    C_ = rng.normal(size=(n_, n_))
+    return (rng.normal(size=(n_, n_)) / np.sqrt(n_), rng.normal(size=(n_, m_)),
+            rng.normal(size=n_), C_ @ C_.T + np.eye(n_), 0.95,
+            rng.normal(size=(T_, n_)), rng.normal(size=(100, n_)))
+
+def bench_num_check (expr, d, k=64):
+    num_check(expr, dims=(d,), k=k, verbose=False)
+    return k
+
+def bench_riccati (A, B, P_T, Q_T, beta, zs, y0s, step=None):
+    if step is None:
+        riccati_forward(riccati_backward(A, B, P_T, Q_T, beta, zs), y0s)
+    else:
+        riccati_backward_compiled(A, B, P_T, Q_T, beta, zs, step)
+
+bench_results = []
+for d in ((3, 2), (10, 5), (30, 10)):
+    bench_results.append(bench_case(
+        'num_check', {'n': d[0], 'm': d[1], 'k': 64},
+        lambda: bench_num_check((num_tmp - num_tmp2)
+                                .subs(EQ21D.lhs, EQ21D.rhs), d)))
+step_tmp = load_compiled('riccati_step')
+for n_, m_, T_ in ((6, 2, 20), (20, 5, 1000), (100, 20, 1000)):
+    A_, B_, P_T_, Q_T_, beta_, z_, y0s_ = bench_riccati_problem(n_, m_, T_)
+    bench_results.append(bench_case(
+        'riccati', {'n': n_, 'm': m_, 'T': T_, 'N': 100},
+        lambda: bench_riccati(A_, B_, P_T_, Q_T_, beta_, z_, y0s_)))
+    bench_results.append(bench_case(
+        'riccati_compiled', {'n': n_, 'm': m_, 'T': T_},
+        lambda: bench_riccati(A_, B_, P_T_, Q_T_, beta_, z_, y0s_,
+                              step_tmp)))
+
+bench_save(bench_results, 'economy_control_03_2b')
+bench_compare(bench_results, 'economy_control_03_2b')
@@ -14,7 +14,7 @@
 # + [markdown] id="-s-r8b183fe8"
 # # 村田安雄『動的経済システムの最適制御』第4章のシミュレーション
 #
-# (Version: 0.0.1)
+# (Version: 0.0.2)
 #
 # 「第4章 ライフサイクル理論による消費経路」について本にシミュレーション結果があるが、それを「追試」してみる。
 #
@@ -32,222 +32,77 @@ import matplotlib.pyplot as plt
 import scipy.optimize
 import numpy as np
 
+# + [markdown] id="PnMgQfC1-jdM"
+# モデルの関数とパラメータは economy_control パッケージの ch04 (economy_control/ch04.py)に置いてあり、このノートではそれを import して説明と実験をする。バッチ処理や図の描画もこのパッケージの同じ関数を使う。Colab ではリポジトリを clone してパスに加えてから import する。
+
+# + id="r01sUAKbJJVZ"
+import os
+import subprocess
+import sys
+
+if not os.path.isdir('economy_control'):
+    if not os.path.isdir('economy_control_repo'):
+        subprocess.run(['git', 'clone', '-q',
+                        'https://github.com/JRF-2018/economy_control',
+                        'economy_control_repo'], check=True)
+    sys.path.append('economy_control_repo')
+
 # + [markdown] id="n2aKqnEyYCmz"
-# パラメータを本から書き写す。$\sigma^2$ は p.74 から。
+# 本から書き写したパラメータ。$\sigma^2$ は p.74 から。
 
 # + id="htfEoe5SX_ss"
-R = 65
-sigma_sq = 0.1625567
+from economy_control.ch04 import R, sigma_sq
+
+R, sigma_sq
 
 # + [markdown] id="kSVjNZGsYWZE"
 # p.76 より、基準型(standard)、代替型(alternative)、ケースI、ケースII。
 
 # + id="UZ7UfaRYYZzK"
-case_I = {
-    'T': 85,
-    'p': 0.00652
-}
-
-case_II = {
-    'T': 90,
-    'p': 0.00838
-}
-
-standard = {
-    'gamma': 3,
-    'r': 0.04,
-    'theta': 0.01,
-    'tau': 0.3,
-    'k': 0.5,
-    'A22': 200,
-    'z': 100,
-    'F65': 0
-}
+from economy_control.ch04 import case_I, case_II, standard, alternative
 
-alternative = {
-    'gamma': 4,
-    'r': 0.05,
-    'theta': 0.02,
-    'tau': 0.2,
-    'k': 50,
-    'A22': 400,
-    'z': 70,
-    'F65': 1000
-}
+for name, d in [('case_I', case_I), ('case_II', case_II),
+                ('standard', standard), ('alternative', alternative)]:
+    print(name, d)
 
 # + [markdown] id="R-vCzuOmYd8j"
 # p.75 より、年齢別平均所得。
 
 # + id="DVOyp4o8YcmU"
-y = [0] * 22 + [
-    154.7, # 22
-    162.0, # 23
-    168.4, # 24
-    175.0, # 25
-    182.4, # 26
-    191.9, # 27
-    201.0, # 28
-    209.0, # 29
-    217.3, # 30
-    226.2, # 31
-    235.4, # 32
-
-    243.1, # 33
-    251.0, # 34
-    258.2, # 35
-    267.1, # 36
-    275.7, # 37
-    284.0, # 38
-    291.2, # 39
-    298.9, # 40
-    304.4, # 41
-    310.5, # 42
-    316.0, # 43
-
-    319.7, # 44
-    322.4, # 45
-    325.4, # 46
-    328.1, # 47
-    326.6, # 48
-    325.1, # 49
-    323.8, # 50
-    322.2, # 51
-    321.7, # 52
-    315.8, # 53
-    308.4, # 54
-    
-    301.1, # 55
-    292.1, # 56
-    281.0, # 57
-    267.0, # 58
-    254.0, # 59
-    243.5, # 60
-    234.8, # 61
-    228.5, # 62
-    221.0, # 63
-    214.9, # 64
-    210.0, # 65
-]
-
-y_R_orig = y[R]
+from economy_control.ch04 import y
 
+print(y[22:])
 
 # + [markdown] id="g1vEERwoYslM"
-# パラメータはグローバル変数に代入して使う。
+# パラメータは LifeCycleParams にまとめて、関数には明示的に渡す。
+#
+# 最初はグローバル変数に代入して使っていたが、それだと二つのシナリオを同時に計算できず、並列化もできない。LifeCycleParams は変更できない(frozen)ので、別のパラメータにしたいときは get_params で新しく作る。get_params の引数は、代替型にするパラメータの名前と、ケース(case_I か case_II)と、個別に上書きしたい値である。
 
 # + id="wQXOaID-Yl31"
-def reset_to_standard ():
-    GL = globals()
-    for n, v in standard.items():
-        GL[n] = v
-    for n, v in case_I.items():
-        GL[n] = v
-
-def set_case_II ():
-    GL = globals()
-    for n, v in case_II.items():
-        GL[n] = v
-
-def set_alternative (*args):
-    GL = globals()
-    for n in args:
-        GL[n] = alternative[n]
-
+from economy_control.ch04 import LifeCycleParams, get_params
 
 # + [markdown] id="KrvPfjvEY0hE"
-# パラメータの変更後、常に次の処理をしなければならない。
+# rho, alpha や F65 を足した年齢別所得 y、$t$ 歳の税引き後の所得(引退後は年金 $z$)を並べた inc など派生する値は、LifeCycleParams を作るときに一度だけ計算しておく。後で使う get_Cts_Ats_vec や get_Ats のための値もここで計算しておく(説明は後で)。
 
 # + id="1I39Oi2aYyyE"
-def set_params ():
-    GL = globals()
-    GL['rho'] = 1 + r
-    GL['alpha'] = (1 + theta) ** -1
-    y[R] = y_R_orig + F65
-
+from economy_control.ch04 import (
+    get_income_suffix_sums, get_working_coefs, get_income, get_Ats_coefs)
 
 # + [markdown] id="hLxUXw5nY7FF"
-# まずは基準型にセットしておく。
+# まずは基準型にしておく。
 
 # + id="lY3UfT6TY50k"
-reset_to_standard()
-set_params()
-
+prm = get_params()
 
 # + [markdown] id="Zfvwu4mtZCyb"
 # $C_t$ と $A_t$ を求める方法だが、まず $A_{T+1}$ がわかっているところから $C_T$ を求め、そこから $A_T$ が求まる。次いで $t \ge R + 1$ の間は $A_{t+1}$ と $C_{t+1}$ から $C_t$ と $A_t$ が求まる。そして $C_R$ と $A_R$ が特別に求まった後、今度は逆に $A_{22}$ からはじめてそこから $C_{22}$ が求まり、$t \le R -1$ の間は、$C_t$ と $A_t$ から $C_{t+1}$ と $A_{t+1}$ が求まることになる。問題はパラメータとして $A_{22}$ は与えられるが、$A_{T+1}$ は与えられないという点である。おそらくこの本の著者の手元にはそれを解析的に求める方法があったものと思われる。しかし、私にはその方法がわからない。
 #
 # そこで scipy.optimize.root を使って適当な $A_{T+1}$ を求めるという方針にする。上の方法でやると、$A_{T+1}$ と $A_{22}$ からは $A_R$ において二通りの値が得られる。その差が 0 となるような $A_{T+1}$ を求めるのだ。
 #
-# そこで $A_{T+1}$ が与えられたときの $C_t$ と $A_t$ の列および $A_R$ の二つの値の差を出力する関数をまず定義する。それが以下になる。
+# そこで $A_{T+1}$ が与えられたときの $C_t$ と $A_t$ の列および $A_R$ の二つの値の差を出力する関数をまず定義する。それが get_Cts_Ats である。
 
 # + id="jZgJDG2RY_rD"
-def get_Cts_Ats (A_Tp1):
-    try:
-        A_Tp1 = A_Tp1[0]
-    except:
-        pass
-    Ats = [A_Tp1]
-    Cts = []
-    A_tp1 = A_Tp1
-    # 式(25)
-    C_T = ((rho * alpha * k * (((1 + p) ** (T - R)) -1)) ** (-1/gamma)) * A_Tp1
-    # 式(2')
-    A_T = (rho ** -1) * A_Tp1 + C_T - z
-    Ats.append(A_T)
-    Cts.append(C_T)
-    C_tp1 = C_T
-    A_tp1 = A_T
-    t = T - 1
-    while t >= R + 1:
-        # 式(25) と 式(26) の間の式
-        C_t = ((
-            ((1 + p) ** (R - t - 1)) * (C_tp1 ** - gamma)
-            + (((1 + p) ** (t - R)) - 1) * k * (A_tp1 ** - gamma)
-        ) * rho * alpha) ** (- 1/gamma)
-        # 式(2')
-        A_t = (rho ** -1) * A_tp1 + C_t - z
-        Ats.append(A_t)
-        Cts.append(C_t)
-        C_tp1 = C_t
-        A_tp1 = A_t
-        t = t - 1
-    assert t == R
-    A_Rp1 = A_tp1
-    # 式(27') の下の式
-    C_R = (rho * alpha * ((1 + p) ** -1) * (C_tp1 ** - gamma)) ** (-1/gamma)
-    # 式(1')
-    A_R = (rho ** -1) * A_tp1 + C_R - (1 - tau) * y[R]
-    Ats.append(A_R)
-    Cts.append(C_R)
-    rAts = list(reversed(Ats))
-    rCts = list(reversed(Cts))
-    Ats = []
-    Cts = []
-    t = 22
-    A_t = A22
-    while t <= R - 1:
-        # 式(36)
-        L_t = A_t \
-            + (1 - tau) * sum([y[t + i] * (rho ** - i)
-                               for i in range(R - t + 1)]) \
-            - A_Rp1 * (rho ** (t - R - 1))
-        # 式(34)
-        g = ((rho ** (1 - gamma)) * alpha) ** (1/gamma)
-        # 式(33)
-        G_tp1 = (1 - g ** (R - (t + 1) + 1)) / (1 - g)
-        # 式(40)
-        C_t = L_t / (1 + ((rho ** (1 - gamma)) * alpha * (G_tp1 ** gamma)
-                          * (1 + (1/2) * gamma * (gamma + 1) * sigma_sq))
-                     ** (1/gamma))
-        Ats.append(A_t)
-        Cts.append(C_t)
-        # 式(1)
-        A_t = (A_t + (1 - tau) * y[t] - C_t) * rho
-        t = t + 1
-    d65 = A_R - A_t
-    return Cts + rCts, Ats + rAts, d65
-
-
+from economy_control.ch04 import get_Cts_Ats
 
 # + [markdown] id="PJkEI6HXcFAk"
 # ところでこの関数がまともに動くまでデバッグするには苦労した。もちろん私が産んだケアレスミスもあったが、本にも誤植があった。
@@ -257,21 +112,19 @@ def get_Cts_Ats (A_Tp1):
 # もう一つは式(34) いおいて、$\gamma$ であるべきところが $r$ に置き換わっていたこと。ありがちな誤植だが、これで結果がかなり変わっていた。
 
 # + [markdown] id="QJmmweiEdJbE"
-# さてここで root finding を実際してみよう。
+# さてここで root finding を実際してみよう。score_A_Tp1 は $A_{T+1}$ から d65 を返す(計算には後で説明する get_Cts_Ats_vec を使っている)。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="AUzXLGSMdQB9" outputId="56d5659e-ff98-4865-9615-a379fc806c23"
-def score_A_Tp1 (A_Tp1):
-    Cts, Ats, d65 = get_Cts_Ats(A_Tp1)
-    return d65
+# + colab={"base_uri": "https://localhost:8080/"} id="AUzXLGSMdQB9"
+from economy_control.ch04 import score_A_Tp1
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 print(sol)
 
 # + [markdown] id="AnqaVKVPdf7F"
 # ちゃんと求まったようだ。p.78 の数値の $A_{T+1}$ は 141 なのであってる感じである。一応、$C_t$ と $A_t$ の列も見ておこう。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="9oolNRS7d13t" outputId="7502118f-3be7-40ee-c5ef-b8fa19f71f28"
-Cts, Ats, d65 = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/"} id="9oolNRS7d13t"
+Cts, Ats, d65 = get_Cts_Ats(sol.x, prm)
 Cts
 
 # + colab={"base_uri": "https://localhost:8080/"} id="QTH2c0rbdXA-" outputId="ca551bf6-e7f4-4a6a-c803-5c5cfecc74c2"
@@ -287,59 +140,127 @@ d65
 Ats0 = Ats
 Cts0 = Cts
 
+# + [markdown] id="IZ4Y0HoqwmTH"
+# get_Cts_Ats は root finding のたびに何度も呼ばれるが、Python のループで年齢ごとに計算しているうえ、式(36) の $\sum_i y_{t+i} \rho^{-i}$ を毎年計算し直している(O(R²))。また $A_{T+1}$ は一つずつしか受け取れない。
+#
+# そこで $D_t = \sum_{i=0}^{R-t} y_{t+i} \rho^{-i}$ を $D_t = y_t + \rho^{-1} D_{t+1}$ で一度だけ求めておき、式(40) の分母も $t$ だけで決まるので先に計算しておく(上の get_working_coefs で LifeCycleParams を作るときに計算している)。そのうえで $A_{T+1}$ の候補を配列で受け取り、引退後の後ろ向きの計算と引退前の前向きの計算を候補すべてについて同時に行うものを作る。
+#
+# 引退前の前向きの計算は、式(36)(40)(1) を合わせると $A_{t+1}$ が $A_t$ と $A_{R+1}$ の一次式になる。なので $A_t = a_t A_{22} + b_t + c_t A_{R+1}$ の係数 $a_t, b_t, c_t$ を先に求めておけば、候補ごとのループは要らない。
+
+# + id="xIuBNkSYBAEO"
+from economy_control.ch04 import get_Cts_Ats_vec, score_A_Tp1
+
+# + [markdown] id="PJwhaOnRvrN3"
+# get_Cts_Ats と同じ結果になるか検算しておく。
+
+# + id="F1nJE8BkFQ5E"
+Cts, Ats, d65 = get_Cts_Ats_vec(sol.x, prm)
+print(np.max(np.abs(Cts[0] - np.array(Cts0))),
+      np.max(np.abs(Ats[0] - np.array(Ats0))), d65)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
+sol.x
+
+# + [markdown] id="mO1GSaNMRvYg"
+# 候補をまとめて評価できるので、パラメータを振るときなどは格子上で d65 の符号が変わるところを一度に探し、そこから brentq で根を求めることができる。
+
+# + id="HzcInoDRtU4S"
+from economy_control.ch04 import find_A_Tp1
+
+find_A_Tp1(prm)
+
+# + [markdown] id="RrH50T8Smv--"
+# scipy.optimize.root は d65 の $A_{T+1}$ による微分を差分で求めているので、そのたびに get_Cts_Ats を余計に呼ぶことになる。そこで get_Cts_Ats_vec に deriv=True を与えたときは、後ろ向きの計算と一緒に $dC_t/dA_{T+1}$, $dA_t/dA_{T+1}$ を前進モードで計算し、d65 と $d(d65)/dA_{T+1}$ をあわせて返すようにした。引退前の部分は $A_R$ の式が $A_{R+1}$ の一次式なので、その係数 $c_R$ を掛けるだけで済む。
+#
+# これを使って、ニュートン法に二分法の安全装置を付けたもので $A_{T+1}$ を求める。符号の違う二点が見つかったらそれを挟み込みとして保持し、ニュートン法の次の点が挟み込みの外に出るときや、値が nan になるときは二分法にする。挟み込みがまだないのに nan になったときは find_A_Tp1 と同じ格子で挟み込みを探す。
+#
+# 失敗したときに原因がわかるよう、各反復の $A_{T+1}$, d65, 微分を history に残し、message に理由を書く。
+
+# + id="krvYTSPx8YAJ"
+from economy_control.ch04 import score_A_Tp1_deriv, solve_A_Tp1
+
+# + [markdown] id="kJwSU3mrX6xK"
+# 微分を差分で検算し、scipy.optimize.root と評価回数を比べてみる。
+
+# + id="NZ3hlS5XTs6R"
+d65_, dd65_ = score_A_Tp1_deriv(np.array([100.0, 141.0, 200.0]), prm)
+eps = 1e-4
+print(dd65_ - (score_A_Tp1(np.array([100.0, 141.0, 200.0]) + eps, prm)
+               - score_A_Tp1(np.array([100.0, 141.0, 200.0]) - eps, prm))
+      / (2 * eps))
+sol_newton = solve_A_Tp1(prm)
+print(sol_newton.x, sol_newton.nfev, sol_newton.message)
+print(sol.x, sol.nfev)
 
 # + [markdown] id="MTqTX7kWeSKe"
 # さてここからは複雑な式を解析的に求めるのではなく、力技で最適化したら、同じ結果が出るのかというのを調べてみたい。そのために必要な定義を書き写していく。$C_t$ の値を求めれば $A_t$ の値は簡単に出るので、$C_t$ の値をいろいろな方法で出してそれが上の Cts0 と等しいか見ていく。
 #
-# Cts のベクトルの正しさは差の二乗和によってみるのでそれ用の関数 ssd を定義しておく。
+# Cts のベクトルの正しさは差の二乗和によってみるのでそれ用の関数 ssd を使う。
 
 # + id="oNpsANu-eB8-"
-def ssd (a, b): # Sum of Squared Difference
-    a = np.array(a)
-    b = np.array(b)
-    return np.sum((a - b) ** 2)
-
+from economy_control.ch04 import ssd
 
 # + [markdown] id="P3JxTZiLfT7m"
-# 基本的な定義・式を書き写す。
+# 基本的な定義・式を書き写す。U と W はパッケージのものをそのまま使い、P, Phi, score_Et_UT は本の式どおりに書き写したものを _naive を付けてここに置いておく。
 
 # + id="BLMXYS5ZfIjm"
-# 式(21)
-def U (C):
-    return ((1 - gamma) ** -1) * (C ** (1 - gamma))
-
-# 式(22)
-def W (A):
-    return k * ((1 - gamma) ** -1) * (A ** (1 - gamma))
+from economy_control.ch04 import U, W
 
 # 式(23)
-def P (t):
+def P_naive (t, prm):
+    R, p = prm.R, prm.p
     if t < R:
         return 0
     #assert t <= T
     return 1 - ((1 + p) ** (R - t))
 
 # 式(3)の前の式。
-def Phi(t1, t2):
+def Phi_naive (t1, t2, prm):
     assert t2 >= t1
-    return np.prod([(1 - P(t)) for t in range(t1, t2 + 1)])
+    return np.prod([(1 - P_naive(t, prm)) for t in range(t1, t2 + 1)])
 
 # 式(3)
-def score_Et_UT (t, Cts, Ats):
+def score_Et_UT_naive (t, Cts, Ats, prm):
+    T, alpha = prm.T, prm.alpha
     s = 0
     for i in range(T - t + 1):
-        Pti = P(t + i)
-        s += Phi(t, t + i) * (U(Cts[t + i - 22])
-                                + ((Pti / (1 - Pti)) * W(Ats[t + 1 + i - 22])
-                                   * alpha)) * (alpha ** i)
+        Pti = P_naive(t + i, prm)
+        s += Phi_naive(t, t + i, prm) * (U(Cts[t + i - 22], prm)
+                                           + ((Pti / (1 - Pti))
+                                              * W(Ats[t + 1 + i - 22], prm)
+                                              * alpha)) * (alpha ** i)
     return s
 
 
+# + [markdown] id="4ExPqMFrSM-7"
+# 上が書き写したものだが、score_Et_UT は i ごとに Phi を呼び、Phi はそのたびに P の積を作り直すので、一回の評価で O(T²) 回 P を呼ぶことになる。
+#
+# そこで $\log(1 - P(t))$ の累積和 logS を表にしておき、$\Phi(t_1, t_2) = \exp(\mathrm{logS}_{t_2 + 1} - \mathrm{logS}_{t_1})$ として O(1) で求める。P や遺産の重み $P(t) / (1 - P(t))$ も同じ表に入れ、$\alpha^i$ も表にしておく。表は functools.lru_cache で (p, R, T) や (alpha, T) ごとにキャッシュするので、これらが変わったパラメータでは自動的に別の表になる。パラメータを大量に振っても溜まり続けないよう、キャッシュは最近使った 128 通りまでにしておく。
+#
+# これで score_Et_UT は重みとの内積一つになる。Cts, Ats を (N, ...) の形で与えれば N 個まとめて計算する。
+
+# + id="ZAaZnwLMLOEI"
+from economy_control.ch04 import (
+    get_survival_table, get_discount_table, P, Phi, score_Et_UT)
+
+# + [markdown] id="XG9PK1rNwh-r"
+# 書き写したものと同じ値になるか確かめておく。
+
+# + id="M1JgwUVAgRQr"
+Cts_tmp = np.linspace(150, 250, prm.T - 22 + 1)
+Ats_tmp = np.linspace(200, 100, prm.T - 22 + 2)
+print(max([abs(Phi(t1, t2, prm) - Phi_naive(t1, t2, prm))
+           for t1 in range(22, prm.T + 1) for t2 in range(t1, prm.T + 1)]))
+[score_Et_UT(t, Cts_tmp, Ats_tmp, prm)
+ - score_Et_UT_naive(t, Cts_tmp, Ats_tmp, prm) for t in (22, 50, 70, prm.T)]
+
+
 # + [markdown] id="GqfwCBo6fll9"
 # Cts が決まっているなら Ats は簡単に求まる。
 
 # + id="lkQRW4-ofdLu"
-def get_Ats (Cts):
+def get_Ats_naive (Cts, prm):
+    A22, R, T, tau, y, z, rho = \
+        prm.A22, prm.R, prm.T, prm.tau, prm.y, prm.z, prm.rho
     Ats = [A22]
     A_t = A22
     t = 22
@@ -358,14 +279,24 @@ def get_Ats (Cts):
     return Ats
 
 
+# + [markdown] id="PDo-RtJ-pwPu"
+# 上の get_Ats_naive は最初に書いたものだが、目的関数や制約が評価されるたびに年ごとのループを回すことになる。式(1)(2) は線形なので、$t$ 歳の所得を $Y_t$ ($t \le R$ なら $(1 - \tau) y_t$, それ以外は $z$)とすると
+#
+# $$A_t = \rho^{t - 22} A_{22} + \sum_{j = 22}^{t - 1} \rho^{t - j} (Y_j - C_j)$$
+#
+# と閉じた形に書ける。$\rho^{t - j}$ を並べた下三角行列を M とすれば Ats = (ρ^{t-22} A22 + M Y) - M Cts で、括弧の中と $dA_t/dC_j = -M$ は Cts によらないので LifeCycleParams を作るときに A_base, dAts_dCts として計算してある(上の get_Ats_coefs)。Cts は (N, T - 21) の形で N 個まとめて与えてもよい。
+
+# + id="9EALb9zTPuo0"
+from economy_control.ch04 import get_Ats
+
 # + [markdown] id="XsNj7goLgUQP"
 # いちおう検算しておく。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="podjlym8gQTG" outputId="6118e815-913f-4367-8fce-cb99652b7e80"
-Ats = get_Ats(Cts0)
+# + colab={"base_uri": "https://localhost:8080/"} id="podjlym8gQTG"
+Ats = get_Ats(Cts0, prm)
+print(ssd(Ats, get_Ats_naive(Cts0, prm)))
 ssd(Ats, Ats0)
 
-
 # + [markdown] id="QruYAr6LfsNG"
 # 最適化は Cts の長い列をまるごと求める形になる。
 #
@@ -374,67 +305,71 @@ ssd(Ats, Ats0)
 # Ats の制約は次のようにした。
 
 # + id="NdDtn6xxfkvd"
-def Ats_cons (Cts):
-    Ats = get_Ats(Cts)
-    return sum([i for i in Ats if i < 0])
+from economy_control.ch04 import Ats_cons
+
+# + [markdown] id="KQPoDeRu_uRm"
+# SLSQP に jac を与えないと、69 個ほどの変数それぞれについて差分で勾配を求めることになり、とても遅い。以下の目的関数はどれも、Cts によらない重み $a_t, b_t$ を使って
+#
+# $$S = \sum_{t=22}^{T} a_t U(C_t) + \sum_{t=22}^{T} b_t W(A_{t+1})$$
+#
+# の形をしているので、$U'(C) = C^{-\gamma}$, $W'(A) = k A^{-\gamma}$ と上の dAts_dCts を使って
+#
+# $$\frac{\partial S}{\partial C_j} = a_j U'(C_j) + \sum_t b_t W'(A_{t+1}) \frac{\partial A_{t+1}}{\partial C_j}$$
+#
+# と正確な勾配が求まる。制約 Ats_cons の勾配は、マイナスになっている $A_t$ についての $\partial A_t / \partial C_j$ の和である。
 
+# + id="jTy9_MJP2JVy"
+from economy_control.ch04 import get_UW_grad, Ats_cons_jac
 
 # + [markdown] id="7rsp_MQOg1_l"
 # さて、最適化はどういうことに関して行っているのか。実はこの本には「目的関数」がこの章では直接書かれていない。そこでまずは最も簡単な候補として、各 $t$ における効用を純粋に足し合わせたものを考える。それを Cts1 とする。なお、scipy.optimize.minimize は最小化でこれは効用の最大化であるため、スコアをマイナスにする必要があることに注意すること。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="y2IToKzLgsEG" outputId="869d93bb-f01e-4cc1-d642-2b8f272338a3"
-def score_simple_sum (Cts):
-    Ats = get_Ats(Cts)
-    s = 0
-    for t in range(22, T+1):
-        Pt = P(t)
-        # 式(2) の後の式
-        s += (1 - Pt) * U(Cts[t - 22]) + Pt * W(Ats[t + 1 - 22]) * alpha
-    return -s
-
-res = scipy.optimize.minimize(score_simple_sum, [10] * (T - 22 + 1),
-                              bounds=([(0, np.inf)] * (T - 22 + 1)),
+# + colab={"base_uri": "https://localhost:8080/"} id="y2IToKzLgsEG"
+from economy_control.ch04 import score_simple_sum, score_simple_sum_jac
+
+res = scipy.optimize.minimize(score_simple_sum, [10] * (prm.T - 22 + 1),
+                              args=(prm,), jac=score_simple_sum_jac,
+                              bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
                               constraints=(
-                                  {'type': 'ineq', 'fun': Ats_cons},
+                                  {'type': 'ineq', 'fun': Ats_cons,
+                                   'jac': Ats_cons_jac, 'args': (prm,)},
                               ), method="SLSQP")
 res
 
-# + colab={"base_uri": "https://localhost:8080/"} id="tFFtgl7LhUK_" outputId="509770e0-34a6-4471-bee7-c64a24340776"
+# + colab={"base_uri": "https://localhost:8080/"} id="tFFtgl7LhUK_"
 Cts1 = res.x
-Ats1 = get_Ats(Cts1)
+Ats1 = get_Ats(Cts1, prm)
 Ats1
 
-
 # + colab={"base_uri": "https://localhost:8080/"} id="LdnbsDPWhj_3" outputId="29522ceb-99f1-4a88-efab-6aca35f3c870"
 ssd(Cts1, Cts0)
 
-
 # + [markdown] id="17eMRopIhoeG"
 # …ということで、Cts0 とはかなり異なる結果が得られた。ただ消費が毎期ほぼ同じなので、これはこれでまともな結果ではないかという気もする。ただ、資産が残り過ぎか。
 
 # + [markdown] id="m8-U3LdHh6jm"
 # 次に 22歳のときの効用を最大化することを考える。$E_{22}U_{T}$ を最大化してみる。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="oAaj1nmWhnXW" outputId="305a60d8-891e-410b-844e-d8357519a285"
-def score_E22_UT (Cts):
-    return -score_Et_UT(22, Cts, get_Ats(Cts))
+# + colab={"base_uri": "https://localhost:8080/"} id="oAaj1nmWhnXW"
+from economy_control.ch04 import score_E22_UT, score_E22_UT_jac
 
-res = scipy.optimize.minimize(score_E22_UT, [10] * (T - 22 + 1),
-                              bounds=([(0, np.inf)] * (T - 22 + 1)),
+res = scipy.optimize.minimize(score_E22_UT, [10] * (prm.T - 22 + 1),
+                              args=(prm,), jac=score_E22_UT_jac,
+                              bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
                               constraints=(
-                                  {'type': 'ineq', 'fun': Ats_cons},
+                                  {'type': 'ineq', 'fun': Ats_cons,
+                                   'jac': Ats_cons_jac, 'args': (prm,)},
                               ), method="SLSQP")
 res
 
-# + colab={"base_uri": "https://localhost:8080/"} id="IALm7-0miki2" outputId="0e3f06b4-5ffe-411e-de94-dcf0c7363a02"
+# + colab={"base_uri": "https://localhost:8080/"} id="IALm7-0miki2"
 Cts2 = res.x
-Ats2 = get_Ats(Cts2)
+Ats2 = get_Ats(Cts2, prm)
 Ats2
 
 # + colab={"base_uri": "https://localhost:8080/"} id="N6besA4fiqtP" outputId="37b93403-77c8-4c26-ee5d-088c0bfcfa2d"
 ssd(Cts2, Cts0)
 
-
 # + [markdown] id="Re4Jus23iv3-"
 # …ということで、これは22歳のときのみの判断なため、高齢になったときの消費を過少評価しているようだ。当然 Cts0 とも大きく違う。
 
@@ -442,23 +377,25 @@ ssd(Cts2, Cts0)
 # ここでどうすればよいか詰まった。22歳のときだけでないようにすればいいのだから、$E_tU_T$ を $t$ に関して足し合わせればいいのかとも考えた。しかし、それは求めるのが重すぎるだけで、どうも正しい結果とは思えない。一応コメントアウトしてそのコードだけは載せておこう。
 
 # + id="pbM0Wb0hjdFn"
-# def score_sum_Et_UT (Cts):
-#     Ats = get_Ats(Cts)
+# def score_sum_Et_UT (Cts, prm):
+#     Ats = get_Ats(Cts, prm)
 #     s = 0
-#     for t in range(22, T + 1):
-#         s += score_Et_UT(t, Cts, Ats)
+#     for t in range(22, prm.T + 1):
+#         s += score_Et_UT(t, Cts, Ats, prm)
 #     return -s
 #
-# res = scipy.optimize.minimize(score_sum_Et_UT, [10] * (T - 22 + 1),
-#                               bounds=([(0, np.inf)] * (T - 22 + 1)),
+# res = scipy.optimize.minimize(score_sum_Et_UT, [10] * (prm.T - 22 + 1),
+#                               args=(prm,),
+#                               bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
 #                               constraints=(
-#                                   {'type': 'ineq', 'fun': Ats_cons},
+#                                   {'type': 'ineq', 'fun': Ats_cons,
+#                                    'args': (prm,)},
 #                               ), method="SLSQP")
 # res
 
 # + id="WdMbmHk3iuJJ"
 # Cts3 = res.x
-# Ats3 = get_Ats(Cts3)
+# Ats3 = get_Ats(Cts3, prm)
 # Ats3
 
 # + id="XXhPcTFLjk1v"
@@ -467,27 +404,21 @@ ssd(Cts2, Cts0)
 # + [markdown] id="qhean9Gnjp-I"
 # 本ではベルマン方程式を使っていく。ではそのベルマン方程式にできるだけ忠実にやってみてはどうかと考えた。それが以下になる。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="XnPTLit6joVW" outputId="63235b52-5fc1-4a2d-ec85-509bc7441958"
-def score_V (Cts):
-    Ats = get_Ats(Cts)
-    V = 0
-    t = T
-    while t >= 22:
-        V = (1 - P(t)) * U(Cts[t - 22]) + P(t) * W(Ats[t + 1 - 22]) * alpha \
-            + (1 - P(t)) * alpha * V
-        t = t - 1
-    return -V
-
-res = scipy.optimize.minimize(score_V, [10] * (T - 22 + 1),
-                              bounds=([(0, np.inf)] * (T - 22 + 1)),
+# + colab={"base_uri": "https://localhost:8080/"} id="XnPTLit6joVW"
+from economy_control.ch04 import score_V, score_V_jac
+
+res = scipy.optimize.minimize(score_V, [10] * (prm.T - 22 + 1),
+                              args=(prm,), jac=score_V_jac,
+                              bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
                               constraints=(
-                                  {'type': 'ineq', 'fun': Ats_cons},
+                                  {'type': 'ineq', 'fun': Ats_cons,
+                                   'jac': Ats_cons_jac, 'args': (prm,)},
                               ), method="SLSQP")
 res
 
-# + colab={"base_uri": "https://localhost:8080/"} id="LMbYRKtUj6VB" outputId="7c2ebdee-aeab-4ef7-b03a-f1c44539c31c"
+# + colab={"base_uri": "https://localhost:8080/"} id="LMbYRKtUj6VB"
 Cts4 = res.x
-Ats4 = get_Ats(Cts4)
+Ats4 = get_Ats(Cts4, prm)
 Ats4
 
 # + colab={"base_uri": "https://localhost:8080/"} id="-TWoG5C2kAqP" outputId="5c28a1d1-8d98-4177-86ec-1386abe9bd21"
@@ -499,6 +430,19 @@ ssd(Cts4, Cts0)
 # + colab={"base_uri": "https://localhost:8080/"} id="5dK4s2sLkDtf" outputId="0013facf-c0d2-424f-c6a1-562ff6df60d5"
 ssd(Cts4, Cts2)
 
+# + [markdown] id="-4R53912t_sH"
+# 勾配を書いてみてわかったが、score_V_jac の重み $\pi_t (1 - P(t))$ は $\Phi(22, t) \alpha^{t - 22}$ そのもので、$\pi_t P(t) \alpha$ も score_E22_UT_jac の重みと同じになる。つまり score_V と score_E22_UT はまったく同じ関数であり、Cts4 と Cts2 が一致するのは当然だった。
+#
+# いちおう勾配が差分と合っているかと、両者の値が一致するかを確かめておく。
+
+# + id="nCL3zjHn3NFG"
+Cts_tmp = np.array(Cts0) * 0.9
+for f, fj in [(score_simple_sum, score_simple_sum_jac),
+              (score_E22_UT, score_E22_UT_jac),
+              (score_V, score_V_jac)]:
+    print(scipy.optimize.check_grad(f, fj, Cts_tmp, prm, epsilon=1e-6)
+          / np.linalg.norm(fj(Cts_tmp, prm)))
+score_V(Cts_tmp, prm) - score_E22_UT(Cts_tmp, prm)
 
 # + [markdown] id="eROn6Pl0kRaP"
 # …ということで、ベルマン方程式って何を求めてるのだ？ と考えることになった。$t$ 期ごとに最適化するということでそれは Cts を一気に最適化するのとはまた違うのではないか？ …そう考えるに至った。
@@ -509,24 +453,17 @@ ssd(Cts4, Cts2)
 #
 # そういう方針でやったのが次のものである。これは時間がかかる…。
 
-# + colab={"base_uri": "https://localhost:8080/"} id="cGSDvotKl0pY" outputId="9cf0cba3-5f1b-45ea-d263-b1f646dcd8c5"
-def score_Et_UT_2 (Cts2, Cts1):
-    Cts = list(Cts1) + list(Cts2)
-    Ats = get_Ats(Cts)
-    return - score_Et_UT(22 + len(Cts1), Cts, Ats)
-
-def Ats_cons_2 (Cts2, Cts1):
-    Ats = get_Ats(list(Cts1) + list(Cts2))
-    return sum([i for i in Ats if i < 0])
+# + colab={"base_uri": "https://localhost:8080/"} id="cGSDvotKl0pY"
+from economy_control.ch04 import score_Et_UT_2, Ats_cons_2
 
 Cts = []
-for t in range(22, T + 1):
-    res = scipy.optimize.minimize(score_Et_UT_2, [10] * (T - 22 + 1 - len(Cts)),
-                                  args=(Cts,),
-                                  bounds=([(0, np.inf)] * (T - 22 + 1 - len(Cts))),
+for t in range(22, prm.T + 1):
+    res = scipy.optimize.minimize(score_Et_UT_2, [10] * (prm.T - 22 + 1 - len(Cts)),
+                                  args=(Cts, prm),
+                                  bounds=([(0, np.inf)] * (prm.T - 22 + 1 - len(Cts))),
                                   constraints=(
                                       {'type': 'ineq', 'fun': Ats_cons_2,
-                                       'args': (Cts,)},
+                                       'args': (Cts, prm)},
                                   ), method="SLSQP")
     Cts.append(res.x[0])
     print(t, res.success)
@@ -534,8 +471,8 @@ for t in range(22, T + 1):
 Cts5 = Cts
 Cts5
 
-# + colab={"base_uri": "https://localhost:8080/"} id="f7xLnH3Il8Gg" outputId="74d439f2-8908-4f80-9cef-2736fccd73a3"
-Ats5 = get_Ats(Cts5)
+# + colab={"base_uri": "https://localhost:8080/"} id="f7xLnH3Il8Gg"
+Ats5 = get_Ats(Cts5, prm)
 Ats5
 
 # + colab={"base_uri": "https://localhost:8080/"} id="mwBYHIehmeZw" outputId="545a0c18-d4c3-4cb9-c948-a93d9647c78d"
@@ -548,12 +485,107 @@ ssd(Cts5, Cts0)
 #
 # 結果的に ssd は Cts1 が一番小さく、なんだかなぁ…という感じである。
 
+# + [markdown] id="Gy0KCNui-MxB"
+# 上のループは年齢ごとに毎回 [10] * 残り年数 から SLSQP をやり直し、そのたびに Cts1 + Cts2 のリスト全体から get_Ats を計算し直している。これをパラメータを振るときにも使えるよう、専用の逐次計画ルーチンにしておく。
+#
+# * $t$ 歳の段階の初期値には、前の段階の解の $C_{t+1}$ 以降(res.x[1:])を使う(ウォームスタート)。
+# * すでに決まった $C_{22}, \ldots, C_{t-1}$ の分は Ats に足し込んでおき、各段階では dAts_dCts の右下のブロックだけを掛ける。$C_t$ が決まるたびにその列を足し込むだけなので、段階ごとに O(T) で済む。
+# * $E_tU_T$ の重みは上の表から作り、勾配も正確に与える。
+#
+# 最初は上のループと同じく制約を sum(min(Ats, 0)) >= 0、下限を 0 にして目的関数だけを正規化していたが、T = 90 にすると評価回数が T = 85 の 485 回から 4 万回近くに増えた。段階ごとの成否を見ると多くの段階が失敗していて、T = 85 でも 22 歳の段階の解は本当の最適解からかなりずれていた。原因は次のとおり。
+#
+# * 引退前は bw が 0 なのに W(Ats) を計算してから掛けていた。直線探索の途中で Ats が負になると W(Ats) が nan になり、0 を掛けても nan のままになる(γ が偶数だと nan にならない代わりに大きな値になり、そこへ逃げていく)。
+# * sum(min(Ats, 0)) は Ats = 0 のところで微分できない。
+# * 下限が 0 で、そこでは $U'(0)$ が無限大になる。
+# * $C$ は 10 から 200 程度まで大きさがばらばらで、SLSQP の直線探索がうまく進まない。
+#
+# そこで、W は bw が正の年齢だけで計算し、制約は Ats >= 0 を年ごとの線形な不等式として与え、下限は c_min (1e-3) にした。変数は今の点 $x$ で割った $u = C / x$ にして、解が 1 から大きく動いたときはスケールを取り直して passes 回までやり直す。
+#
+# 段階ごとに成否・メッセージ・評価回数・やり直した回数・時間を記録して返す。失敗した段階があれば、その年齢を RuntimeWarning で知らせる。
+
+# + id="H9e4pOip4-vR"
+import time
+from economy_control.ch04 import plan_time_consistent
+
+# + [markdown] id="Csm5qDPWL-Td"
+# 上の Cts5 と比べてみる。
+
+# + id="M55CFW9yVpte"
+Cts5b, stages5 = plan_time_consistent(prm, verbose=True)
+print(all([s['success'] for s in stages5]))
+print(sum([s['nfev'] for s in stages5]))
+ssd(Cts5b, Cts5)
+
+# + [markdown] id="4vbslHFPyM2H"
+# T = 90 でも失敗する段階がなく、評価回数も T = 85 と同じ程度で済むことを確かめておく。
+
+# + id="VuAcQC3VOEmp"
+Cts_tmp, stages_tmp = plan_time_consistent(get_params(T=90))
+print([s['t'] for s in stages_tmp if not s['success']])
+print(sum([s['nfev'] for s in stages_tmp]))
+
+# + [markdown] id="aY1Ipnj0JjuE"
+# $E_{22}U_T$ の値で比べると Cts5b のほうが Cts5 や Cts4 よりだいぶ良い。効用の値が小さいせいで、上の SLSQP はどれも既定の ftol で早めに止まっていたようだ。
+#
+# また、23歳以降の段階はほとんど 1 回の評価で終わっている。$\Phi(t+1, t_i) = \Phi(t, t_i) / \Phi(t, t)$ なので、$E_{t+1}U_T$ の重みは $E_tU_T$ の $t+1$ 以降の重みの定数倍になり、前の段階の解の続きがそのまま次の段階の解になるためである。
+
+# + id="neT6UTXtXwYI"
+[score_E22_UT(x, prm) for x in [Cts5b, Cts5, Cts4, Cts1]]
+
+# + [markdown] id="oGRdKcWUK2iA"
+# ここまでは Cts の列をまるごと最適化してきたが、score_V のベルマン方程式をそのまま動的計画法で解くこともできる。score_V の漸化式を $A_t$ の関数として書くと
+#
+# $$V_t(A_t) = \max_{C_t} \left[ (1 - P(t)) U(C_t) + P(t) \alpha W(A_{t+1}) + (1 - P(t)) \alpha V_{t+1}(A_{t+1}) \right], \quad V_{T+1} = 0$$
+#
+# で、$A_{t+1} = \rho (A_t + Y_t - C_t)$ である($Y_t$ は税引き後の所得 prm.inc で、$t > R$ では年金 $z$)。
+#
+# これを内生格子法(endogenous grid method)で $T$ から 22 まで後ろ向きに解く。$A_{t+1}$ の格子 a_grid を先に決めると、一階条件
+#
+# $$(1 - P(t)) C_t^{-\gamma} = \rho \left[ P(t) \alpha k A_{t+1}^{-\gamma} + (1 - P(t)) \alpha V'_{t+1}(A_{t+1}) \right]$$
+#
+# から $C_t$ が格子の点ごとにまとめて求まり、$A_t = A_{t+1} / \rho + C_t - Y_t$ がその $C_t$ に対応する(内生的な)格子になる。$V'_{t+1}$ は包絡線定理から $(1 - P(t+1)) C_{t+1}(A_{t+1})^{-\gamma}$ なので、一つ先の政策関数を np.interp で補間すれば済み、最適化は要らない。
+#
+# $A_t$ が内生格子の一番下より小さいときは $A_{t+1}$ が a_grid[0] に張り付く(資産をほぼ使い切る)ものとする。$V_t$ も同じ格子の上で求めておくが、これは $V_{t+1}$ を線形補間しているので近似である。
+
+# + id="zBhdaNo5LTBa"
+from economy_control.ch04 import (
+    dp_policy_at, dp_value_at, solve_dp, dp_policy, dp_value, dp_path)
+
+# + [markdown] id="Xzp9J0ZFPug-"
+# 一度 solve_dp すれば、どんな $A_{22}$ から始めても政策関数を前から引いていくだけで Cts が求まる(dp_path は $A_{22}$ を配列で受け取ってまとめて計算する)。これまでの Cts と $E_{22}U_T$ (score_E22_UT はそのマイナス)で比べてみる。
+
+# + id="bEvGzqTlPsBK"
+t0 = time.perf_counter()
+dp = solve_dp(prm)
+print("solve_dp %.3fs" % (time.perf_counter() - t0))
+Cts6, Ats6 = dp_path(dp, prm.A22, prm)
+print(ssd(Ats6, get_Ats(Cts6, prm)), dp_value(dp, 22, prm.A22, prm))
+for name, x in [('Cts0', Cts0), ('Cts1', Cts1), ('Cts2', Cts2),
+                ('Cts4', Cts4), ('Cts5', Cts5), ('Cts5b', Cts5b),
+                ('Cts6', Cts6)]:
+    print(name, score_E22_UT(x, prm), Ats_cons(x, prm), ssd(x, Cts6))
+
+# + [markdown] id="bnSwyKIVaIUD"
+# 格子を細かくしたときに結果が変わらないかも見ておく。
+
+# + id="A6hieRbIlAmG"
+for n in [500, 1000, 4000]:
+    Cts_n, Ats_n = dp_path(solve_dp(prm, np.geomspace(1e-2, 1e5, n)),
+                           prm.A22, prm)
+    print(n, score_E22_UT(Cts_n, prm), np.max(np.abs(Cts_n - Cts6)))
+
+# + [markdown] id="3KN8ovfGHQvb"
+# 動的計画法で求めた Cts6 の $E_{22}U_T$ がいちばん良く(score_E22_UT が小さく)、逐次計画の Cts5b はそれにほぼ一致する。dp_value による $V_{22}(A_{22})$ もそのマイナスとほぼ同じ値になっている。格子は 2000 点もあれば十分なようだ。
+
+# + id="dnubtaiTqXBY"
+Cts6
+
 # + [markdown] id="-joQ8ZTanJka"
 # さて一応これまでのところを図示しておこう。
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 281} id="IWAE6TOLnPT4" outputId="9242a54c-e611-477d-dd0a-e83b06f44861"
+# + colab={"base_uri": "https://localhost:8080/", "height": 281} id="IWAE6TOLnPT4"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Cts0, label='0')
 ax.plot(t1, Cts1, label='1')
 ax.plot(t1, Cts2, label='2')
@@ -564,9 +596,9 @@ ax.set_ylabel('$C_t$')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 281} id="NLiwVfUymi25" outputId="1d495482-5789-4e70-d1d7-c6aa6c567248"
+# + colab={"base_uri": "https://localhost:8080/", "height": 281} id="NLiwVfUymi25"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 2))
+t1 = list(range(22, prm.T + 2))
 ax.plot(t1, Ats0, label='0')
 ax.plot(t1, Ats1, label='1')
 ax.plot(t1, Ats2, label='2')
@@ -581,11 +613,11 @@ plt.show()
 # さてここからは単純に図4-1a から図4-10b まで「検算」して図示していこう。
 
 # + id="0XWDc1KMnZmY"
-Yts = y[22:R+1] + [z] * (T - R)
+Yts = list(prm.y[22:prm.R+1]) + [prm.z] * (prm.T - prm.R)
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Nkg4M6W3tJE7" outputId="27cf30ae-1538-4933-a02c-3499f0219bd5"
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Nkg4M6W3tJE7"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Yts, label='$Y$')
 ax.plot(t1, Cts0, label='$C$')
 ax.set_xlabel('$t$')
@@ -594,10 +626,10 @@ ax.set_title('Fig. 4-1a')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="TpBReVuKtMxD" outputId="a1365953-a148-45fa-ece1-7d36b637c042"
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="TpBReVuKtMxD"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
-t2 = list(range(22, T + 2))
+t1 = list(range(22, prm.T + 1))
+t2 = list(range(22, prm.T + 2))
 ax.plot(t2, Ats0, label='$A$')
 ax.plot(t1, Cts0, label='$C$')
 ax.set_xlabel('$t$')
@@ -606,18 +638,16 @@ ax.set_title('Fig. 4-1b')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="Q8ucpdsTuzA7" outputId="1f1b548e-a77e-4d0b-c14e-69cd2c29eb6f"
-reset_to_standard()
-set_alternative('r')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="Q8ucpdsTuzA7"
+prm = get_params('r')
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="bo6OvIZRvdKb" outputId="9817bb9b-18d1-4da2-cc2d-d37e58afeeb1"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="bo6OvIZRvdKb"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Yts, label='$Y$')
 ax.plot(t1, Cts1, label='$C$')
 ax.set_xlabel('$t$')
@@ -626,18 +656,16 @@ ax.set_title('Fig. 4-2')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="l41jzaR_wNoz" outputId="0b580f98-07b6-470b-8cf9-39f96573a626"
-reset_to_standard()
-set_alternative('tau')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="l41jzaR_wNoz"
+prm = get_params('tau')
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="krYM7Jh-weoz" outputId="ae9d1076-29a5-4cfa-d05c-7d5ce2ccdd87"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="krYM7Jh-weoz"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Yts, label='$Y$')
 ax.plot(t1, Cts1, label='$C$')
 ax.set_xlabel('$t$')
@@ -646,18 +674,16 @@ ax.set_title('Fig. 4-3')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="JtNJ4bsSwksb" outputId="f3c11878-8bd1-490e-a642-5020890192bc"
-reset_to_standard()
-set_alternative('theta')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="JtNJ4bsSwksb"
+prm = get_params('theta')
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Rr6bI9NCxAtL" outputId="eb1d3974-151e-46ab-fd8d-e350d13df22f"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Rr6bI9NCxAtL"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Cts0, label='$θ = 0.01$')
 ax.plot(t1, Cts1, label='$θ = 0.02$')
 ax.set_xlabel('$t$')
@@ -666,18 +692,16 @@ ax.set_title('Fig. 4-4')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="D-Xit8gHxN0L" outputId="0f967271-9565-400a-9477-4935606059c8"
-reset_to_standard()
-set_alternative('F65')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="D-Xit8gHxN0L"
+prm = get_params('F65')
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="c6t6b1LvxsWz" outputId="fdcaa229-5be0-4e7b-de50-09c92845e8d0"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="c6t6b1LvxsWz"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Cts0, label='$F_{65} = 0$')
 ax.plot(t1, Cts1, label='$F_{65} = 1000$')
 ax.set_xlabel('$t$')
@@ -686,9 +710,9 @@ ax.set_title('Fig. 4-5a')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="a4ef08j3x6yr" outputId="96fd509d-ad59-4487-f13b-96232efbb2d7"
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="a4ef08j3x6yr"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 2))
+t1 = list(range(22, prm.T + 2))
 ax.plot(t1, Ats0, label='$F_{65} = 0$')
 ax.plot(t1, Ats1, label='$F_{65} = 1000$')
 ax.set_xlabel('$t$')
@@ -697,18 +721,16 @@ ax.set_title('Fig. 4-5b')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="TbCyBhCCyFD8" outputId="b56ef5c3-2c66-4aee-a099-986dfb1ac38d"
-reset_to_standard()
-set_alternative('z')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="TbCyBhCCyFD8"
+prm = get_params('z')
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Krd0bkTIyVyc" outputId="da2a2278-af73-486e-ce06-bd16c338a06c"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Krd0bkTIyVyc"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 1))
+t1 = list(range(22, prm.T + 1))
 ax.plot(t1, Cts0, label='$z = 100$')
 ax.plot(t1, Cts1, label='$z = 70$')
 ax.set_xlabel('$t$')
@@ -717,9 +739,9 @@ ax.set_title('Fig. 4-6a')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="0X0AOQoCygEU" outputId="47e2003c-f8a7-434f-c3c1-0c3926827960"
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="0X0AOQoCygEU"
 fig, ax = plt.subplots()
-t1 = list(range(22, T + 2))
+t1 = list(range(22, prm.T + 2))
 ax.plot(t1, Ats0, label='$z = 100$')
 ax.plot(t1, Ats1, label='$z = 70$')
 ax.set_xlabel('$t$')
@@ -728,16 +750,14 @@ ax.set_title('Fig. 4-6b')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="ZuBMd9dYypK0" outputId="0e3325fe-c31b-40ea-e031-426a03847316"
-reset_to_standard()
-set_case_II()
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="ZuBMd9dYypK0"
+prm = get_params(case=case_II)
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Nu4blM1mzBV1" outputId="d1fcef7a-4f07-446c-b192-7a0c43d17887"
-Cts1, Ats1, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="Nu4blM1mzBV1"
+Cts1, Ats1, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
 t1 = list(range(22, case_I['T'] + 1))
 t2 = list(range(22, case_II['T'] + 1))
@@ -761,17 +781,14 @@ ax.set_title('Fig. 4-7b')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="D5zyWzwwzkSt" outputId="73af47b8-630b-4baf-e812-2bc9ca0b2a0b"
-reset_to_standard()
-set_case_II()
-set_alternative('gamma')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="D5zyWzwwzkSt"
+prm = get_params('gamma', case=case_II)
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="PEbtjBcE0aFU" outputId="8214269e-8c74-49c6-edbd-90666190234a"
-Cts2, Ats2, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="PEbtjBcE0aFU"
+Cts2, Ats2, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
 t1 = list(range(22, case_II['T'] + 1))
 ax.plot(t1, Cts1, label='$γ = 3$')
@@ -793,17 +810,14 @@ ax.set_title('Fig. 4-8b')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="DVeLmozI0gcV" outputId="5fdd3d8c-5122-41cd-e1b3-30178fe45967"
-reset_to_standard()
-set_case_II()
-set_alternative('k')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="DVeLmozI0gcV"
+prm = get_params('k', case=case_II)
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="LWKK5C0K0uUV" outputId="0f95c133-d4a5-4b39-84eb-5a222097ca13"
-Cts2, Ats2, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="LWKK5C0K0uUV"
+Cts2, Ats2, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
 t1 = list(range(22, case_II['T'] + 2))
 ax.plot(t1, Ats1, label='$k = 0.5$')
@@ -814,17 +828,14 @@ ax.set_title('Fig. 4-9')
 ax.legend()
 plt.show()
 
-# + colab={"base_uri": "https://localhost:8080/"} id="k4F-DPu70wVs" outputId="446eff1c-ba54-4cb3-ff34-09e4e75ea637"
-reset_to_standard()
-set_case_II()
-set_alternative('A22')
-set_params()
+# + colab={"base_uri": "https://localhost:8080/"} id="k4F-DPu70wVs"
+prm = get_params('A22', case=case_II)
 
-sol = scipy.optimize.root(score_A_Tp1, A22)
+sol = scipy.optimize.root(score_A_Tp1, prm.A22, args=(prm,))
 sol.success
 
-# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="zh-6yegV1eRc" outputId="9c1a00f3-c7fa-40f0-e717-24f7d0062c40"
-Cts2, Ats2, _ = get_Cts_Ats(sol.x)
+# + colab={"base_uri": "https://localhost:8080/", "height": 297} id="zh-6yegV1eRc"
+Cts2, Ats2, _ = get_Cts_Ats(sol.x, prm)
 fig, ax = plt.subplots()
 t1 = list(range(22, case_II['T'] + 1))
 ax.plot(t1, Cts1, label='$A_{22} = 200$')
@@ -848,3 +859,547 @@ plt.show()
 
 # + [markdown] id="v4GNWw9R17U9"
 # ちゃんと「検算」できてるように思う。
+
+# + [markdown] id="fxVgRw2em7pB"
+# ## パラメータを振る
+#
+# 上では図ごとに手でパラメータを設定して root finding をしたが、(gamma, r, theta, tau, k, A22, z, F65, T, p) を何千通りも振って調べたいこともある。そこでシナリオの格子(またはシナリオのリスト)を受け取り、プロセスプールで手分けして $A_{T+1}$ を求めるものを作る。
+#
+# 解くのは economy_control.batch である。コマンドラインから JSON Lines のシナリオをチャンクごとにプロセスプールで解き、チャンクごとの part ファイルに列ごとに書く。ここではシナリオの格子を JSON Lines にして run_batch に渡し、結果を列ごとの配列にまとめて返す run_sweep だけを作る。
+#
+# batch は同じチャンクの中ですでに解けたシナリオのうち一番近いものの $A_{T+1}$ を初期値にする(ウォームスタート)。近さはチャンク内の各パラメータの幅で正規化した距離で測り、根は上の solve_A_Tp1 (と同じ economy_control.ch04 のもの)で求める。なので run_sweep では、近いシナリオが同じチャンクに入るように並べてから書き出す。
+#
+# outdir を指定すると、結果はそこに残り、同じシナリオで呼び直せば書き終わったチャンクは解かずに読むだけになる。
+
+# + id="E9tIqkIEKbiR"
+import itertools
+import json
+import tempfile
+
+from economy_control import batch
+
+sweep_keys = ('gamma', 'r', 'theta', 'tau', 'k', 'A22', 'z', 'F65', 'T', 'p')
+
+def make_scenarios (grid):
+    names = list(grid.keys())
+    return [dict(zip(names, v)) for v in itertools.product(*grid.values())]
+
+def run_sweep (scenarios, outdir=None, workers=None, chunksize=32):
+    if isinstance(scenarios, dict):
+        scenarios = make_scenarios(scenarios)
+    prms = [get_params(**sc) for sc in scenarios]
+    X = np.array([[getattr(prm, n) for n in sweep_keys] for prm in prms],
+                 dtype=float)
+    scale = np.ptp(X, axis=0)
+    scale[scale == 0] = 1
+    order = np.lexsort((X / scale).T[::-1])
+    with tempfile.TemporaryDirectory() as tmp:
+        if outdir is None:
+            outdir = tmp
+        # 呼び直したときに manifest.json の入力と一致するよう、入力も
+        # outdir に書く
+        os.makedirs(outdir, exist_ok=True)
+        path = os.path.join(outdir, 'scenarios.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in order:
+                f.write(json.dumps(scenarios[i]) + '\n')
+        t0 = time.perf_counter()
+        stats = batch.run_batch(path, outdir, 'ch04', method='root',
+                                workers=workers, chunksize=chunksize,
+                                resume=True, verbose=False)
+        elapsed = time.perf_counter() - t0
+        rows = list(batch.iter_results(outdir))
+    names = list(sweep_keys) + ['A_Tp1', 'd65', 'success', 'nfev']
+    res = {n: np.array([r[n] for r in rows]) for n in names}
+    res['success'] = res['success'].astype(bool)
+    print("%d solves in %.2f s (%.1f solves/s)"
+          % (stats['records'], elapsed, stats['records'] / elapsed))
+    return res
+
+
+# + [markdown] id="dRQl3oqFVHXw"
+# 試しに 864 通りのシナリオを振ってみる。
+
+# + id="I5BmItGymohl"
+sweep_grid = {
+    'gamma': [2, 3, 4, 5],
+    'r': [0.03, 0.04, 0.05],
+    'theta': [0.01, 0.02],
+    'tau': [0.2, 0.3, 0.4],
+    'A22': [100, 200, 400],
+    'T': [85, 90],
+    'F65': [0, 1000],
+}
+sweep = run_sweep(sweep_grid, outdir='sweep_results')
+print(np.mean(sweep['success']), np.mean(sweep['nfev']))
+
+# + [markdown] id="k7Li6C3b1zaH"
+# ## 寿命のモンテカルロ
+#
+# これまでは期待値だけを見てきた。実際に何歳で死んでそのときいくら遺産を残すのか、その分布を見るために、死亡年齢を乱数で引いて人生を多数シミュレートしてみる。
+#
+# score_Et_UT の重みと同じく、$t$ 歳の初めに生きている人はその年に確率 $P(t)$ で死に、遺産 $A_{t+1}$ を残すものとする。$T$ 歳まで生き延びた人(死亡年齢を $T + 1$ とする)は $A_{T+1}$ を残して終わる。なので死亡年齢の分布は $t \le T$ では $\exp(\mathrm{logS}_t - \mathrm{logS}_{22}) P(t)$ で、一様乱数一つを累積分布に searchsorted すれば引ける。
+#
+# 消費の政策は Cts の列(年齢だけで決まる。Cts0 など)か、solve_dp の結果(その年の $A_t$ で決まる)で与える。$A_t$ か $C_t$ がマイナスになった人は破綻したものとして数える。
+#
+# 何百万人分もの経路を持っておくことはできないので、block 人ずつ NumPy でまとめて計算し、集計値だけを足し込んでいく。集計値は死亡年齢の度数、年齢別の生存者数と消費の和と二乗和、破綻した人数、遺産と生涯消費の度数分布(bins の外は別に数える)と和・二乗和・最小・最大である。百分位は度数分布から線形補間で求めるので、bins の幅くらいの精度になる。
+#
+# 乱数は SeedSequence(seed).spawn でブロックごとに独立に作るので、同じ seed と block なら workers の数によらず同じ結果になる。workers が 1 以外ならブロックをプロセスに分ける。
+
+# + id="8BHPSggW8uET"
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+mc_default_bins = {
+    'bequest': np.linspace(0, 10000, 2001),
+    'life_C': np.linspace(0, 30000, 3001),
+}
+
+def get_death_age_dist (prm):
+    T = prm.T
+    Pt, logS, bw = get_survival_table(prm.p, prm.R, T)
+    ts = np.arange(22, T + 2)
+    # t 歳の初めに生きている確率 × その年に死ぬ確率
+    f = np.exp(logS[ts] - logS[22]) * np.where(ts <= T, Pt[ts], 1.0)
+    return ts, f
+
+def apply_policy (policy, t, A):
+    if isinstance(policy, dict):
+        return dp_policy(policy, t, A)
+    return np.full(np.shape(A), np.asarray(policy, dtype=float)[t - 22])
+
+def hist_stats (x, edges):
+    return {'counts': np.histogram(x, edges)[0],
+            'under': np.sum(x < edges[0]), 'over': np.sum(x > edges[-1]),
+            'sum': np.sum(x), 'sum2': np.sum(x ** 2),
+            'min': np.min(x), 'max': np.max(x)}
+
+def merge_mc (a, b):
+    r = {}
+    for key in a:
+        if isinstance(a[key], dict):
+            r[key] = merge_mc(a[key], b[key])
+        elif key == 'min':
+            r[key] = min(a[key], b[key])
+        elif key == 'max':
+            r[key] = max(a[key], b[key])
+        else:
+            r[key] = a[key] + b[key]
+    return r
+
+def simulate_block (policy, prm, n, seed, bins):
+    T, rho = prm.T, prm.rho
+    rng = np.random.default_rng(seed)
+    ts, f = get_death_age_dist(prm)
+    cf = np.cumsum(f)
+    d = ts[np.minimum(np.searchsorted(cf, rng.random(n) * cf[-1],
+                                      side='right'), len(ts) - 1)]
+    A = np.full(n, float(prm.A22))
+    bequest = np.zeros(n)
+    life_C = np.zeros(n)
+    ruined = np.zeros(n, dtype=bool)
+    n_alive = np.zeros(T - 22 + 1)
+    sum_C = np.zeros(T - 22 + 1)
+    sum_C2 = np.zeros(T - 22 + 1)
+    for t in range(22, T + 1):
+        i = t - 22
+        alive = d >= t
+        C = apply_policy(policy, t, A)
+        # 式(1)(2)
+        A = (A + prm.inc[i] - C) * rho
+        ruined |= alive & ((A < 0) | (C < 0))
+        n_alive[i] = np.sum(alive)
+        sum_C[i] = np.sum(C[alive])
+        sum_C2[i] = np.sum(C[alive] ** 2)
+        life_C[alive] += C[alive]
+        bequest[d == t] = A[d == t]
+    bequest[d == T + 1] = A[d == T + 1]
+    return {'n': n, 'death_counts': np.bincount(d - 22, minlength=len(ts)),
+            'n_alive': n_alive, 'sum_C': sum_C, 'sum_C2': sum_C2,
+            'ruin': np.sum(ruined),
+            'bequest': hist_stats(bequest, bins['bequest']),
+            'life_C': hist_stats(life_C, bins['life_C'])}
+
+def hist_percentiles (h, edges, q):
+    # bins の外は観測された最小・最大までを一つの bin とみなす
+    e = np.concatenate([[min(h['min'], edges[0])], edges,
+                        [max(h['max'], edges[-1])]])
+    c = np.concatenate([[h['under']], h['counts'], [h['over']]])
+    cum = np.concatenate([[0], np.cumsum(c)]) / np.sum(c)
+    return np.interp(np.asarray(q) / 100, cum, e)
+
+def summarize_mc (acc, bins, q=(1, 5, 25, 50, 75, 95, 99)):
+    n = acc['n']
+    ages = np.arange(22, 22 + len(acc['death_counts']))
+    r = {'n': n, 'q': np.array(q), 'ages': ages,
+         'death_prob': acc['death_counts'] / n,
+         'death_age_mean': acc['death_counts'] @ ages / n,
+         'death_age_percentiles': ages[np.minimum(np.searchsorted(
+             np.cumsum(acc['death_counts']) / n, np.array(q) / 100),
+                                                  len(ages) - 1)],
+         'survive_T_prob': acc['death_counts'][-1] / n,
+         'ruin_prob': acc['ruin'] / n,
+         'alive_prob': acc['n_alive'] / n}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r['C_mean'] = acc['sum_C'] / acc['n_alive']
+        r['C_std'] = np.sqrt(np.maximum(acc['sum_C2'] / acc['n_alive']
+                                        - r['C_mean'] ** 2, 0))
+    for key in ('bequest', 'life_C'):
+        h = acc[key]
+        mean = h['sum'] / n
+        r[key + '_mean'] = mean
+        r[key + '_std'] = np.sqrt(max(h['sum2'] / n - mean ** 2, 0))
+        r[key + '_min'], r[key + '_max'] = h['min'], h['max']
+        r[key + '_percentiles'] = hist_percentiles(h, bins[key], q)
+    return r
+
+def simulate_lives (policy, prm, n, seed=0, block=100000, workers=1,
+                    bins=None):
+    if bins is None:
+        bins = mc_default_bins
+    sizes = [block] * (n // block) + ([n % block] if n % block else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = ([policy] * len(sizes), [prm] * len(sizes), sizes, seeds,
+            [bins] * len(sizes))
+    acc = None
+    t0 = time.perf_counter()
+    if workers == 1:
+        for a in map(simulate_block, *args):
+            acc = a if acc is None else merge_mc(acc, a)
+    else:
+        with ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork')) as ex:
+            for a in ex.map(simulate_block, *args):
+                acc = a if acc is None else merge_mc(acc, a)
+    elapsed = time.perf_counter() - t0
+    print("%d lives in %.2f s (%.0f lives/s)" % (n, elapsed, n / elapsed))
+    return summarize_mc(acc, bins)
+
+
+# + [markdown] id="rUwWb0lvS-I9"
+# 基準型で Cts0 の政策と動的計画法の政策(上の dp)をそれぞれ 100 万人ずつ試してみる。所得に不確実性がないので、遺産の平均は死亡年齢の分布で経路上の $A_{t+1}$ を平均したものに一致するはずである。
+
+# + id="69JPpjdiGUmt"
+prm = get_params()
+ts_d, f_d = get_death_age_dist(prm)
+for name, policy, Ats_p in [('Cts0', Cts0, Ats0), ('dp', dp, Ats6)]:
+    mc = simulate_lives(policy, prm, 1000000, seed=1, workers=None)
+    print(name, "death age", mc['death_age_mean'],
+          mc['death_age_percentiles'],
+          "max |dP|", np.max(np.abs(mc['death_prob'] - f_d)))
+    print("  bequest mean", mc['bequest_mean'],
+          "expected", f_d @ np.append(np.asarray(Ats_p)[1:], Ats_p[-1]))
+    print("  bequest percentiles", mc['bequest_percentiles'])
+    print("  ruin", mc['ruin_prob'], "survive T", mc['survive_T_prob'])
+
+# + [markdown] id="FUUqS6AxiEw3"
+# workers の数によらず同じ結果になることも確かめておく。
+
+# + id="S0MOebBXZHDQ"
+mc1 = simulate_lives(dp, prm, 300000, seed=2, block=50000, workers=1)
+mc2 = simulate_lives(dp, prm, 300000, seed=2, block=50000, workers=None)
+print(mc1['bequest_mean'] == mc2['bequest_mean'],
+      np.all(mc1['death_prob'] == mc2['death_prob']))
+
+# + id="WCZLgMu3x0rq"
+fig, axs = plt.subplots(1, 2, figsize=(10, 4))
+axs[0].bar(mc['ages'], mc['death_prob'])
+axs[0].set_xlabel('death age')
+axs[1].plot(mc['ages'][:-1], mc['C_mean'], label='mean $C$')
+axs[1].fill_between(mc['ages'][:-1], mc['C_mean'] - mc['C_std'],
+                    mc['C_mean'] + mc['C_std'], alpha=0.3)
+axs[1].set_xlabel('$t$')
+axs[1].legend()
+plt.show()
+
+# + [markdown] id="4adduRYKrn7o"
+# ### 所得の不確実性
+#
+# $\sigma^2$ は式(40) の補正項 $1 + \frac{1}{2} \gamma (\gamma + 1) \sigma^2$ に入っているだけで、上のシミュレーションの所得は決まった値だった。そこで $t < R$ の税引き後の所得を $Y_t \exp(\sigma \epsilon_t - \sigma^2 / 2)$ ($\epsilon_t$ は独立な標準正規分布。平均は $Y_t$ のまま)として、消費の政策の期待効用を数値的に求め、本の近似が妥当か確かめてみる。$R$ 歳の所得は F65 を含むので揺らさない。
+#
+# 本の政策は Cts0 の列ではなく、その年の $A_t$ に応じて消費を決める規則として使う。引退前は式(36)(40) で $A_{R+1}$ を root finding で求めた値に固定したもの($A_t$ の一次式)、引退後は get_Cts_Ats_vec で $A_{T+1}$ を振って後ろ向きに計算した $(A_t, C_t)$ の表を補間したものである。これを solve_dp の結果と同じ形の表にしておけば、apply_policy でそのまま使える。
+#
+# 死亡については score_Et_UT の重みで期待値をとってしまい、乱数は所得にだけ使う。所得の乱数は $R - 22$ 次元になるので、scipy.stats.qmc.Sobol の点を scipy.special.ndtri で正規分布に変換し、さらに $\epsilon$ と $-\epsilon$ を対にする(antithetic)。block 本ごとに別々にスクランブルした Sobol 列を使うので、ブロックごとの平均のばらつきから標準誤差が求まる。block は 2 のべき乗にしておく。
+#
+# 政策が手元の資産と所得 $A_t + Y_t$ 以上を消費しようとしたら、$A_{t+1} \geq a_{\min}$ となるように $C_t$ を切り詰め、$C_t < c_{\min}$ なら $c_{\min}$ にする。$U$ と $W$ は 0 で発散するので、$a_{\min} = c_{\min} = 1$ を借入制約兼、破綻したときの罰とする($U(1)$ と $W(1)$ は大きな負の値だが有限)。一度でも切り詰めた経路を破綻として数え、その割合は期待効用とは別に返す。期待効用は破綻した経路も含めたすべての経路で平均する。ブロックの平均は経路の数で重みをつけてまとめ、標準誤差もその重みで求める。
+
+# + id="X-nAtRotjL4G"
+import scipy.special
+from scipy.stats import qmc
+
+def get_book_policy (prm, A_Tp1=None, n=2000):
+    R, rho, tau = prm.R, prm.rho, prm.tau
+    if A_Tp1 is None:
+        A_Tp1 = solve_A_Tp1(prm).x[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Cg, Ag, d65 = get_Cts_Ats_vec(np.geomspace(1e-2, 1e5, n), prm)
+    ok = np.all(np.isfinite(Ag[:, R - 22:]) & (Ag[:, R - 22:] > 0), axis=1) \
+        & np.all(np.isfinite(Cg[:, R - 22:]), axis=1)
+    Cg, Ag = Cg[ok], Ag[ok]
+    ts = np.arange(22, prm.T + 1)
+    As = np.zeros((len(ts), len(Cg)))
+    Cs = np.zeros((len(ts), len(Cg)))
+    A_Rp1 = get_Cts_Ats_vec(A_Tp1, prm)[1][R + 1 - 22]
+    # 引退前は一次式なので、広い範囲の二点以上あれば補間で正確に求まる
+    Aw = np.linspace(-1e5, 1e5, len(Cg))
+    for t in range(22, R):
+        i = t - 22
+        As[i] = Aw
+        # 式(36)(40)
+        Cs[i] = (Aw + (1 - tau) * prm.D[i]
+                 - A_Rp1 * (rho ** (t - R - 1))) / prm.den[i]
+    As[R - 22:] = Ag[:, R - 22:-1].T
+    Cs[R - 22:] = Cg[:, R - 22:].T
+    return {'ts': ts, 'A': As, 'C': Cs}
+
+def draw_normals (n, d, seed, method='sobol', antithetic=True):
+    m = n // 2 if antithetic else n
+    rng = np.random.default_rng(seed)
+    if method == 'sobol':
+        u = qmc.Sobol(d, scramble=True, seed=rng).random(m)
+    else:
+        u = rng.random((m, d))
+    e = scipy.special.ndtri(u)
+    if antithetic:
+        e = np.concatenate([e, -e])
+    return e
+
+def eval_policy_block (policy, prm, n, seed, sigma_sq, method, antithetic,
+                       a_min=1.0, c_min=1.0):
+    T, R, rho, alpha = prm.T, prm.R, prm.rho, prm.alpha
+    Pt, logS, bw = get_survival_table(prm.p, R, T)
+    ts = np.arange(22, T + 1)
+    w = Phi(22, ts, prm) * get_discount_table(alpha, T)[:len(ts)]
+    eps = draw_normals(n, R - 22, seed, method, antithetic)
+    # 年齢ごとに取り出すので (年齢, 経路) の順に並べておく
+    shock = np.exp(np.sqrt(sigma_sq) * eps.T - sigma_sq / 2)
+    A = np.full(n, float(prm.A22))
+    v = np.zeros(n)
+    sum_C = np.zeros(len(ts))
+    ruined = np.zeros(n, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, t in enumerate(ts):
+            C = apply_policy(policy, t, A)
+            Y = prm.inc[i] * shock[i] if t < R else prm.inc[i]
+            # A_{t+1} >= a_min となる上限。A_t >= a_min かつ Y > 0 なので
+            # c_min より大きい
+            C_max = A + Y - a_min / rho
+            ruined |= ~(C <= C_max) | ~(C >= c_min)
+            C = np.clip(np.nan_to_num(C, nan=c_min), c_min, C_max)
+            # 式(1)(2)
+            A = (A + Y - C) * rho
+            sum_C[i] = np.sum(C)
+            # score_Et_UT の 22 歳の重み
+            v += w[i] * (U(C, prm) + bw[t] * alpha * W(A, prm))
+    mean = np.mean(v)
+    # ブロックの大きさで重みをつけて merge_mc で足し合わせる
+    return {'n': n, 'blocks': 1, 'ruin': np.sum(ruined), 'sum_C': sum_C,
+            'sum_v': np.sum(v), 'sum_w2': n ** 2, 'sum_w2_mean': n ** 2 * mean,
+            'sum_w2_mean2': n ** 2 * mean ** 2}
+
+def eval_policy_qmc (policy, prm, n, sigma_sq=None, seed=0, block=2 ** 16,
+                     method='sobol', antithetic=True, workers=1, a_min=1.0,
+                     c_min=1.0):
+    if sigma_sq is None:
+        sigma_sq = prm.sigma_sq
+    nb = max(1, - (- n // block))
+    seeds = np.random.SeedSequence(seed).spawn(nb)
+    args = ([policy] * nb, [prm] * nb, [block] * nb, seeds, [sigma_sq] * nb,
+            [method] * nb, [antithetic] * nb, [a_min] * nb, [c_min] * nb)
+    acc = None
+    t0 = time.perf_counter()
+    if workers == 1:
+        for a in map(eval_policy_block, *args):
+            acc = a if acc is None else merge_mc(acc, a)
+    else:
+        with ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork')) as ex:
+            for a in ex.map(eval_policy_block, *args):
+                acc = a if acc is None else merge_mc(acc, a)
+    elapsed = time.perf_counter() - t0
+    print("%d paths in %.2f s (%.0f paths/s)"
+          % (acc['n'], elapsed, acc['n'] / elapsed))
+    N = acc['n']
+    mean = acc['sum_v'] / N
+    # 重み n_b / N のブロック平均の分散: sum n_b^2 (m_b - mean)^2 / N^2
+    ss = acc['sum_w2_mean2'] - 2 * mean * acc['sum_w2_mean'] \
+        + mean ** 2 * acc['sum_w2']
+    var = max(ss, 0) / N ** 2 * nb / max(nb - 1, 1)
+    return {'n': N, 'value': mean, 'se': np.sqrt(var),
+            'ruin_prob': acc['ruin'] / acc['n'],
+            'C_mean': acc['sum_C'] / acc['n']}
+
+
+# + [markdown] id="lS123J3Ljnsp"
+# まず揺らさない場合に本の政策が Cts0 と同じになることを確かめる。
+
+# + id="rpzOvNlwFE5Z"
+prm = get_params()
+book_policy = get_book_policy(prm)
+print(np.max(np.abs(dp_path(book_policy, prm.A22, prm)[0] - np.array(Cts0))))
+eval_policy_qmc(book_policy, prm, 2, sigma_sq=0, block=2)['value'] \
+    + score_E22_UT(Cts0, prm)
+
+# + [markdown] id="Ui5GiwfVtbbs"
+# 100 万本を Sobol + antithetic と、ふつうの乱数とで比べる。同じ本数でも標準誤差がだいぶ小さくなる。
+
+# + id="cJ0WqYz51rbn"
+qmc_res = eval_policy_qmc(book_policy, prm, 2 ** 20, seed=3, workers=None)
+print(qmc_res['value'], qmc_res['se'], qmc_res['ruin_prob'])
+mc_res = eval_policy_qmc(book_policy, prm, 2 ** 20, seed=3, method='mc',
+                         antithetic=False, workers=None)
+print(mc_res['value'], mc_res['se'], mc_res['ruin_prob'])
+
+# + [markdown] id="RfNdKXJncW5M"
+# 本の近似を確かめる。式(40) の補正項は所得の不確実性に備えて消費を控えさせるものなので、所得が揺れるときには、補正を入れた政策のほうが補正なし(sigma_sq=0 として作った政策)より期待効用が高く、破綻も少ないはずである。比べるために揺らさない所得で解いた動的計画法の政策 dp も同じ所得の揺れのもとで評価しておく。
+
+# + id="PwMXz108oBki"
+for name, policy in [('book', book_policy),
+                     ('book sigma_sq=0',
+                      get_book_policy(get_params(sigma_sq=0))),
+                     ('dp', dp)]:
+    r_ = eval_policy_qmc(policy, prm, 2 ** 20, seed=4, workers=None)
+    print(name, r_['value'], r_['se'], r_['ruin_prob'])
+
+# + [markdown] id="ex0SiZhXqax9"
+# 補正を入れた本の政策は破綻がほとんどない(0.02% 程度)のに対し、補正なしの政策や揺らさない所得で解いた dp では 3 分の 2 近くの経路で一度は消費を切り詰めることになる。ところが破綻した経路も含めた期待効用は、$a_{\min} = c_{\min} = 1$ では後者のほうが高い。切り詰めても翌年からはその年の所得で暮らすだけなので、この罰は軽いのである。
+#
+# そこで罰の重さ $a_{\min} = c_{\min}$ を変えて、26 万本ずつで比べてみる。
+
+# + id="9zAr1Y58-IpN"
+for a_min in (10, 1, 0.1):
+    for name, policy in [('book', book_policy),
+                         ('book sigma_sq=0',
+                          get_book_policy(get_params(sigma_sq=0))),
+                         ('dp', dp)]:
+        r_ = eval_policy_qmc(policy, prm, 2 ** 18, seed=4, workers=None,
+                             a_min=a_min, c_min=a_min)
+        print(a_min, name, r_['value'], r_['se'], r_['ruin_prob'])
+
+# + [markdown] id="1EmcI2Q57IXF"
+# $a_{\min} = 0.1$ にすると、補正なしの本の政策は期待効用が大きく下がり、標準誤差も大きくなる。$W$ は $A^{1-\gamma}$ なので、資産が 0 近くまで下がった経路の重みが効くのである。一方、資産に応じて消費を決める dp は罰の重さによらずほぼ同じ値で、補正を入れた本の政策より期待効用が高い。式(40) の補正は破綻を避けるという意味では数値的にも効いているが、期待効用で比べたときにそれが得かどうかは破綻の罰の決め方による。
+
+# + [markdown] id="317SZ-0JiPgJ"
+# ## ベンチマーク
+#
+# 問題の大きさを変えながら時間・評価回数・ピークメモリを測り、benchmarks/economy_control_04.json に書き出して基準と比べる。計測と記録は economy_control.bench の bench_case などで行う。第2章・第3章2節b のノートでも同じものを使っている。
+
+# + id="2QB5pISMXm64"
+from economy_control.bench import bench_case, bench_save, bench_compare
+
+
+# + [markdown] id="hXSStEbpqDym"
+# 第4章では、get_Cts_Ats_vec による $A_{T+1}$ の scipy.optimize.root、四つの SLSQP の定式化(score_simple_sum, score_E22_UT, score_V と、年齢ごとに score_Et_UT_2 を解き直す Cts5 の逐次計画)、plan_time_consistent を T を変えながら測る。シナリオの数を変えて run_sweep も測る。評価回数は nfev の合計である。生存確率と割引の表は前のセルで作られてキャッシュに入っているので、ピークメモリを測る前には bench_reset でキャッシュを空にして、表を作るぶんも数えるようにする。
+
+# + id="9iWcnJAX9QwO"
+def bench_slsqp (score, jac, prm):
+    n = prm.T - 22 + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = scipy.optimize.minimize(score, [10] * n, args=(prm,), jac=jac,
+                                      bounds=([(0, np.inf)] * n),
+                                      constraints=(
+                                          {'type': 'ineq', 'fun': Ats_cons,
+                                           'jac': Ats_cons_jac,
+                                           'args': (prm,)},
+                                      ), method="SLSQP")
+    return res.nfev
+
+def bench_Cts5 (prm):
+    Cts = []
+    nfev = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for t in range(22, prm.T + 1):
+            n = prm.T - 22 + 1 - len(Cts)
+            res = scipy.optimize.minimize(score_Et_UT_2, [10] * n,
+                                          args=(Cts, prm),
+                                          bounds=([(0, np.inf)] * n),
+                                          constraints=(
+                                              {'type': 'ineq',
+                                               'fun': Ats_cons_2,
+                                               'args': (Cts, prm)},
+                                          ), method="SLSQP")
+            Cts.append(res.x[0])
+            nfev += res.nfev
+    return nfev
+
+def bench_reset ():
+    get_survival_table.cache_clear()
+    get_discount_table.cache_clear()
+
+bench_results = []
+for T_ in (80, 85, 90):
+    prm_tmp = get_params(T=T_)
+    bench_results.append(bench_case(
+        'root', {'T': T_},
+        lambda: scipy.optimize.root(score_A_Tp1, prm_tmp.A22,
+                                    args=(prm_tmp,)).nfev,
+        reset=bench_reset))
+    for score, jac in ((score_simple_sum, score_simple_sum_jac),
+                       (score_E22_UT, score_E22_UT_jac),
+                       (score_V, score_V_jac)):
+        bench_results.append(bench_case(
+            score.__name__, {'T': T_},
+            lambda: bench_slsqp(score, jac, prm_tmp), reset=bench_reset))
+    bench_results.append(bench_case(
+        'Cts5', {'T': T_}, lambda: bench_Cts5(prm_tmp), repeat=1,
+        reset=bench_reset))
+    bench_results.append(bench_case(
+        'plan_time_consistent', {'T': T_},
+        lambda: sum([s['nfev'] for s in plan_time_consistent(prm_tmp)[1]]),
+        repeat=1, reset=bench_reset))
+for grid in ({'gamma': [2, 3], 'r': [0.03, 0.05], 'A22': [100, 400]},
+             {'gamma': [2, 3, 4, 5], 'r': [0.03, 0.04, 0.05],
+              'tau': [0.2, 0.3, 0.4], 'A22': [100, 200, 400]}):
+    scenarios = make_scenarios(grid)
+    bench_results.append(bench_case(
+        'run_sweep', {'scenarios': len(scenarios), 'workers': 1},
+        lambda: np.sum(run_sweep(scenarios, workers=1)['nfev']), repeat=1,
+        reset=bench_reset))
+
+bench_save(bench_results, 'economy_control_04')
+bench_compare(bench_results, 'economy_control_04')
+
+# + [markdown] id="FoxT1IA3BBDC"
+# ## 目的関数の計測
+#
+# SLSQP が score_E22_UT や score_Et_UT_2 を何回呼び、その中の get_Ats, Phi, U, W などのどこに時間がかかっているのかを見るために、第2章のノートと同じく economy_control.instrument で目的関数・勾配・制約を包んで計測する。
+
+# + id="M-UNSvPAIbCR"
+from economy_control.instrument import (
+    instr_bins, new_report, instrument, finish_report, minimize_instrumented,
+    print_report)
+
+# + [markdown] id="axck5ZBBEuPs"
+# score_E22_UT の SLSQP と、Cts5 の最初の段階(勾配を与えていないので差分で勾配をとる)で試す。後者では時間の大半が score_Et_UT(特にその中の Phi)と get_Ats にかかっていて、U や W はほとんど効いていないことがわかる。
+
+# + id="q77JBZfiwxkn"
+with np.errstate(divide='ignore', invalid='ignore'):
+    res_tmp, report_tmp = minimize_instrumented(
+        score_E22_UT, [10] * (prm.T - 22 + 1), args=(prm,),
+        jac=score_E22_UT_jac, bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
+        constraints=({'type': 'ineq', 'fun': Ats_cons, 'jac': Ats_cons_jac,
+                      'args': (prm,)},),
+        method="SLSQP", profile_every=10)
+print_report(report_tmp, 5)
+[(tr['nit'], tr['fun'], tr['viol']) for tr in report_tmp['trace']][-5:]
+
+# + id="onqTK2B6ZUtk"
+with np.errstate(divide='ignore', invalid='ignore'):
+    res_tmp, report_tmp = minimize_instrumented(
+        score_Et_UT_2, [10] * (prm.T - 22 + 1), args=([], prm),
+        bounds=([(0, np.inf)] * (prm.T - 22 + 1)),
+        constraints=({'type': 'ineq', 'fun': Ats_cons_2, 'args': ([], prm)},),
+        method="SLSQP", profile_every=50)
+print_report(report_tmp)
+list(zip(instr_bins[:-1], report_tmp['calls']['score_Et_UT_2']['hist']))
+
+# + [markdown] id="dWi3ELSHgmg8"
+# minimize を使わない root finding などは instrument で直接包めばよい。
+
+# + id="wRZ7eVOOWwl0"
+report_tmp = new_report(profile_every=1)
+t0 = time.perf_counter()
+sol = scipy.optimize.root(instrument(score_A_Tp1, 'score_A_Tp1', report_tmp),
+                          prm.A22, args=(prm,))
+finish_report(report_tmp, time.perf_counter() - t0)
+print_report(report_tmp, 5)
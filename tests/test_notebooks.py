@@ -0,0 +1,325 @@
+"""economy_control パッケージの計算をノートブックの参照実装と比べて確かめる。
+
+ノートブックはモデルの関数をパッケージから import して使い、手元には本の
+式をそのまま書き写した遅い版(calc_ys_naive, P_naive, Phi_naive,
+score_Et_UT_naive, get_Ats_naive)と num_check だけを持っている。ノート
+ブックの *.py からトップレベルの import と関数とクラスの定義、それに指定
+した定数の代入だけを取り出して実行し(実験や図の描画は実行しない)、それ
+らとパッケージの結果を比べる。あわせて、同じ量を別の方法で求めるパッケー
+ジの関数どうし(リカッチ方程式と最適化、閉じた形とループ、解析的な勾配と
+差分など)が一致するかも見る。
+
+    python -m pytest tests
+"""
+
+import ast
+import os
+
+import numpy as np
+import pytest
+
+from economy_control import ch02, ch03_2b, ch04, render
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_notebook (name, consts=()):
+    path = os.path.join(root, name + '.py')
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    ns = {'__name__': name}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            # ノートブックにしか要らないもの(sympy_matrix_tools など)が
+            # 入っていなくても、数値計算の部分は比べられるようにする
+            try:
+                exec(compile(ast.Module([node], []), path, 'exec'), ns)
+            except ImportError:
+                pass
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) \
+             or (isinstance(node, ast.Assign)
+                 and all(isinstance(t, ast.Name) and t.id in consts
+                         for t in node.targets)):
+            exec(compile(ast.Module([node], []), path, 'exec'), ns)
+    return ns
+
+
+@pytest.fixture(scope='module')
+def nb02 ():
+    return load_notebook('economy_control_02')
+
+
+@pytest.fixture(scope='module')
+def nb03 ():
+    return load_notebook('economy_control_03_2b',
+                         consts=('n', 'm', 'num_dims', 'proof_notebook',
+                                 'proof_cache_dir', 'proof_steps',
+                                 'proof_num_cells'))
+
+
+@pytest.fixture(scope='module')
+def nb04 ():
+    return load_notebook('economy_control_04')
+
+
+def set_ch02_globals (nb, prm):
+    # ノートブックの calc_ys_naive はパラメータをグローバル変数で見る
+    for n in ('s', 'nu', 'rho', 'phi', 'dt', 'w', 'theta'):
+        nb[n] = getattr(prm, n)
+
+
+@pytest.mark.parametrize('dt, n', [(0.1, 100), (0.01, 1000)])
+def test_ch02_ys (nb02, dt, n):
+    prm = ch02.get_params(dt=dt)
+    set_ch02_globals(nb02, prm)
+    gs = np.random.default_rng(0).normal(size=(4, n))
+    ys = ch02.calc_ys(-1, gs, prm)
+    for g, y in zip(gs, ys):
+        np.testing.assert_allclose(y, nb02['calc_ys_naive'](-1, g),
+                                   atol=1e-12)
+    np.testing.assert_allclose(ch02.calc_score(gs, -1, prm),
+                               np.sum(ys ** 2 + prm.phi * gs ** 2, axis=-1),
+                               rtol=1e-12)
+
+
+@pytest.mark.parametrize('dt, n', [(0.1, 100), (0.01, 1000)])
+def test_ch02_score_derivs (dt, n):
+    # 係数行列 K を作って行列積で求めたものと、随伴方程式で求めたもの
+    prm = ch02.get_params(dt=dt)
+    rng = np.random.default_rng(1)
+    gs = rng.normal(size=(4, n))
+    v = rng.normal(size=(4, n))
+    a = 1 - prm.s * prm.w * prm.dt
+    k = np.arange(n)
+    d = k[:, None] - k[None, :] - 1
+    K = np.where(d >= 0, prm.w * prm.dt * (a ** np.maximum(d, 0)), 0.0)
+    ys = -1 * (a ** k) + gs @ K.T
+    np.testing.assert_allclose(ch02.calc_score_jac(gs, -1, prm),
+                               2 * ys @ K + 2 * prm.phi * gs, atol=1e-10)
+    np.testing.assert_allclose(ch02.calc_score_hessp(gs, v, -1, prm),
+                               2 * (v @ K.T) @ K + 2 * prm.phi * v,
+                               atol=1e-10)
+
+
+@pytest.mark.parametrize('method', ['L-BFGS-B', 'Newton-CG'])
+def test_ch02_solve_gs (method):
+    prm = ch02.get_params()
+    res_lqr = ch02.solve_gs(-1, 100, prm)
+    res = ch02.solve_gs(-1, 100, prm, method=method)
+    assert res.fun == pytest.approx(res_lqr.fun, rel=1e-8)
+    np.testing.assert_allclose(res.x, res_lqr.x, atol=1e-4)
+
+
+def test_ch02_fields ():
+    ps = [(0.3, 4, 0.1, phi) for phi in (0.5, 1, 2, 4)]
+    Y, G = ch02.get_grid()
+    for p, f in zip(ps, ch02.get_fields(ps)):
+        A = ch02.get_A(*p)
+        np.testing.assert_allclose(f, np.einsum('ij,jhw->ihw', A,
+                                                np.stack([Y, G])))
+
+
+def test_ch03_riccati ():
+    # EQ20D の v(1, y(0)) と、前向きに求めた y(t) から直接計算した J
+    rng = np.random.default_rng(0)
+    n, m, T = 6, 2, 30
+    C = rng.normal(size=(n, n))
+    A = rng.normal(size=(n, n)) / np.sqrt(n)
+    B = rng.normal(size=(n, m))
+    P_T = rng.normal(size=n)
+    Q_T = C @ C.T + np.eye(n)
+    zs = rng.normal(size=(T, n))
+    y0s = rng.normal(size=(5, n))
+    rc = ch03_2b.riccati_backward(A, B, P_T, Q_T, 0.95, zs)
+    xs, ys = ch03_2b.riccati_forward(rc, y0s)
+    np.testing.assert_allclose(ch03_2b.calc_J(ys, xs, P_T, Q_T, 0.95),
+                               ch03_2b.riccati_value(rc, y0s), rtol=1e-10)
+    J0 = ch03_2b.calc_J_x(xs[:, 0], y0s[0], A, B, zs, P_T, Q_T, 0.95)
+    assert all(ch03_2b.calc_J_x(xs[:, 0] + 1e-3 * rng.normal(size=(T, m)),
+                                y0s[0], A, B, zs, P_T, Q_T, 0.95) > J0
+               for i in range(20))
+
+
+def test_ch03_num_check (nb03):
+    import sympy
+    n, m = nb03['n'], nb03['m']
+    B = sympy.MatrixSymbol('B', n, m)
+    Q = sympy.MatrixSymbol('Q', n, n)
+    S = sympy.Identity(n) - B * (B.T * Q * B) ** -1 * B.T * Q
+    check = lambda *a, **kw: nb03['num_check'](*a, verbose=False, **kw)
+    assert check(S * B, sympy.ZeroMatrix(n, m), symmetric=(Q,))
+    assert check(S.T * Q * S, Q * S, symmetric=(Q,))
+    assert not check(S.T * Q * S, Q, symmetric=(Q,))
+    # 対称にするのは渡したものだけで、名前が Q で始まるかどうかは見ない
+    Q2 = sympy.MatrixSymbol('Q2', n, n)
+    X = sympy.MatrixSymbol('X', n, n)
+    assert not check(Q2 - Q2.T, symmetric=(Q,))
+    assert check(X - X.T, symmetric=(Q, X))
+
+
+def test_ch03_proof_steps (nb03):
+    # proof_steps のセルがノートブックにあり、依存関係に循環がないこと
+    cells = nb03['load_cells'](os.path.join(root, nb03['proof_notebook']))
+    done = set()
+    for k, (deps, ids, zero) in nb03['proof_steps'].items():
+        assert set(deps) <= done
+        assert set(zero) <= set(ids) <= set(cells)
+        done.add(k)
+    ids = {c for deps, ids, zero in nb03['proof_steps'].values() for c in ids}
+    assert set(nb03['proof_num_cells']) <= ids
+
+
+def test_ch03_run_verification (nb03, capsys):
+    cells = {
+        'a1': "X_ = MatrixSymbol('X_', 2, 2)\nEa = X_ - X_\nEa",
+        'b1': "Eb = X_.T.T - X_\nEb",
+        'c1': "Ec = X_ * X_ - X_\nEc",
+        'd1': "Ed = Ec\nEd",
+        'e1': "Ee = X_ + Ea\nEe",
+    }
+    steps = {
+        'a': ([], ['a1'], ['a1']),
+        'b': (['a'], ['b1'], ['b1']),
+        'c': (['a'], ['c1'], ['c1']),
+        'd': (['c'], ['d1'], []),
+        'e': ([], ['e1'], []),
+    }
+    # 上から実行したときに残っている名前は使わない
+    ns = dict(nb03, X_=None, Ea=None)
+    r = nb03['run_verification'](steps, cells=cells, ns=ns, memo=False)
+    assert r['a']['passed'] and r['b']['passed']
+    assert r['c']['checks'] == [('c1', False)] and not r['c']['passed']
+    assert r['d']['skipped'] == ['c']
+    assert 'NameError' in r['e']['error']
+    assert 'SOME FAILED' in capsys.readouterr().out
+    r = nb03['run_verification'](steps, only=['b'], cells=cells, ns=ns,
+                                 memo=False)
+    assert list(r) == ['a', 'b']
+    with pytest.raises(ValueError):
+        nb03['run_verification']({'a': (['b'], ['a1'], []),
+                                  'b': (['a'], ['b1'], [])},
+                                 cells=cells, ns=ns, memo=False)
+
+
+def test_ch03_run_verification_num (nb03, monkeypatch):
+    # num_cells のセルの式には num_check もかける
+    import sympy
+    Q_ = sympy.MatrixSymbol('Q_', 2, 2)
+    cells = {'a1': "Q_ = MatrixSymbol('Q_', 2, 2)\nEa = Q_ * (Q_ - Q_.T)\nEa"}
+    steps = {'a': ([], ['a1'], [])}
+    run = lambda: nb03['run_verification'](steps, cells=cells, ns=dict(nb03),
+                                           memo=False, num_cells=['a1'])
+    monkeypatch.setitem(nb03, 'num_symmetric', (Q_,))
+    r = run()
+    assert r['a']['checks'] == [('a1 num', True)] and r['a']['passed']
+    monkeypatch.setitem(nb03, 'num_symmetric', ())
+    r = run()
+    assert r['a']['checks'] == [('a1 num', False)] and not r['a']['passed']
+
+
+def test_ch03_run_verification_cache (nb03, capsys, tmp_path):
+    cells = {
+        'a1': "X_ = MatrixSymbol('X_', 2, 2)\nEa = X_ - X_\nEa",
+        'b1': "Eb = X_.T.T - X_\nEb",
+        'c1': "Ec = X_ * X_ - X_\nEc",
+    }
+    steps = {
+        'a': ([], ['a1'], ['a1']),
+        'b': (['a'], ['b1'], ['b1']),
+        'c': (['a'], ['c1'], ['c1']),
+    }
+
+    def run (cells):
+        r = nb03['run_verification'](steps, cells=cells, ns=dict(nb03),
+                                     cache_dir=str(tmp_path))
+        return {k: (v['cached'], v['passed']) for k, v in r.items()}
+
+    assert run(cells) == {'a': (False, True), 'b': (False, True),
+                          'c': (False, False)}
+    # 通ったステップだけがキャッシュから読まれる
+    assert run(cells) == {'a': (True, True), 'b': (True, True),
+                          'c': (False, False)}
+    assert 'cache hit 2, miss 1, load_error 0, store_error 0' \
+        in capsys.readouterr().out
+    # 書き換えたセルのステップとそれを入力に使うステップだけ計算し直す
+    cells = dict(cells, a1="X_ = MatrixSymbol('X_', 3, 3)\nEa = X_ - X_\nEa")
+    assert run(cells) == {'a': (False, True), 'b': (False, True),
+                          'c': (False, False)}
+    cells = dict(cells, b1="Eb = X_.T.T - X_ + ZeroMatrix(3, 3)\nEb")
+    assert run(cells) == {'a': (True, True), 'b': (False, True),
+                          'c': (False, False)}
+
+
+# 図に使うシナリオ(図4-1a～図4-10b)のうち、標準型と代替型の代表
+ch04_scenarios = ['standard', 'r', 'theta', 'II', 'II_k']
+
+
+@pytest.mark.parametrize('sc', ch04_scenarios)
+def test_ch04_naive (nb04, sc):
+    prm = render.scenario_params(sc)
+    n = prm.T - 22 + 1
+    Cts = np.linspace(150, 250, n)
+    Ats = np.linspace(200, 100, n + 1)
+    for t1 in (22, prm.R, prm.T):
+        for t2 in (t1, prm.R + 1, prm.T):
+            if t2 >= t1:
+                assert ch04.Phi(t1, t2, prm) \
+                    == pytest.approx(nb04['Phi_naive'](t1, t2, prm),
+                                     rel=1e-12)
+    for t in (22, 50, 70, prm.T):
+        assert ch04.score_Et_UT(t, Cts, Ats, prm) \
+            == pytest.approx(nb04['score_Et_UT_naive'](t, Cts, Ats, prm),
+                             rel=1e-12)
+    np.testing.assert_allclose(ch04.get_Ats(Cts, prm),
+                               nb04['get_Ats_naive'](Cts, prm),
+                               rtol=1e-10, atol=1e-8)
+
+
+@pytest.mark.parametrize('sc', ch04_scenarios)
+def test_ch04_root (sc):
+    # 式(25) から後ろ向きに一年ずつ求めるものと、閉じた形でまとめて求めるもの
+    prm = render.scenario_params(sc)
+    sol = ch04.solve_A_Tp1(prm)
+    assert sol.success
+    Cts, Ats = ch04.get_Cts_Ats(sol.x[0], prm)[:2]
+    Cts_vec, Ats_vec = ch04.get_Cts_Ats_vec(sol.x[0], prm)[:2]
+    np.testing.assert_allclose(Cts, Cts_vec, rtol=1e-10)
+    np.testing.assert_allclose(Ats, Ats_vec, rtol=1e-10, atol=1e-8)
+    np.testing.assert_allclose(ch04.get_Ats(Cts_vec, prm), Ats_vec,
+                               rtol=1e-10, atol=1e-8)
+
+
+def check_jac (f, jac, x, prm, rtol=1e-5):
+    J = np.atleast_2d(jac(x, prm))
+    eps = 1e-6 * np.abs(x)
+    for i in range(0, len(x), 7):
+        dx = np.zeros_like(x)
+        dx[i] = eps[i]
+        num = (np.asarray(f(x + dx, prm)) - np.asarray(f(x - dx, prm))) \
+            / (2 * eps[i])
+        np.testing.assert_allclose(J[..., i], np.atleast_1d(num), rtol=rtol,
+                                   atol=1e-8 * np.max(np.abs(J)))
+
+
+@pytest.mark.parametrize('sc', ch04_scenarios)
+def test_ch04_scores (sc):
+    prm = render.scenario_params(sc)
+    Cts = ch04.get_Cts_Ats_vec(ch04.solve_A_Tp1(prm).x[0], prm)[0]
+    Cts = Cts * np.linspace(0.9, 1.1, len(Cts))
+    for name in ('score_simple_sum', 'score_E22_UT', 'score_V'):
+        check_jac(getattr(ch04, name), getattr(ch04, name + '_jac'), Cts, prm)
+    check_jac(ch04.Ats_cons, ch04.Ats_cons_jac, Cts, prm)
+
+
+@pytest.mark.parametrize('sc', ['standard', 'II'])
+def test_ch04_dp (sc):
+    # 時間整合的な計画を年ごとに SLSQP で解いたものと、動的計画法の経路
+    prm = render.scenario_params(sc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Cts_tc, stages = ch04.plan_time_consistent(prm)
+    assert all(s['success'] for s in stages)
+    Cts, Ats = ch04.dp_path(ch04.solve_dp(prm), prm.A22, prm)
+    np.testing.assert_allclose(Cts, Cts_tc, rtol=1e-4)
+    np.testing.assert_allclose(ch04.get_Ats(Cts, prm), Ats, rtol=1e-10,
+                               atol=1e-8)